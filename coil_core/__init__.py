@@ -1,2 +1,2 @@
-
-from .executer import execute_train, execute_validation, execute_train_encoder
\ No newline at end of file
+from .executer import execute_train, execute_validation, execute_train_encoder, execute_train_multi, execute_train_distributed, \
+    execute_train_distill, execute_validation_sharded, execute_scheduled
@@ -1,7 +1,20 @@
+import os
+import sys
+import functools
 import multiprocessing
 from coilutils.general import create_exp_path
+from coilutils.distributed import find_free_port
+from coilutils.job_scheduler import JobScheduler, Task, GB
 
-from . import train, validate, train_encoder
+# The resources declared by the scheduled processes, the cpus count the data loading workers.
+# The scheduler holds the measured usage instead when a process uses more.
+TASK_RESOURCES = {
+    'train': {'cpus': 13, 'ram': 24 * GB, 'gpu_memory': 8 * GB},
+    'validation': {'cpus': 13, 'ram': 16 * GB, 'gpu_memory': 4 * GB}
+}
+
+# The process modules are imported by the execute functions, so a process only loads
+# the dependencies of its own mode
 
 
 def execute_train_encoder(gpu, exp_batch, exp_alias, suppress_output=True, number_of_workers=12):
@@ -17,11 +30,33 @@ def execute_train_encoder(gpu, exp_batch, exp_alias, suppress_output=True, numbe
 
     """
     create_exp_path(exp_batch, exp_alias)
+    from . import train_encoder
     p = multiprocessing.Process(target=train_encoder.execute,
                                 args=(gpu, exp_batch, exp_alias, suppress_output, number_of_workers))
     p.start()
 
 
+def execute_train_distill(gpu, exp_batch, exp_alias, suppress_output=True, number_of_workers=12):
+    """
+        Distill the DISTILL_TEACHER experiment into the encoder of this experiment.
+
+    Args:
+        gpu: The gpu being used for this execution.
+        exp_batch: the folder with the experiments
+        exp_alias: The experiment alias, file name, to be executed.
+        suppress_output: if the output are going to be saved on a file
+        number_of_workers: the number of threads used for data loading
+
+    Returns:
+
+    """
+    create_exp_path(exp_batch, exp_alias)
+    from . import train_distill
+    p = multiprocessing.Process(target=train_distill.execute,
+                                args=(gpu, exp_batch, exp_alias, suppress_output, number_of_workers))
+    p.start()
+
+
 def execute_train(gpu, exp_batch, exp_alias, suppress_output=True, number_of_workers=12, encoder_params = None):
     """
 
@@ -40,11 +75,84 @@ def execute_train(gpu, exp_batch, exp_alias, suppress_output=True, number_of_wor
     else:
         create_exp_path(exp_batch, exp_alias)
 
+    from . import train
     p = multiprocessing.Process(target=train.execute,
                                 args=(gpu, exp_batch, exp_alias, suppress_output, number_of_workers, encoder_params))
     p.start()
 
 
+def execute_train_multi(gpu, exp_batch, exp_aliases, suppress_output=True, number_of_workers=12,
+                        encoder_params=None):
+    """
+        Train several compatible experiments in a single process sharing the data pipeline.
+
+    Args:
+        gpu: The gpu being used for this execution.
+        exp_batch: The folder with the experiments.
+        exp_aliases: The list of experiment aliases, file names, to be trained together.
+        encoder_params: The pre-trained encoder used by all the experiments.
+
+    Returns:
+
+    """
+    for exp_alias in exp_aliases:
+        if encoder_params:
+            create_exp_path(exp_batch, exp_alias + '_' + str(encoder_params['encoder_checkpoint']))
+        else:
+            create_exp_path(exp_batch, exp_alias)
+
+    from . import train_multi
+    p = multiprocessing.Process(target=train_multi.execute,
+                                args=(gpu, exp_batch, exp_aliases, suppress_output, number_of_workers,
+                                      encoder_params))
+    p.start()
+
+
+def execute_train_distributed(gpus, exp_batch, exp_alias, world_size, process_type='train',
+                              suppress_output=True, number_of_workers=12, encoder_params=None):
+    """
+        Data parallel training. One process is started per rank, the ranks are placed on the
+        given gpus round robin and they synchronize through the gloo backend.
+
+    Args:
+        gpus: The list of gpus used by this execution.
+        exp_batch: The folder with the experiments.
+        exp_alias: The experiment alias, file name, to be executed.
+        world_size: The number of training processes.
+        process_type: train or train_encoder.
+        number_of_workers: The number of data loading threads of each process.
+        encoder_params: The pre-trained encoder, only for the train process.
+
+    Returns:
+
+    """
+    if process_type == 'train':
+        if encoder_params:
+            create_exp_path(exp_batch, exp_alias + '_' + str(encoder_params['encoder_checkpoint']))
+        else:
+            create_exp_path(exp_batch, exp_alias)
+    elif process_type == 'train_encoder':
+        create_exp_path(exp_batch, exp_alias)
+    else:
+        raise ValueError("Data parallel training is only available for train and train_encoder")
+
+    # Every process loads its share of the data
+    number_of_workers = max(1, number_of_workers // world_size)
+    dist_url = 'tcp://127.0.0.1:%d' % find_free_port()
+    for rank in range(world_size):
+        if process_type == 'train':
+            from . import train
+            p = multiprocessing.Process(target=train.execute,
+                                        args=(gpus[rank % len(gpus)], exp_batch, exp_alias, suppress_output,
+                                              number_of_workers, encoder_params, rank, world_size, dist_url))
+        else:
+            from . import train_encoder
+            p = multiprocessing.Process(target=train_encoder.execute,
+                                        args=(gpus[rank % len(gpus)], exp_batch, exp_alias, suppress_output,
+                                              number_of_workers, rank, world_size, dist_url))
+        p.start()
+
+
 def execute_validation(gpu, exp_batch, exp_alias, json_file_path, suppress_output=True, encoder_params = None):
     """
 
@@ -63,7 +171,108 @@ def execute_validation(gpu, exp_batch, exp_alias, json_file_path, suppress_outpu
     else:
         create_exp_path(exp_batch, exp_alias)
 
+    from . import validate
     # The difference between train and validation is the
     p = multiprocessing.Process(target=validate.execute,
                                 args=(gpu, exp_batch, exp_alias, json_file_path, suppress_output, encoder_params))
-    p.start()
\ No newline at end of file
+    p.start()
+
+
+def execute_validation_sharded(gpus, exp_batch, exp_alias, json_file_path, world_size, suppress_output=True,
+                               encoder_params=None):
+    """
+        Sharded validation. The dataset is split in world_size contiguous shards, each one
+        validated by its own process, and their metrics are summed into the same summary row
+        a single process validation writes. The processes are placed on the gpus round robin,
+        or all on the CPU with gpus ['cpu'], sharing the cores of the host.
+
+    Args:
+        gpus: The list of gpus used by this execution, or ['cpu'].
+        exp_batch: The folder with the experiments.
+        exp_alias: The experiment alias, file name, to be executed.
+        json_file_path: The json file of the validation dataset.
+        world_size: The number of validation processes.
+        encoder_params: The pre-trained encoder.
+
+    Returns:
+
+    """
+    if encoder_params:
+        create_exp_path(exp_batch, exp_alias + '_' + str(encoder_params['encoder_checkpoint']))
+    else:
+        create_exp_path(exp_batch, exp_alias)
+
+    from . import validate
+    dist_url = 'tcp://127.0.0.1:%d' % find_free_port()
+    for rank in range(world_size):
+        p = multiprocessing.Process(target=validate.execute,
+                                    args=(gpus[rank % len(gpus)], exp_batch, exp_alias, json_file_path,
+                                          suppress_output, encoder_params, False, rank, world_size, dist_url))
+        p.start()
+
+
+def _run_and_check(execute, gpu, *args):
+    """
+        Run the execute function of a process and exit with an error code if it failed. The
+        execute functions log their errors and return, so the exit code alone does not tell.
+    """
+    from logger import coil_logger
+    execute(gpu, *args)
+    if coil_logger.LAST_PHASE == 'Error':
+        sys.exit(1)
+
+
+def _has_checkpoint(checkpoints_path):
+    from coilutils.checkpoint_schedule import read_checkpoint_manifest
+    return bool(read_checkpoint_manifest(checkpoints_path))
+
+
+def execute_scheduled(exp_batch, exp_aliases, validation_datasets=(), gpus=None, suppress_output=True,
+                      number_of_workers=12, encoder_params=None, resources=None):
+    """
+        Train the experiments and validate them on each dataset, on the resources of this host.
+        The processes are packed on the gpus by the memory they need instead of a fixed cost
+        per gpu, trainings first, and each validation starts once its training published a
+        checkpoint. With gpus ['cpu'], or on a host without gpus, they are packed on the cpu
+        cores and RAM. Blocks until every process ended.
+
+    Args:
+        exp_batch: The folder with the experiments.
+        exp_aliases: The experiment aliases, file names, to be executed.
+        validation_datasets: The json files of the validation datasets.
+        gpus: The list of gpus used, all of them if None, or ['cpu'].
+        encoder_params: The pre-trained encoder used by all the experiments.
+        resources: The cpus, ram and gpu_memory of the train and validation processes,
+            updates TASK_RESOURCES.
+
+    Returns:
+        A dictionary from the name of each process to its final status.
+    """
+    task_resources = {process_type: dict(values) for process_type, values in TASK_RESOURCES.items()}
+    for process_type, values in (resources or {}).items():
+        task_resources[process_type].update(values)
+
+    from . import train, validate
+    scheduler = JobScheduler(gpus=gpus)
+    for exp_alias in exp_aliases:
+        if encoder_params:
+            exp_name = exp_alias + '_' + str(encoder_params['encoder_checkpoint'])
+        else:
+            exp_name = exp_alias
+        create_exp_path(exp_batch, exp_name)
+        scheduler.add(Task('train_' + exp_name, _run_and_check,
+                           args=(train.execute, exp_batch, exp_alias, suppress_output, number_of_workers,
+                                 encoder_params),
+                           priority=0, **task_resources['train']))
+
+        checkpoints_path = os.path.join('_logs', exp_batch, exp_name, 'checkpoints')
+        for json_file_path in validation_datasets:
+            dataset_name = os.path.basename(json_file_path).split('.')[0]
+            scheduler.add(Task('validation_' + dataset_name + '_' + exp_name, _run_and_check,
+                               args=(validate.execute, exp_batch, exp_alias, json_file_path, suppress_output,
+                                     encoder_params),
+                               priority=1, ready=functools.partial(_has_checkpoint, checkpoints_path),
+                               ready_from=['train_' + exp_name],
+                               **task_resources['validation']))
+
+    return scheduler.run()
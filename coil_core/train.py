@@ -8,10 +8,14 @@ import torch.optim as optim
 
 from configs import g_conf, set_type_of_process, merge_with_yaml
 from network import CoILModel, Loss, adjust_learning_rate_auto, EncoderModel
-from input import CoILDataset, Augmenter, select_balancing_strategy
+from input import CoILDataset, Augmenter, select_balancing_strategy, EmbeddingCache, checkpoint_hash
 from logger import coil_logger
+from logger.profiler import StageProfiler
 from coilutils.checkpoint_schedule import is_ready_to_save, get_latest_saved_checkpoint, \
-                                    check_loss_validation_stopped
+                                    check_loss_validation_stopped, save_checkpoint
+from coilutils.distributed import init_distributed, cleanup, is_main_process, get_rank, get_world_size, \
+    barrier, any_process, broadcast_learning_rate, broadcast_parameters, average_gradients, data_parallel, \
+    select_device
 import numpy as np
 
 
@@ -26,32 +30,47 @@ def seed_everything(seed=0):
 
 
 # The main function maybe we could call it with a default name
-def execute(gpu, exp_batch, exp_alias, suppress_output=True, number_of_workers=12, encoder_params = None):
+def execute(gpu, exp_batch, exp_alias, suppress_output=True, number_of_workers=12, encoder_params = None,
+            rank=0, world_size=1, dist_url=None):
     """
         The main training function. This functions loads the latest checkpoint
         for a given, exp_batch (folder) and exp_alias (experiment configuration).
         With this checkpoint it starts from the beginning or continue some training.
     Args:
-        gpu: The GPU number
+        gpu: The GPU number, or 'cpu' to train on the CPU
         exp_batch: the folder with the experiments
         exp_alias: the alias, experiment name
         suppress_output: if the output are going to be saved on a file
         number_of_workers: the number of threads used for data loading
+        encoder_params: the pre-trained encoder folder, exp and checkpoint
+        rank: the rank of this process on a data parallel run
+        world_size: the number of processes of a data parallel run, 1 to train on a single process
+        dist_url: the rendezvous address of the data parallel run
 
     Returns:
         None
 
     """
     try:
-        # We set the visible cuda devices to select the GPU
-        os.environ["CUDA_VISIBLE_DEVICES"] = gpu
+        device = select_device(gpu, world_size)
+        if world_size > 1:
+            init_distributed(rank, world_size, dist_url)
+            # Only the first process writes logs and checkpoints
+            if not is_main_process():
+                coil_logger.mute()
         g_conf.VARIABLE_WEIGHT = {}
         # At this point the log file with the correct naming is created.
         # You merge the yaml file with the global configuration structure.
         merge_with_yaml(os.path.join('configs', exp_batch, exp_alias + '.yaml'), encoder_params)
+        if world_size > 1:
+            # The configured batch is split among the processes, g_conf.BATCH_SIZE is
+            # from now on the batch of a single process.
+            if g_conf.BATCH_SIZE % world_size != 0:
+                raise ValueError("The batch size should be divisible by the number of processes")
+            g_conf.BATCH_SIZE = g_conf.BATCH_SIZE // world_size
         set_type_of_process('train')
         # Set the process into loading status.
-        coil_logger.add_message('Loading', {'GPU': os.environ["CUDA_VISIBLE_DEVICES"]})
+        coil_logger.add_message('Loading', {'GPU': gpu})
 
         seed_everything(seed=g_conf.MAGICAL_SEED)
 
@@ -79,7 +98,7 @@ def execute(gpu, exp_batch, exp_alias, suppress_output=True, number_of_workers=1
             checkpoint = torch.load(os.path.join('_logs', g_conf.PRELOAD_MODEL_BATCH,
                                                   g_conf.PRELOAD_MODEL_ALIAS,
                                                  'checkpoints',
-                                                 str(g_conf.PRELOAD_MODEL_CHECKPOINT)+'.pth'))
+                                                 str(g_conf.PRELOAD_MODEL_CHECKPOINT)+'.pth'), map_location=device)
 
         else:
 
@@ -89,7 +108,7 @@ def execute(gpu, exp_batch, exp_alias, suppress_output=True, number_of_workers=1
             if checkpoint_file is not None:
                 print('loading previous checkpoint ', checkpoint_file)
                 checkpoint = torch.load(os.path.join('_logs', g_conf.EXPERIMENT_BATCH_NAME, g_conf.EXPERIMENT_NAME,
-                                        'checkpoints', str(get_latest_saved_checkpoint())))
+                                        'checkpoints', str(get_latest_saved_checkpoint())), map_location=device)
                 iteration = checkpoint['iteration']
                 best_loss = checkpoint['best_loss']
                 best_loss_iter = checkpoint['best_loss_iter']
@@ -112,17 +131,23 @@ def execute(gpu, exp_batch, exp_alias, suppress_output=True, number_of_workers=1
             json_file_name = str(g_conf.EXPERIENCE_FILE[0]).split('/')[-1].split('.')[-2]
         else:
             json_file_name = str(g_conf.EXPERIENCE_FILE[0]).split('/')[-1].split('.')[-2] + '_' + str(g_conf.EXPERIENCE_FILE[1]).split('/')[-1].split('.')[-2]
+        # The first process writes the preload file that the others read
+        if not is_main_process():
+            barrier()
         dataset = CoILDataset(transform=augmenter,
                               preload_name=g_conf.PROCESS_NAME + '_' + json_file_name + '_' + g_conf.DATA_USED)
+        if is_main_process():
+            barrier()
 
         #dataset = CoILDataset(transform=augmenter, preload_name=str(g_conf.NUMBER_OF_HOURS)+ 'hours_' + g_conf.TRAIN_DATASET_NAME)
         print ("Loaded Training dataset")
 
-        data_loader = select_balancing_strategy(dataset, iteration, number_of_workers)
+        data_loader = select_balancing_strategy(dataset, iteration, number_of_workers,
+                                                get_rank(), get_world_size())
         if g_conf.MODEL_TYPE in ['separate-affordances']:
             model = CoILModel(g_conf.MODEL_TYPE, g_conf.MODEL_CONFIGURATION, g_conf.ENCODER_MODEL_CONFIGURATION)
 
-        model.cuda()
+        model.to(device)
         optimizer = optim.Adam(model.parameters(), lr=g_conf.LEARNING_RATE)
 
         print(model)
@@ -131,16 +156,17 @@ def execute(gpu, exp_batch, exp_alias, suppress_output=True, number_of_workers=1
 
         if g_conf.MODEL_TYPE in ['separate-affordances']:
             encoder_model = EncoderModel(g_conf.ENCODER_MODEL_TYPE, g_conf.ENCODER_MODEL_CONFIGURATION)
-            encoder_model.cuda()
+            encoder_model.to(device)
             encoder_model.eval()
             # To freeze the pre-trained encoder model
             if g_conf.FREEZE_ENCODER:
                 for param_ in encoder_model.parameters():
                     param_.requires_grad = False
             if encoder_params is not None:
-                encoder_checkpoint = torch.load(
-                    os.path.join('_logs', encoder_params['encoder_folder'], encoder_params['encoder_exp'], 'checkpoints',
-                                 str(encoder_params['encoder_checkpoint']) + '.pth'))
+                encoder_checkpoint_path = os.path.join('_logs', encoder_params['encoder_folder'],
+                                                       encoder_params['encoder_exp'], 'checkpoints',
+                                                       str(encoder_params['encoder_checkpoint']) + '.pth')
+                encoder_checkpoint = torch.load(encoder_checkpoint_path, map_location=device)
                 print("Encoder model ", str(encoder_params['encoder_checkpoint']), "loaded from ",
                       os.path.join('_logs', encoder_params['encoder_folder'], encoder_params['encoder_exp'], 'checkpoints'))
                 encoder_model.load_state_dict(encoder_checkpoint['state_dict'])
@@ -159,6 +185,26 @@ def execute(gpu, exp_batch, exp_alias, suppress_output=True, number_of_workers=1
                 else:
                     print('  Frozen layers', name_encoder)
 
+            # With a frozen encoder its embeddings only depend on the frame, so they are computed
+            # once and the heads are trained directly on them.
+            if g_conf.ENCODER_EMBEDDING_CACHE:
+                if not g_conf.FREEZE_ENCODER or encoder_params is None:
+                    raise RuntimeError("The embedding cache needs a frozen pre-trained encoder")
+                if g_conf.AUGMENTATION is not None and g_conf.AUGMENTATION != 'None':
+                    raise RuntimeError("The embedding cache can not be used with data augmentation")
+                # The first process fills the cache, the others open it once it is complete
+                if is_main_process():
+                    embedding_cache = EmbeddingCache(dataset.preload_name,
+                                                     checkpoint_hash(encoder_checkpoint_path),
+                                                     len(dataset))
+                    embedding_cache.fill(encoder_model, dataset, number_of_workers)
+                barrier()
+                if not is_main_process():
+                    embedding_cache = EmbeddingCache(dataset.preload_name,
+                                                     checkpoint_hash(encoder_checkpoint_path),
+                                                     len(dataset))
+                dataset.embedding_cache = embedding_cache
+
 
         if checkpoint_file is not None or g_conf.PRELOAD_MODEL_ALIAS is not None:
             model.load_state_dict(checkpoint['state_dict'])
@@ -175,15 +221,25 @@ def execute(gpu, exp_batch, exp_alias, suppress_output=True, number_of_workers=1
             else:
                 print('  Frozen layers', name)
 
+        # On a data parallel run the head forward goes through the wrapper that syncs the
+        # gradients. The encoder is called through forward_encoder, so its gradients are
+        # averaged explicitly when it is fine tuned.
+        head_model = data_parallel(model)
+        if g_conf.MODEL_TYPE in ['separate-affordances'] and not g_conf.FREEZE_ENCODER:
+            broadcast_parameters(encoder_model)
+
         print ("Before the loss")
 
+        profiler = StageProfiler(g_conf.PROFILE_STAGES, g_conf.PROFILE_LOG_FREQUENCY)
+        profiler.start()
         # Loss time series window
         for data in data_loader:
+            profiler.toc('data_wait')
 
             # Basically in this mode of execution, we validate every X Steps, if it goes up 3 times,
             # add a stop on the _logs folder that is going to be read by this process
             if g_conf.FINISH_ON_VALIDATION_STALE is not None and \
-                    check_loss_validation_stopped(iteration, g_conf.FINISH_ON_VALIDATION_STALE):
+                    any_process(check_loss_validation_stopped(iteration, g_conf.FINISH_ON_VALIDATION_STALE)):
                 break
                 
             """
@@ -194,49 +250,58 @@ def execute(gpu, exp_batch, exp_alias, suppress_output=True, number_of_workers=1
 
             if iteration % 1000 == 0:
                 adjust_learning_rate_auto(optimizer, loss_window)
+                broadcast_learning_rate(optimizer)
 
             model.zero_grad()
             if not g_conf.FREEZE_ENCODER:
                 encoder_model.zero_grad()
 
-            if g_conf.LABELS_SUPERVISED:
-                inputs_data = torch.cat((data['rgb'],
-                                         torch.zeros(g_conf.BATCH_SIZE, 1, 88, 200)), dim=1).cuda()
-            else:
-                inputs_data = torch.squeeze(data['rgb'].cuda())
-
-
             if g_conf.MODEL_TYPE in ['separate-affordances']:
                 #TODO: for this two encoder models training, we haven't put speed as input to train yet
 
+                classification_gt = dataset.extract_affordances_targets(data, 'classification')
+                regression_gt = dataset.extract_affordances_targets(data, 'regression')
+                if dataset.embedding_cache is None:
+                    encoder_inputs = dataset.extract_inputs(data)
+                    encoder_commands = dataset.extract_commands(data)
+                profiler.toc('extract')
 
-                if g_conf.ENCODER_MODEL_TYPE in ['action_prediction',
-                                                 'stdim', 'forward','one-step-affordances']:
-
-                    e, inter = encoder_model.forward_encoder(inputs_data,
-                                           dataset.extract_inputs(data).cuda(),
-                                           # We also add measurements and commands
-                                                             torch.squeeze(
-                                                                 dataset.extract_commands(
-                                                                     data).cuda()))
-
-
-                elif g_conf.ENCODER_MODEL_TYPE in ['ETE']:
-                    e, inter = encoder_model.forward_encoder(inputs_data,
-                                                      dataset.extract_inputs(data).cuda(),
-                                                      torch.squeeze(
-                                                          dataset.extract_commands(data).cuda()))
+                if dataset.embedding_cache is not None:
+                    inputs_data = None
+                    e = data['embedding'].to(device)
+                else:
+                    if g_conf.LABELS_SUPERVISED:
+                        inputs_data = torch.cat((data['rgb'],
+                                                 torch.zeros(g_conf.BATCH_SIZE, 1, 88, 200)), dim=1).to(device)
+                    else:
+                        inputs_data = torch.squeeze(data['rgb'].to(device))
+                    encoder_inputs = encoder_inputs.to(device)
+                    # We also add measurements and commands
+                    encoder_commands = torch.squeeze(encoder_commands.to(device))
+                classification_gt = classification_gt.to(device)
+                regression_gt = regression_gt.to(device)
+                profiler.toc('h2d')
+
+                if dataset.embedding_cache is None:
+                    e, inter = encoder_model.forward_encoder(inputs_data, encoder_inputs, encoder_commands)
+                profiler.toc('forward')
 
                 loss_function_params = {
-                    'classification_gt': dataset.extract_affordances_targets(data, 'classification').cuda(),
+                    'classification_gt': classification_gt,
                 # harzard stop, red_light....
                     'class_weights': g_conf.AFFORDANCES_CLASS_WEIGHT,
-                    'regression_gt': dataset.extract_affordances_targets(data, 'regression').cuda(),
+                    'regression_gt': regression_gt,
                     'variable_weights': g_conf.AFFORDANCES_VARIABLE_WEIGHT
                 }
-                loss = model(e, loss_function_params)
+                # The affordance heads are run together with their losses
+                loss = head_model(e, loss_function_params)
+                profiler.toc('loss')
                 loss.backward()
+                if not g_conf.FREEZE_ENCODER:
+                    average_gradients(encoder_model.parameters())
+                profiler.toc('backward')
                 optimizer.step()
+                profiler.toc('optimizer')
 
             else:
                 raise RuntimeError(
@@ -248,7 +313,7 @@ def execute(gpu, exp_batch, exp_alias, suppress_output=True, number_of_workers=1
                 ####################################
             """
 
-            if is_ready_to_save(iteration):
+            if is_ready_to_save(iteration) and is_main_process():
 
                 state = {
                     'iteration': iteration,
@@ -258,9 +323,7 @@ def execute(gpu, exp_batch, exp_alias, suppress_output=True, number_of_workers=1
                     'optimizer': optimizer.state_dict(),
                     'best_loss_iter': best_loss_iter
                 }
-                torch.save(state, os.path.join('_logs', g_conf.EXPERIMENT_BATCH_NAME, g_conf.EXPERIMENT_NAME
-                                               , 'checkpoints', str(iteration) + '.pth'))
-
+                encoder_state = None
                 if not g_conf.FREEZE_ENCODER:
                     encoder_state = {
                         'iteration': iteration,
@@ -270,9 +333,10 @@ def execute(gpu, exp_batch, exp_alias, suppress_output=True, number_of_workers=1
                         'optimizer': optimizer.state_dict(),
                         'best_loss_iter': best_loss_iter
                     }
-                    torch.save(encoder_state, os.path.join('_logs', g_conf.EXPERIMENT_BATCH_NAME, g_conf.EXPERIMENT_NAME
-                                                   , 'checkpoints', str(iteration) + '_encoder.pth'))
+                save_checkpoint(os.path.join('_logs', g_conf.EXPERIMENT_BATCH_NAME, g_conf.EXPERIMENT_NAME,
+                                             'checkpoints'), iteration, state, encoder_state)
 
+            profiler.toc('checkpoint')
             iteration += 1
 
             """
@@ -283,7 +347,8 @@ def execute(gpu, exp_batch, exp_alias, suppress_output=True, number_of_workers=1
                 #################################################
             """
             coil_logger.add_scalar('Loss', loss.data, iteration)
-            coil_logger.add_image('Image', torch.squeeze(data['rgb']), iteration)
+            if inputs_data is not None:
+                coil_logger.add_image('Image', torch.squeeze(data['rgb']), iteration)
 
 
             if loss.data < best_loss:
@@ -296,7 +361,12 @@ def execute(gpu, exp_batch, exp_alias, suppress_output=True, number_of_workers=1
                     iteration, iteration, g_conf.NUMBER_ITERATIONS,
                     100. * iteration / g_conf.NUMBER_ITERATIONS, loss.data))
 
+            profiler.toc('logging')
+            profiler.end_iteration(iteration, g_conf.BATCH_SIZE)
+
+        profiler.finish()
         coil_logger.add_message('Finished', {})
+        cleanup()
 
     except KeyboardInterrupt:
         coil_logger.add_message('Error', {'Message': 'Killed By User'})
@@ -0,0 +1,306 @@
+import os
+import sys
+import time
+import random
+import traceback
+
+import numpy as np
+import torch
+import torch.optim as optim
+import yaml
+
+from configs import g_conf, set_type_of_process, merge_with_yaml
+from network import CoILModel, EncoderModel, adjust_learning_rate_auto
+from network.loss import distillation
+from network.inference import set_intermediate_outputs
+from input import CoILDataset, Augmenter, select_balancing_strategy
+from logger import coil_logger
+from logger.profiler import StageProfiler
+from coilutils.checkpoint_schedule import is_ready_to_save, get_latest_saved_checkpoint, save_checkpoint
+
+
+def seed_everything(seed=0):
+    random.seed(seed)
+    torch.manual_seed(seed)
+    torch.cuda.manual_seed_all(seed)
+    np.random.seed(seed)
+    os.environ['PYTHONHASHSEED'] = str(seed)
+    torch.backends.cudnn.deterministic = True
+
+
+def teacher_experiment_name(teacher):
+    """ The name of the logs folder of the teacher, named after its encoder checkpoint as train does. """
+    return teacher['exp'] + '_' + str(teacher['encoder_checkpoint'])
+
+
+def load_teacher(teacher, map_location=None):
+    """
+        Load the encoder and the affordance heads of a trained separate-affordances experiment.
+        Its models are built from its own yaml, only the encoder type has to be the one of the
+        current configuration.
+
+    Args:
+        teacher: the DISTILL_TEACHER configuration
+        map_location: where the checkpoints are loaded
+
+    Returns:
+        The teacher encoder model and heads model, frozen and on evaluation mode
+
+    """
+    for key in ['folder', 'exp', 'checkpoint', 'encoder_folder', 'encoder_exp', 'encoder_checkpoint']:
+        if key not in teacher:
+            raise ValueError("Missing the %s of the DISTILL_TEACHER" % key)
+
+    with open(os.path.join('configs', teacher['folder'], teacher['exp'] + '.yaml'), 'r') as f:
+        teacher_conf = yaml.load(f)
+    if teacher_conf['MODEL_TYPE'] not in ['separate-affordances']:
+        raise ValueError("The teacher should be a separate-affordances experiment")
+    # The heads are built after the global encoder type
+    if teacher_conf['ENCODER_MODEL_TYPE'] != g_conf.ENCODER_MODEL_TYPE:
+        raise ValueError("The student and the teacher should have the same ENCODER_MODEL_TYPE")
+
+    checkpoints_path = os.path.join('_logs', teacher['folder'], teacher_experiment_name(teacher), 'checkpoints')
+    teacher_model = CoILModel(teacher_conf['MODEL_TYPE'], teacher_conf['MODEL_CONFIGURATION'],
+                              teacher_conf['ENCODER_MODEL_CONFIGURATION'])
+    teacher_model.load_state_dict(torch.load(os.path.join(checkpoints_path, str(teacher['checkpoint']) + '.pth'),
+                                             map_location=map_location)['state_dict'])
+
+    teacher_encoder = EncoderModel(teacher_conf['ENCODER_MODEL_TYPE'], teacher_conf['ENCODER_MODEL_CONFIGURATION'])
+    if teacher_conf.get('FREEZE_ENCODER', False):
+        encoder_checkpoint_path = os.path.join('_logs', teacher['encoder_folder'], teacher['encoder_exp'],
+                                               'checkpoints', str(teacher['encoder_checkpoint']) + '.pth')
+    else:
+        encoder_checkpoint_path = os.path.join(checkpoints_path, str(teacher['checkpoint']) + '_encoder.pth')
+    teacher_encoder.load_state_dict(torch.load(encoder_checkpoint_path, map_location=map_location)['state_dict'])
+    print("Teacher loaded from ", checkpoints_path, " and ", encoder_checkpoint_path)
+
+    for model in [teacher_encoder, teacher_model]:
+        model.eval()
+        for param_ in model.parameters():
+            param_.requires_grad = False
+
+    return teacher_encoder, teacher_model
+
+
+def execute(gpu, exp_batch, exp_alias, suppress_output=True, number_of_workers=12):
+    """
+        Distill a trained separate-affordances experiment (the teacher, set on DISTILL_TEACHER)
+        into the smaller encoder of this experiment (the student). The student learns to
+        reproduce the teacher embeddings and, through the frozen teacher heads, its affordance
+        outputs.
+
+        The checkpoints are the ones of a separate-affordances experiment with a fine tuned
+        encoder: the heads on <iteration>.pth and the student on <iteration>_encoder.pth, so
+        the experiment is validated and driven as any other one.
+    Args:
+        gpu: The GPU number
+        exp_batch: the folder with the experiments
+        exp_alias: the alias, experiment name
+        suppress_output: if the output are going to be saved on a file
+        number_of_workers: the number of threads used for data loading
+
+    Returns:
+        None
+
+    """
+    try:
+        # We set the visible cuda devices to select the GPU
+        os.environ["CUDA_VISIBLE_DEVICES"] = gpu
+        g_conf.VARIABLE_WEIGHT = {}
+        # At this point the log file with the correct naming is created.
+        # You merge the yaml file with the global configuration structure.
+        merge_with_yaml(os.path.join('configs', exp_batch, exp_alias + '.yaml'))
+        if g_conf.MODEL_TYPE not in ['separate-affordances']:
+            raise ValueError("The distillation experiments are separate-affordances experiments")
+        if g_conf.FREEZE_ENCODER:
+            raise ValueError("The student is trained, the distillation experiments need FREEZE_ENCODER: False")
+        set_type_of_process('train_distill')
+        # Set the process into loading status.
+        coil_logger.add_message('Loading', {'GPU': os.environ["CUDA_VISIBLE_DEVICES"]})
+
+        seed_everything(seed=g_conf.MAGICAL_SEED)
+
+        # Put the output to a separate file if it is the case
+        if suppress_output:
+            if not os.path.exists('_output_logs'):
+                os.mkdir('_output_logs')
+            sys.stdout = open(os.path.join('_output_logs', exp_alias + '_' +
+                                           g_conf.PROCESS_NAME + '_' + str(os.getpid()) + ".out"), "a",
+                              buffering=1)
+            sys.stderr = open(os.path.join('_output_logs',
+                                           exp_alias + '_err_' + g_conf.PROCESS_NAME + '_'
+                                           + str(os.getpid()) + ".out"),
+                              "a", buffering=1)
+
+        # Get the latest checkpoint to be loaded
+        # returns none if there are no checkpoints saved for this model
+        checkpoint_file = get_latest_saved_checkpoint()
+        if checkpoint_file is not None:
+            print('loading previous checkpoint ', checkpoint_file)
+            checkpoint = torch.load(os.path.join('_logs', exp_batch, exp_alias, 'checkpoints', checkpoint_file))
+            iteration = checkpoint['iteration']
+            best_loss = checkpoint['best_loss']
+            best_loss_iter = checkpoint['best_loss_iter']
+        else:
+            iteration = 0
+            best_loss = 1000000000.0
+            best_loss_iter = 0
+
+        augmenter = Augmenter(g_conf.AUGMENTATION)
+
+        if len(g_conf.EXPERIENCE_FILE) == 1:
+            json_file_name = str(g_conf.EXPERIENCE_FILE[0]).split('/')[-1].split('.')[-2]
+        else:
+            json_file_name = str(g_conf.EXPERIENCE_FILE[0]).split('/')[-1].split('.')[-2] + '_' + str(g_conf.EXPERIENCE_FILE[1]).split('/')[-1].split('.')[-2]
+        dataset = CoILDataset(transform=augmenter,
+                              preload_name=g_conf.PROCESS_NAME + '_' + json_file_name + '_' + g_conf.DATA_USED)
+        print ("Loaded dataset")
+
+        data_loader = select_balancing_strategy(dataset, iteration, number_of_workers)
+
+        teacher_encoder, teacher_model = load_teacher(g_conf.DISTILL_TEACHER)
+        teacher_encoder.cuda()
+        teacher_model.cuda()
+        # The feature maps of the teacher are not used
+        set_intermediate_outputs(teacher_encoder, [])
+
+        student_model = EncoderModel(g_conf.ENCODER_MODEL_TYPE, g_conf.ENCODER_MODEL_CONFIGURATION)
+        student_model.cuda()
+        student_model.train()
+
+        print(student_model)
+        print("Teacher parameters: %d, student parameters: %d" %
+              (sum(p.numel() for p in teacher_encoder.parameters()),
+               sum(p.numel() for p in student_model.parameters())))
+
+        optimizer = optim.Adam(student_model.parameters(), lr=g_conf.LEARNING_RATE)
+
+        if checkpoint_file is not None:
+            student_checkpoint = torch.load(os.path.join('_logs', exp_batch, exp_alias, 'checkpoints',
+                                                         str(iteration) + '_encoder.pth'))
+            student_model.load_state_dict(student_checkpoint['state_dict'])
+            optimizer.load_state_dict(student_checkpoint['optimizer'])
+            accumulated_time = student_checkpoint['total_time']
+            loss_window = coil_logger.recover_loss_window('train', iteration)
+        else:  # We accumulate iteration time and keep the average speed
+            accumulated_time = 0
+            loss_window = []
+
+        profiler = StageProfiler(g_conf.PROFILE_STAGES, g_conf.PROFILE_LOG_FREQUENCY)
+        profiler.start()
+        for data in data_loader:
+            profiler.toc('data_wait')
+            if iteration % 1000 == 0:
+                adjust_learning_rate_auto(optimizer, loss_window)
+
+            capture_time = time.time()
+            student_model.zero_grad()
+
+            inputs_data = torch.squeeze(data['rgb'].cuda())
+            profiler.toc('h2d')
+            encoder_inputs = dataset.extract_inputs(data).cuda()
+            encoder_commands = torch.squeeze(dataset.extract_commands(data).cuda())
+            profiler.toc('extract')
+
+            with torch.no_grad():
+                teacher_embedding, _ = teacher_encoder.forward_encoder(inputs_data, encoder_inputs, encoder_commands)
+                teacher_classification, teacher_regression = teacher_model.forward_test(teacher_embedding)
+            student_embedding, _ = student_model.forward_encoder(inputs_data, encoder_inputs, encoder_commands)
+            if student_embedding.shape != teacher_embedding.shape:
+                raise ValueError("The student embedding should have the size of the teacher one, %s != %s"
+                                 % (str(tuple(student_embedding.shape)), str(tuple(teacher_embedding.shape))))
+            # The gradients go through the frozen teacher heads to the student
+            student_classification, student_regression = teacher_model.forward_test(student_embedding)
+            profiler.toc('forward')
+
+            loss, plotable_params = distillation({
+                'student_embedding': student_embedding,
+                'teacher_embedding': teacher_embedding,
+                'student_classification': student_classification,
+                'teacher_classification': teacher_classification,
+                'student_regression': student_regression,
+                'teacher_regression': teacher_regression,
+                'temperature': g_conf.DISTILL_TEMPERATURE,
+                'weights': g_conf.DISTILL_LOSS_WEIGHTS
+            })
+            profiler.toc('loss')
+            loss.backward()
+            profiler.toc('backward')
+            optimizer.step()
+            profiler.toc('optimizer')
+
+            """
+                ####################################
+                    Saving the model if necessary
+                ####################################
+            """
+
+            if is_ready_to_save(iteration):
+                state = {
+                    'iteration': iteration,
+                    'state_dict': teacher_model.state_dict(),
+                    'best_loss': best_loss,
+                    'total_time': accumulated_time,
+                    'best_loss_iter': best_loss_iter
+                }
+                student_state = {
+                    'iteration': iteration,
+                    'state_dict': student_model.state_dict(),
+                    'best_loss': best_loss,
+                    'total_time': accumulated_time,
+                    'optimizer': optimizer.state_dict(),
+                    'best_loss_iter': best_loss_iter
+                }
+                save_checkpoint(os.path.join('_logs', exp_batch, exp_alias, 'checkpoints'), iteration,
+                                state, student_state)
+
+            profiler.toc('checkpoint')
+            iteration += 1
+
+            """
+                ################################################
+                    Adding tensorboard logs.
+                    Making calculations for logging purposes.
+                    These logs are monitored by the printer module.
+                #################################################
+            """
+            coil_logger.add_scalar('Loss', loss.data, iteration)
+            for name, value in plotable_params.items():
+                coil_logger.add_scalar(name, float(value), iteration)
+            coil_logger.add_image('Image', torch.squeeze(data['rgb']), iteration)
+
+            if loss.data < best_loss:
+                best_loss = loss.data.tolist()
+                best_loss_iter = iteration
+
+            accumulated_time += time.time() - capture_time
+            coil_logger.add_message('Iterating',
+                                    {'Iteration': iteration,
+                                     'Loss': loss.data.tolist(),
+                                     'Images/s': (iteration * g_conf.BATCH_SIZE) / accumulated_time,
+                                     'BestLoss': best_loss, 'BestLossIteration': best_loss_iter},
+                                    iteration)
+            loss_window.append(loss.data.tolist())
+            coil_logger.write_on_error_csv('train', loss.data)
+
+            if iteration % 100 == 0:
+                print('Train Iteration: {} [{}/{} ({:.0f}%)] \t Loss: {:.6f}'.format(
+                    iteration, iteration, g_conf.NUMBER_ITERATIONS,
+                    100. * iteration / g_conf.NUMBER_ITERATIONS, loss.data))
+
+            profiler.toc('logging')
+            profiler.end_iteration(iteration, g_conf.BATCH_SIZE)
+
+        profiler.finish()
+        coil_logger.add_message('Finished', {})
+
+    except KeyboardInterrupt:
+        coil_logger.add_message('Error', {'Message': 'Killed By User'})
+
+    except RuntimeError as e:
+
+        coil_logger.add_message('Error', {'Message': str(e)})
+
+    except:
+        traceback.print_exc()
+        coil_logger.add_message('Error', {'Message': 'Something Happened'})
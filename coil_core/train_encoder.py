@@ -11,7 +11,10 @@ from configs import g_conf, set_type_of_process, merge_with_yaml
 from network import Loss, adjust_learning_rate_auto, EncoderModel
 from input import CoILDataset, Augmenter, select_balancing_strategy
 from logger import coil_logger
-from coilutils.checkpoint_schedule import is_ready_to_save, get_latest_saved_checkpoint
+from logger.profiler import StageProfiler
+from coilutils.checkpoint_schedule import is_ready_to_save, get_latest_saved_checkpoint, save_checkpoint
+from coilutils.distributed import init_distributed, cleanup, is_main_process, get_rank, get_world_size, \
+    barrier, broadcast_learning_rate, data_parallel, select_device
 
 
 
@@ -25,28 +28,42 @@ def seed_everything(seed=0):
     torch.backends.cudnn.deterministic = True
 
 
-def execute(gpu, exp_batch, exp_alias, suppress_output=True, number_of_workers=12):
+def execute(gpu, exp_batch, exp_alias, suppress_output=True, number_of_workers=12,
+            rank=0, world_size=1, dist_url=None):
     """
         The main encoder training function.
     Args:
-        gpu: The GPU id number
+        gpu: The GPU id number, or 'cpu' to train on the CPU
         exp_batch: the folder with the experiments
         exp_alias: the alias, experiment name
         suppress_output: if the output are going to be saved on a file
         number_of_workers: the number of threads used for data loading
+        rank: the rank of this process on a data parallel run
+        world_size: the number of processes of a data parallel run, 1 to train on a single process
+        dist_url: the rendezvous address of the data parallel run
     Returns:
         None
     """
     try:
-        # We set the visible cuda devices to select the GPU
-        os.environ["CUDA_VISIBLE_DEVICES"] = gpu
+        device = select_device(gpu, world_size)
+        if world_size > 1:
+            init_distributed(rank, world_size, dist_url)
+            # Only the first process writes logs and checkpoints
+            if not is_main_process():
+                coil_logger.mute()
         g_conf.VARIABLE_WEIGHT = {}
         # At this point the log file with the correct naming is created.
         # You merge the yaml file with the global configuration structure.
         merge_with_yaml(os.path.join('configs', exp_batch, exp_alias + '.yaml'))
+        if world_size > 1:
+            # The configured batch is split among the processes, g_conf.BATCH_SIZE is
+            # from now on the batch of a single process.
+            if g_conf.BATCH_SIZE % world_size != 0:
+                raise ValueError("The batch size should be divisible by the number of processes")
+            g_conf.BATCH_SIZE = g_conf.BATCH_SIZE // world_size
         set_type_of_process('train_encoder')
         # Set the process into loading status.
-        coil_logger.add_message('Loading', {'GPU': os.environ["CUDA_VISIBLE_DEVICES"]})
+        coil_logger.add_message('Loading', {'GPU': gpu})
 
         # we set a seed for this exp
         seed_everything(seed=g_conf.MAGICAL_SEED)
@@ -68,14 +85,14 @@ def execute(gpu, exp_batch, exp_alias, suppress_output=True, number_of_workers=1
             checkpoint = torch.load(os.path.join('_logs', g_conf.PRELOAD_MODEL_BATCH,
                                                  g_conf.PRELOAD_MODEL_ALIAS,
                                                  'checkpoints',
-                                                 str(g_conf.PRELOAD_MODEL_CHECKPOINT) + '.pth'))
+                                                 str(g_conf.PRELOAD_MODEL_CHECKPOINT) + '.pth'), map_location=device)
 
         # Get the latest checkpoint to be loaded
         # returns none if there are no checkpoints saved for this model
         checkpoint_file = get_latest_saved_checkpoint()
         if checkpoint_file is not None:
             checkpoint = torch.load(os.path.join('_logs', exp_batch, exp_alias,
-                                                 'checkpoints', str(get_latest_saved_checkpoint())))
+                                                 'checkpoints', str(get_latest_saved_checkpoint())), map_location=device)
             iteration = checkpoint['iteration']
             best_loss = checkpoint['best_loss']
             best_loss_iter = checkpoint['best_loss_iter']
@@ -97,15 +114,21 @@ def execute(gpu, exp_batch, exp_alias, suppress_output=True, number_of_workers=1
         else:
             json_file_name = str(g_conf.EXPERIENCE_FILE[0]).split('/')[-1].split('.')[-2] + '_' + str(g_conf.EXPERIENCE_FILE[1]).split('/')[-1].split('.')[-2]
 
+        # The first process writes the preload file that the others read
+        if not is_main_process():
+            barrier()
         dataset = CoILDataset(transform=augmenter,
                               preload_name=g_conf.PROCESS_NAME + '_' + json_file_name + '_' + g_conf.DATA_USED)
+        if is_main_process():
+            barrier()
 
         print ("Loaded dataset")
 
-        data_loader = select_balancing_strategy(dataset, iteration, number_of_workers)
+        data_loader = select_balancing_strategy(dataset, iteration, number_of_workers,
+                                                get_rank(), get_world_size())
 
         encoder_model = EncoderModel(g_conf.ENCODER_MODEL_TYPE, g_conf.ENCODER_MODEL_CONFIGURATION)
-        encoder_model.cuda()
+        encoder_model.to(device)
         encoder_model.train()
 
         print(encoder_model)
@@ -121,15 +144,22 @@ def execute(gpu, exp_batch, exp_alias, suppress_output=True, number_of_workers=1
             accumulated_time = 0
             loss_window = []
 
+        # On a data parallel run the forward goes through the wrapper that syncs the gradients
+        train_model = data_parallel(encoder_model)
+
         print ("Before the loss")
 
         if g_conf.ENCODER_MODEL_TYPE in ['ETE']:
             criterion = Loss(g_conf.LOSS_FUNCTION)
 
+        profiler = StageProfiler(g_conf.PROFILE_STAGES, g_conf.PROFILE_LOG_FREQUENCY)
+        profiler.start()
         # Loss time series window
         for data in data_loader:
+            profiler.toc('data_wait')
             if iteration % 1000 == 0:
                 adjust_learning_rate_auto(optimizer, loss_window)
+                broadcast_learning_rate(optimizer)
 
             capture_time = time.time()
             encoder_model.zero_grad()
@@ -148,20 +178,24 @@ def execute(gpu, exp_batch, exp_alias, suppress_output=True, number_of_workers=1
             """
 
             if g_conf.ENCODER_MODEL_TYPE in ['one-step-affordances']:
+                inputs_data = torch.squeeze(data['rgb'].to(device))
+                profiler.toc('h2d')
                 loss_function_params = {
-                    'classification_gt': dataset.extract_affordances_targets(data, 'classification').cuda(),
+                    'classification_gt': dataset.extract_affordances_targets(data, 'classification').to(device),
                 # harzard stop, red_light....
                     'class_weights': g_conf.AFFORDANCES_CLASS_WEIGHT,
-                    'regression_gt': dataset.extract_affordances_targets(data, 'regression').cuda(),
+                    'regression_gt': dataset.extract_affordances_targets(data, 'regression').to(device),
                     'variable_weights': g_conf.AFFORDANCES_VARIABLE_WEIGHT
                 }
+                encoder_inputs = dataset.extract_inputs(data).to(device)
+                encoder_commands = torch.squeeze(dataset.extract_commands(data).to(device))
+                profiler.toc('extract')
                 # we input RGB images, speed and command to train affordances
-                loss = encoder_model(torch.squeeze(data['rgb'].cuda()),
-                                     dataset.extract_inputs(data).cuda(),
-                                     torch.squeeze(dataset.extract_commands(data).cuda()),
-                                     loss_function_params)
+                loss = train_model(inputs_data, encoder_inputs, encoder_commands,
+                                   loss_function_params)
+                profiler.toc('forward')
 
-                if iteration == 0:
+                if iteration == 0 and is_main_process():
                     state = {
                         'iteration': iteration,
                         'state_dict': encoder_model.state_dict(),
@@ -172,61 +206,88 @@ def execute(gpu, exp_batch, exp_alias, suppress_output=True, number_of_workers=1
                     }
                     torch.save(state, os.path.join('_logs', exp_batch, exp_alias
                                                    , 'checkpoints', 'inital.pth'))
+                    profiler.toc('checkpoint')
 
                 loss.backward()
+                profiler.toc('backward')
                 optimizer.step()
+                profiler.toc('optimizer')
 
             elif g_conf.ENCODER_MODEL_TYPE in ['forward']:
                 # We sample another batch to avoid the superposition
 
-                inputs_data = [data['rgb'][0].cuda(), data['rgb'][1].cuda()]
-                loss, loss_other, loss_ete = encoder_model(inputs_data,
-                                           dataset.extract_inputs(data),
-                                           # We also add measurements and commands
-                                           dataset.extract_commands(data),
-                                           dataset.extract_targets(data)[0].cuda()
-                                           )
+                inputs_data = [data['rgb'][0].to(device), data['rgb'][1].to(device)]
+                profiler.toc('h2d')
+                encoder_inputs = dataset.extract_inputs(data)
+                # We also add measurements and commands
+                encoder_commands = dataset.extract_commands(data)
+                targets = dataset.extract_targets(data)[0].to(device)
+                profiler.toc('extract')
+                # The losses are computed inside the model forward
+                loss, loss_other, loss_ete = train_model(inputs_data, encoder_inputs,
+                                                         encoder_commands, targets)
+                profiler.toc('forward')
                 loss.backward()
+                profiler.toc('backward')
                 optimizer.step()
+                profiler.toc('optimizer')
 
 
             elif g_conf.ENCODER_MODEL_TYPE in ['ETE']:
-                branches = encoder_model(torch.squeeze(data['rgb'].cuda()),
-                                         dataset.extract_inputs(data).cuda(),
-                                         torch.squeeze(dataset.extract_commands(data).cuda()))
+                inputs_data = torch.squeeze(data['rgb'].to(device))
+                profiler.toc('h2d')
+                encoder_inputs = dataset.extract_inputs(data).to(device)
+                encoder_commands = torch.squeeze(dataset.extract_commands(data).to(device))
+                targets = dataset.extract_targets(data).to(device)
+                profiler.toc('extract')
+                branches = train_model(inputs_data, encoder_inputs, encoder_commands)
+                profiler.toc('forward')
 
                 loss_function_params = {
                     'branches': branches,
-                    'targets': dataset.extract_targets(data).cuda(),  # steer, throttle, brake
-                    'inputs': dataset.extract_inputs(data).cuda(),  # speed
+                    'targets': targets,  # steer, throttle, brake
+                    'inputs': encoder_inputs,  # speed
                     'branch_weights': g_conf.BRANCH_LOSS_WEIGHT,
                     'variable_weights': g_conf.VARIABLE_WEIGHT
                 }
 
                 loss, _ = criterion(loss_function_params)
+                profiler.toc('loss')
                 loss.backward()
+                profiler.toc('backward')
                 optimizer.step()
+                profiler.toc('optimizer')
 
             elif g_conf.ENCODER_MODEL_TYPE in ['stdim']:
-                inputs_data = [data['rgb'][0].cuda(), data['rgb'][1].cuda()]
-                loss, _, _ = encoder_model(inputs_data,
-                                           dataset.extract_inputs(data),
-                                           # We also add measurements and commands
-                                           dataset.extract_commands(data)
-                                           )
+                inputs_data = [data['rgb'][0].to(device), data['rgb'][1].to(device)]
+                profiler.toc('h2d')
+                encoder_inputs = dataset.extract_inputs(data)
+                # We also add measurements and commands
+                encoder_commands = dataset.extract_commands(data)
+                profiler.toc('extract')
+                # The losses are computed inside the model forward
+                loss, _, _ = train_model(inputs_data, encoder_inputs, encoder_commands)
+                profiler.toc('forward')
                 loss.backward()
+                profiler.toc('backward')
                 optimizer.step()
+                profiler.toc('optimizer')
 
             elif g_conf.ENCODER_MODEL_TYPE in ['action_prediction']:
-                inputs_data = [data['rgb'][0].cuda(), data['rgb'][1].cuda()]
-                loss, _, _ = encoder_model(inputs_data,
-                                           dataset.extract_inputs(data),
-                                           # We also add measurements and commands
-                                           dataset.extract_commands(data),
-                                           dataset.extract_targets(data)[0].cuda()
-                                           )
+                inputs_data = [data['rgb'][0].to(device), data['rgb'][1].to(device)]
+                profiler.toc('h2d')
+                encoder_inputs = dataset.extract_inputs(data)
+                # We also add measurements and commands
+                encoder_commands = dataset.extract_commands(data)
+                targets = dataset.extract_targets(data)[0].to(device)
+                profiler.toc('extract')
+                # The losses are computed inside the model forward
+                loss, _, _ = train_model(inputs_data, encoder_inputs, encoder_commands, targets)
+                profiler.toc('forward')
                 loss.backward()
+                profiler.toc('backward')
                 optimizer.step()
+                profiler.toc('optimizer')
 
             else:
                 raise ValueError("The encoder model type is not know")
@@ -237,7 +298,7 @@ def execute(gpu, exp_batch, exp_alias, suppress_output=True, number_of_workers=1
                 ####################################
             """
 
-            if is_ready_to_save(iteration):
+            if is_ready_to_save(iteration) and is_main_process():
                 state = {
                     'iteration': iteration,
                     'state_dict': encoder_model.state_dict(),
@@ -246,9 +307,9 @@ def execute(gpu, exp_batch, exp_alias, suppress_output=True, number_of_workers=1
                     'optimizer': optimizer.state_dict(),
                     'best_loss_iter': best_loss_iter
                 }
-                torch.save(state, os.path.join('_logs', exp_batch, exp_alias
-                                               , 'checkpoints', str(iteration) + '.pth'))
+                save_checkpoint(os.path.join('_logs', exp_batch, exp_alias, 'checkpoints'), iteration, state)
 
+            profiler.toc('checkpoint')
             iteration += 1
 
             """
@@ -276,7 +337,7 @@ def execute(gpu, exp_batch, exp_alias, suppress_output=True, number_of_workers=1
             coil_logger.add_message('Iterating',
                                     {'Iteration': iteration,
                                      'Loss': loss.data.tolist(),
-                                     'Images/s': (iteration * g_conf.BATCH_SIZE) / accumulated_time,
+                                     'Images/s': (iteration * g_conf.BATCH_SIZE * get_world_size()) / accumulated_time,
                                      'BestLoss': best_loss, 'BestLossIteration': best_loss_iter},
                                     iteration)
             loss_window.append(loss.data.tolist())
@@ -287,7 +348,12 @@ def execute(gpu, exp_batch, exp_alias, suppress_output=True, number_of_workers=1
                     iteration, iteration, g_conf.NUMBER_ITERATIONS,
                     100. * iteration / g_conf.NUMBER_ITERATIONS, loss.data))
 
+            profiler.toc('logging')
+            profiler.end_iteration(iteration, g_conf.BATCH_SIZE)
+
+        profiler.finish()
         coil_logger.add_message('Finished', {})
+        cleanup()
 
     except KeyboardInterrupt:
         coil_logger.add_message('Error', {'Message': 'Killed By User'})
@@ -0,0 +1,371 @@
+import os
+import sys
+import copy
+import time
+import traceback
+import torch
+import torch.optim as optim
+
+from configs import g_conf, set_type_of_process, merge_with_yaml
+from network import CoILModel, adjust_learning_rate_auto, EncoderModel
+from input import CoILDataset, Augmenter, select_balancing_strategy, EmbeddingCache, checkpoint_hash
+from logger import coil_logger
+from coilutils.checkpoint_schedule import is_ready_to_save, get_latest_saved_checkpoint, \
+                                    check_loss_validation_stopped, save_checkpoint
+
+from .train import seed_everything
+
+
+# The configuration keys that define the data stream and the encoder. Experiments trained
+# together have to agree on all of them, they may differ on everything else (head, losses,
+# learning rate, schedules ...)
+SHARED_KEYS = ['EXPERIENCE_FILE', 'DATA_USED', 'BATCH_SIZE', 'SPLIT', 'REMOVE', 'AUGMENTATION',
+               'SENSORS', 'INPUTS', 'COMMANDS', 'TARGETS', 'AFFORDANCES_TARGETS',
+               'NUMBER_IMAGES_SEQUENCE', 'LABELS_SUPERVISED', 'SPEED_FACTOR',
+               'AUGMENT_LATERAL_STEERINGS', 'AUGMENT_RELATIVE_ANGLE', 'AUGMENT_RA_CLIP',
+               'MODEL_TYPE', 'ENCODER_MODEL_TYPE', 'ENCODER_MODEL_CONFIGURATION',
+               'FREEZE_ENCODER', 'ENCODER_EMBEDDING_CACHE']
+
+
+def _activate(experiment):
+    """
+        Point the global configuration and the logger to the given experiment.
+    """
+    g_conf.clear()
+    g_conf.update(experiment['conf'])
+    coil_logger.set_log_state(experiment['log_state'])
+
+
+def _add_message_to_all(experiments, phase, message):
+    for experiment in experiments:
+        _activate(experiment)
+        coil_logger.add_message(phase, message)
+
+
+def _load_experiment(exp_batch, exp_alias, encoder_params, default_conf):
+    """
+        Merge the experiment yaml on top of the default configuration and create its logs.
+        Returns the dictionary that keeps the state of this experiment.
+    """
+    g_conf.immutable(False)
+    g_conf.clear()
+    g_conf.update(copy.deepcopy(default_conf))
+    g_conf.VARIABLE_WEIGHT = {}
+    merge_with_yaml(os.path.join('configs', exp_batch, exp_alias + '.yaml'), encoder_params)
+    set_type_of_process('train')
+    coil_logger.add_message('Loading', {'GPU': os.environ["CUDA_VISIBLE_DEVICES"]})
+
+    return {'alias': exp_alias,
+            'conf': dict(g_conf),
+            'log_state': coil_logger.get_log_state(),
+            'finished': coil_logger.check_finish('train')}
+
+
+def _check_compatibility(experiments):
+    reference = experiments[0]
+    for experiment in experiments[1:]:
+        different_keys = [key for key in SHARED_KEYS
+                          if experiment['conf'][key] != reference['conf'][key]]
+        if different_keys:
+            raise ValueError("Experiment %s can not share the data pipeline with %s, they differ on %s"
+                             % (experiment['alias'], reference['alias'], ', '.join(different_keys)))
+
+
+def _load_encoder(encoder_params):
+    """
+        Build the encoder of the current experiment and load the pre-trained weights.
+    Returns:
+        the encoder model and the path of the checkpoint it was loaded from
+    """
+    encoder_model = EncoderModel(g_conf.ENCODER_MODEL_TYPE, g_conf.ENCODER_MODEL_CONFIGURATION)
+    encoder_model.cuda()
+    encoder_model.eval()
+    encoder_checkpoint_path = None
+    if encoder_params is not None:
+        encoder_checkpoint_path = os.path.join('_logs', encoder_params['encoder_folder'],
+                                               encoder_params['encoder_exp'], 'checkpoints',
+                                               str(encoder_params['encoder_checkpoint']) + '.pth')
+        encoder_model.load_state_dict(torch.load(encoder_checkpoint_path)['state_dict'])
+        print("Encoder model ", str(encoder_params['encoder_checkpoint']), "loaded from ",
+              encoder_checkpoint_path)
+    if g_conf.FREEZE_ENCODER:
+        for param_ in encoder_model.parameters():
+            param_.requires_grad = False
+
+    return encoder_model, encoder_checkpoint_path
+
+
+def _setup_experiment(experiment, encoder_params, shared_encoder):
+    """
+        Create the model and the optimizer of one experiment and resume it from its
+        latest checkpoint when there is one.
+    """
+    _activate(experiment)
+
+    checkpoint = None
+    iteration = 0
+    best_loss = 100000000.0
+    best_loss_iter = 0
+    if g_conf.PRELOAD_MODEL_ALIAS is not None:
+        checkpoint = torch.load(os.path.join('_logs', g_conf.PRELOAD_MODEL_BATCH,
+                                             g_conf.PRELOAD_MODEL_ALIAS,
+                                             'checkpoints',
+                                             str(g_conf.PRELOAD_MODEL_CHECKPOINT) + '.pth'))
+    else:
+        checkpoint_file = get_latest_saved_checkpoint()
+        if checkpoint_file is not None:
+            print(experiment['alias'], ' loading previous checkpoint ', checkpoint_file)
+            checkpoint = torch.load(os.path.join('_logs', g_conf.EXPERIMENT_BATCH_NAME,
+                                                 g_conf.EXPERIMENT_NAME, 'checkpoints',
+                                                 checkpoint_file))
+            iteration = checkpoint['iteration']
+            best_loss = checkpoint['best_loss']
+            best_loss_iter = checkpoint['best_loss_iter']
+
+    model = CoILModel(g_conf.MODEL_TYPE, g_conf.MODEL_CONFIGURATION, g_conf.ENCODER_MODEL_CONFIGURATION)
+    model.cuda()
+
+    if shared_encoder is not None:
+        encoder_model = shared_encoder
+        optimizer = optim.Adam(model.parameters(), lr=g_conf.LEARNING_RATE)
+    else:
+        encoder_model, _ = _load_encoder(encoder_params)
+        optimizer = optim.Adam(list(model.parameters()) + list(encoder_model.parameters()),
+                               lr=g_conf.LEARNING_RATE)
+
+    if checkpoint is not None:
+        model.load_state_dict(checkpoint['state_dict'])
+        optimizer.load_state_dict(checkpoint['optimizer'])
+        accumulated_time = checkpoint['total_time']
+        loss_window = coil_logger.recover_loss_window('train', iteration)
+    else:
+        accumulated_time = 0
+        loss_window = []
+
+    experiment.update({'model': model,
+                       'encoder_model': encoder_model,
+                       'optimizer': optimizer,
+                       'iteration': iteration,
+                       'best_loss': best_loss,
+                       'best_loss_iter': best_loss_iter,
+                       'accumulated_time': accumulated_time,
+                       'loss_window': loss_window})
+
+
+def _save_checkpoint(experiment):
+    state = {
+        'iteration': experiment['iteration'],
+        'state_dict': experiment['model'].state_dict(),
+        'best_loss': experiment['best_loss'],
+        'total_time': experiment['accumulated_time'],
+        'optimizer': experiment['optimizer'].state_dict(),
+        'best_loss_iter': experiment['best_loss_iter']
+    }
+    checkpoints_path = os.path.join('_logs', g_conf.EXPERIMENT_BATCH_NAME, g_conf.EXPERIMENT_NAME,
+                                    'checkpoints')
+    encoder_state = None
+    if not g_conf.FREEZE_ENCODER:
+        encoder_state = dict(state)
+        encoder_state['state_dict'] = experiment['encoder_model'].state_dict()
+    save_checkpoint(checkpoints_path, experiment['iteration'], state, encoder_state)
+
+
+def _train_step(experiment, data, shared_inputs):
+    """
+        One optimization step of an experiment over the shared batch.
+    Args:
+        experiment: the experiment state, it has to be the active one
+        data: the batch coming from the shared data loader
+        shared_inputs: the tensors already moved to the GPU for all experiments. The embedding
+            is also there when the encoder is shared by all of them.
+    """
+    model = experiment['model']
+    encoder_model = experiment['encoder_model']
+    optimizer = experiment['optimizer']
+
+    if experiment['iteration'] % 1000 == 0:
+        adjust_learning_rate_auto(optimizer, experiment['loss_window'])
+
+    capture_time = time.time()
+    model.zero_grad()
+    if not g_conf.FREEZE_ENCODER:
+        encoder_model.zero_grad()
+
+    if shared_inputs['embedding'] is not None:
+        e = shared_inputs['embedding']
+    else:
+        e, _ = encoder_model.forward_encoder(shared_inputs['rgb'], shared_inputs['inputs'],
+                                             shared_inputs['commands'])
+
+    loss_function_params = {
+        'classification_gt': shared_inputs['classification_gt'],
+        'class_weights': g_conf.AFFORDANCES_CLASS_WEIGHT,
+        'regression_gt': shared_inputs['regression_gt'],
+        'variable_weights': g_conf.AFFORDANCES_VARIABLE_WEIGHT
+    }
+    loss = model(e, loss_function_params)
+    loss.backward()
+    optimizer.step()
+
+    if is_ready_to_save(experiment['iteration']):
+        _save_checkpoint(experiment)
+
+    experiment['iteration'] += 1
+    iteration = experiment['iteration']
+    experiment['accumulated_time'] += time.time() - capture_time
+
+    coil_logger.add_scalar('Loss', loss.data, iteration)
+    if shared_inputs['rgb'] is not None:
+        coil_logger.add_image('Image', torch.squeeze(data['rgb']), iteration)
+
+    if loss.data < experiment['best_loss']:
+        experiment['best_loss'] = loss.data.tolist()
+        experiment['best_loss_iter'] = iteration
+
+    if iteration % 100 == 0:
+        print('{} Train Iteration: {} [{}/{} ({:.0f}%)] \t Loss: {:.6f}'.format(
+            experiment['alias'], iteration, iteration, g_conf.NUMBER_ITERATIONS,
+            100. * iteration / g_conf.NUMBER_ITERATIONS, loss.data))
+
+
+def execute(gpu, exp_batch, exp_aliases, suppress_output=True, number_of_workers=12, encoder_params=None):
+    """
+        Train several experiments of the same folder over a single data pipeline.
+        The experiments have to agree on the dataset and encoder configuration (SHARED_KEYS),
+        then one CoILDataset and one DataLoader stream feed all of them. Each experiment keeps
+        its own model, optimizer, logs and checkpoints, so they are validated and driven as if
+        they were trained separately.
+    Args:
+        gpu: The GPU number
+        exp_batch: the folder with the experiments
+        exp_aliases: the list of experiment aliases trained together
+        suppress_output: if the output are going to be saved on a file
+        number_of_workers: the number of threads used for data loading
+        encoder_params: the pre-trained encoder shared by all the experiments
+
+    Returns:
+        None
+
+    """
+    experiments = []
+    try:
+        # We set the visible cuda devices to select the GPU
+        os.environ["CUDA_VISIBLE_DEVICES"] = gpu
+        default_conf = copy.deepcopy(dict(g_conf))
+        for exp_alias in exp_aliases:
+            experiments.append(_load_experiment(exp_batch, exp_alias, encoder_params, default_conf))
+        _check_compatibility(experiments)
+
+        _activate(experiments[0])
+        seed_everything(seed=g_conf.MAGICAL_SEED)
+
+        # Put the output to a separate file if it is the case
+        if suppress_output:
+            if not os.path.exists('_output_logs'):
+                os.mkdir('_output_logs')
+            sys.stdout = open(os.path.join('_output_logs', exp_aliases[0] + '_multi_' +
+                              g_conf.PROCESS_NAME + '_' + str(os.getpid()) + ".out"), "a",
+                              buffering=1)
+            sys.stderr = open(os.path.join('_output_logs',
+                              exp_aliases[0] + '_multi_err_' + g_conf.PROCESS_NAME + '_'
+                                           + str(os.getpid()) + ".out"),
+                              "a", buffering=1)
+
+        for experiment in experiments:
+            if experiment['finished']:
+                _activate(experiment)
+                coil_logger.add_message('Finished', {})
+        experiments = [experiment for experiment in experiments if not experiment['finished']]
+        if not experiments:
+            return
+
+        _activate(experiments[0])
+        if g_conf.MODEL_TYPE not in ['separate-affordances']:
+            raise RuntimeError(
+                'Not implement yet, this mode only works for g_conf.MODEL_TYPE in [separate-affordances]')
+
+        augmenter = Augmenter(g_conf.AUGMENTATION)
+        if len(g_conf.EXPERIENCE_FILE) == 1:
+            json_file_name = str(g_conf.EXPERIENCE_FILE[0]).split('/')[-1].split('.')[-2]
+        else:
+            json_file_name = str(g_conf.EXPERIENCE_FILE[0]).split('/')[-1].split('.')[-2] + '_' + str(g_conf.EXPERIENCE_FILE[1]).split('/')[-1].split('.')[-2]
+        dataset = CoILDataset(transform=augmenter,
+                              preload_name=g_conf.PROCESS_NAME + '_' + json_file_name + '_' + g_conf.DATA_USED)
+        print("Loaded Training dataset, shared by ", len(experiments), " experiments")
+
+        # A frozen encoder is shared, its embedding is computed once per batch for all the heads.
+        shared_encoder = None
+        if g_conf.FREEZE_ENCODER:
+            shared_encoder, encoder_checkpoint_path = _load_encoder(encoder_params)
+            if g_conf.ENCODER_EMBEDDING_CACHE:
+                if encoder_params is None:
+                    raise RuntimeError("The embedding cache needs a frozen pre-trained encoder")
+                if g_conf.AUGMENTATION is not None and g_conf.AUGMENTATION != 'None':
+                    raise RuntimeError("The embedding cache can not be used with data augmentation")
+                embedding_cache = EmbeddingCache(dataset.preload_name,
+                                                 checkpoint_hash(encoder_checkpoint_path),
+                                                 len(dataset))
+                embedding_cache.fill(shared_encoder, dataset, number_of_workers)
+                dataset.embedding_cache = embedding_cache
+
+        for experiment in experiments:
+            _setup_experiment(experiment, encoder_params, shared_encoder)
+
+        # The stream is as long as the experiment with more iterations left needs
+        longest = max(experiments,
+                      key=lambda experiment: experiment['conf']['NUMBER_ITERATIONS'] - experiment['iteration'])
+        _activate(longest)
+        data_loader = select_balancing_strategy(dataset, longest['iteration'], number_of_workers)
+
+        for data in data_loader:
+            active = [experiment for experiment in experiments if not experiment['finished']]
+            if not active:
+                break
+
+            # Everything that does not depend on the experiment is moved to the GPU only once.
+            _activate(active[0])
+            shared_inputs = {
+                'rgb': None,
+                'embedding': None,
+                'classification_gt': dataset.extract_affordances_targets(data, 'classification').cuda(),
+                'regression_gt': dataset.extract_affordances_targets(data, 'regression').cuda()
+            }
+            if dataset.embedding_cache is not None:
+                shared_inputs['embedding'] = data['embedding'].cuda()
+            else:
+                if g_conf.LABELS_SUPERVISED:
+                    shared_inputs['rgb'] = torch.cat((data['rgb'],
+                                                      torch.zeros(g_conf.BATCH_SIZE, 1, 88, 200)), dim=1).cuda()
+                else:
+                    shared_inputs['rgb'] = torch.squeeze(data['rgb'].cuda())
+                shared_inputs['inputs'] = dataset.extract_inputs(data).cuda()
+                shared_inputs['commands'] = torch.squeeze(dataset.extract_commands(data).cuda())
+                if shared_encoder is not None:
+                    with torch.no_grad():
+                        shared_inputs['embedding'], _ = shared_encoder.forward_encoder(
+                            shared_inputs['rgb'], shared_inputs['inputs'], shared_inputs['commands'])
+
+            for experiment in active:
+                _activate(experiment)
+                if experiment['iteration'] >= g_conf.NUMBER_ITERATIONS or \
+                        (g_conf.FINISH_ON_VALIDATION_STALE is not None and
+                         check_loss_validation_stopped(experiment['iteration'],
+                                                       g_conf.FINISH_ON_VALIDATION_STALE)):
+                    experiment['finished'] = True
+                    coil_logger.add_message('Finished', {})
+                    continue
+
+                _train_step(experiment, data, shared_inputs)
+
+        _add_message_to_all([experiment for experiment in experiments if not experiment['finished']],
+                            'Finished', {})
+
+    except KeyboardInterrupt:
+        _add_message_to_all(experiments, 'Error', {'Message': 'Killed By User'})
+
+    except RuntimeError as e:
+        _add_message_to_all(experiments, 'Error', {'Message': str(e)})
+
+    except:
+        traceback.print_exc()
+        _add_message_to_all(experiments, 'Error', {'Message': 'Something Happened'})
@@ -1,78 +1,177 @@
 import os
 import sys
+import copy
 import torch
 import traceback
-from torchvision.utils import save_image
 from torch.nn import functional as F
 import math
 import numpy as np
-# What do we define as a parameter what not.
-import matplotlib as mpl
-mpl.use('Agg')
-import matplotlib.pyplot as plt
-import numpy as np
-import scipy
-from scipy.misc import imresize
 from configs import g_conf, set_type_of_process, merge_with_yaml
 from network import CoILModel, EncoderModel
-from input import CoILDataset, Augmenter
+from network.inference import slim_inference, AffordancesInference, onnx_runtime_model, \
+    split_affordances_outputs
+from input import CoILDataset, Augmenter, EmbeddingCache, checkpoint_hash
 from logger import coil_logger
+from logger.attention_writer import AttentionWriter
 from coilutils.checkpoint_schedule import maximun_checkpoint_reach, get_next_checkpoint, \
-    get_next_checkpoint_2, get_latest_evaluated_checkpoint_2
-
-
-
-def write_attentions(images, all_layers, iteration, folder_name, layers=None):
-
-    # Plot the attentions that are computed by the network directly here.
-    # maybe take the intermediate layers and compute the attentions  ??
-    if layers is None:
-        layers = [0, 1, 2]
-
-
-    if not os.path.exists(folder_name):
-        os.mkdir(folder_name)
-
-    # We save the images directly as a source of comparison
-    if not os.path.exists(os.path.join(folder_name, 'images')):
-        os.mkdir(os.path.join(folder_name, 'images'))
-    for i in range(images.shape[0]):
-        save_image(images[i], os.path.join(folder_name, 'images', str(iteration) + '_' + str(i) + '.png' ))
-
-
-    # We save now the attention maps for the layers
-    cmap = plt.get_cmap('inferno')
-    for layer in layers:
-
-        if not os.path.exists(os.path.join(folder_name, 'layer' + str(layer))):
-            os.mkdir(os.path.join(folder_name, 'layer' + str(layer)))
-
-        y = all_layers[layer]      #shape [120, 64, 22, 50]
-        #for i in range(y.shape[0]):
-
-        atts = torch.abs(y).mean(1).data.cpu().numpy()      #shape [120, 22, 50]
-
-        for j in range(atts.shape[0]):
-            att = atts[j]                           #shape [22, 50]
-            att = att / att.max()                   #shape [22, 50]
-            att = scipy.misc.imresize(att, [352, 800])
-            scipy.misc.imsave(os.path.join(folder_name, 'layer' + str(layer), str(iteration)+'_'+ str(j) + '.png' ), cmap(att))
-
-
+    get_next_checkpoint_2, get_next_checkpoints_2, get_latest_evaluated_checkpoint_2, next_scheduled_checkpoint
+from coilutils.checkpoint_watcher import CheckpointWatcher
+from coilutils.metrics import AffordancesMetrics, binary_counts, CLASSIFICATION_NAMES, SUMMARY_NAMES
+from coilutils.distributed import init_distributed, cleanup, is_main_process, get_rank, get_world_size, \
+    barrier, broadcast_object, select_device
 
 
 def write_regular_output(iteration, output, gt):
-    for i in range(len(output)):
-        coil_logger.write_on_csv(iteration, [output[i], gt[i]])
+    coil_logger.write_rows_on_csv(iteration, zip(output, gt))
+
+
+def shard_range(number_of_samples, batch_size, rank, world_size):
+    """
+        The contiguous samples validated by a process of a sharded validation. The shards are
+        made of whole batches, so every batch is the same as on a single process validation.
+
+    Returns:
+        The range of the samples of the shard and the index of its first batch
+    """
+    number_of_batches = (number_of_samples + batch_size - 1) // batch_size
+    first_batch = number_of_batches * rank // world_size
+    last_batch = number_of_batches * (rank + 1) // world_size
+
+    return range(first_batch * batch_size, min(last_batch * batch_size, number_of_samples)), first_batch
+
+
+# The columns of the validation summary csv
+SUMMARY_COLUMNS = ['step'] + ['accumulated_%s_%s' % (name, count) for name in SUMMARY_NAMES
+                              for count in ('TP', 'FP', 'FN', 'TN')] + ['MAE_relative_angle']
+
+
+def write_summary(summary_file, checkpoint_iteration, results):
+    """ Append the row of a validated checkpoint to the summary csv and to the metrics store. """
+    # Here also need a better analysis. TODO divide into curve and other things
+    MAE_relative_angle = results['mae'][0]
+    counts = {name: binary_counts(confusion)
+              for name, confusion in zip(CLASSIFICATION_NAMES, results['confusion'])}
+    values = sum([tuple(counts[name]) for name in SUMMARY_NAMES], ()) + (MAE_relative_angle,)
+
+    csv_outfile = open(summary_file, 'a')
+    csv_outfile.write(("%s" + ", %f" * 13) % ((checkpoint_iteration,) + values))
+    csv_outfile.write("\n")
+    csv_outfile.close()
+    coil_logger.add_metrics(checkpoint_iteration, dict(zip(SUMMARY_COLUMNS[1:], values)))
+
+
+def load_checkpoint(model, encoder_model, checkpoints_path, checkpoint_number, device):
+    """
+        Load a checkpoint of the experiment on the model, and its fine tunned encoder on the
+        encoder model when the encoder is not frozen.
+
+    Args:
+        model: the affordances model, or the one-step-affordances encoder
+        encoder_model: the encoder of the separate-affordances models, None otherwise
+        checkpoints_path: the checkpoints folder of the experiment
+        checkpoint_number: the checkpoint of the schedule
+        device: the device the models run on
+
+    Returns:
+        The iteration of the checkpoint
+    """
+    checkpoint = torch.load(os.path.join(checkpoints_path, str(checkpoint_number) + '.pth'), map_location=device)
+    model.load_state_dict(checkpoint['state_dict'])
+    print("Validation checkpoint ", checkpoint['iteration'])
+    model.eval()
+    for param_ in model.parameters():
+        param_.requires_grad = False
+
+    # Here we load the fine-tunned encoder
+    if encoder_model is not None and not g_conf.FREEZE_ENCODER:
+        encoder_checkpoint = torch.load(os.path.join(checkpoints_path, str(checkpoint_number) + '_encoder.pth'),
+                                        map_location=device)
+        print("FINE TUNNED encoder model ", str(checkpoint_number) + '_encoder.pth', "loaded from ",
+              checkpoints_path)
+        encoder_model.load_state_dict(encoder_checkpoint['state_dict'])
+        encoder_model.eval()
+        for param_ in encoder_model.parameters():
+            param_.requires_grad = False
+
+    return checkpoint['iteration']
+
+
+def validation_group_size(models, device):
+    """
+        The number of checkpoints validated together, VALIDATION_CHECKPOINT_GROUP reduced to the
+        copies of the models of a checkpoint that fit on half of the free gpu memory.
+
+    Args:
+        models: the models that are loaded for each checkpoint
+        device: the device the models run on, the group is not reduced on the CPU
+    """
+    group_size = max(g_conf.VALIDATION_CHECKPOINT_GROUP, 1)
+    if group_size > 1 and device.type == 'cuda' and hasattr(torch.cuda, 'mem_get_info'):
+        model_bytes = sum(tensor.numel() * tensor.element_size() for model in models
+                          for tensor in list(model.parameters()) + list(model.buffers()))
+        free_bytes, _ = torch.cuda.mem_get_info()
+        group_size = max(1, min(group_size, 1 + int(free_bytes // 2 // max(model_bytes, 1))))
+        if group_size < g_conf.VALIDATION_CHECKPOINT_GROUP:
+            print("Validating groups of ", group_size, " checkpoints, the gpu memory does not fit more")
+
+    return group_size
+
+
+def affordances_outputs(model, encoder_model, images, speeds, commands, embedding=None):
+    """
+        The affordances predicted by a checkpoint for a batch.
+
+    Args:
+        model: the affordances model, or the one-step-affordances encoder
+        encoder_model: the encoder of the separate-affordances models
+        embedding: the encoder embedding and feature maps of the batch, when the frozen encoder
+            was already run for all the checkpoints
+
+    Returns:
+        The classification and regression outputs, and the intermediate feature maps
+    """
+    if g_conf.MODEL_TYPE in ['one-step-affordances']:
+        return model.forward_outputs(images, speeds, commands)
+
+    if embedding is None:
+        embedding = encoder_model.forward_encoder(images, speeds, torch.squeeze(commands))
+    e, layers = embedding
+    c_output, r_output = model.forward_test(e)
+
+    return c_output, r_output, layers
 
 
 
 # The main function maybe we could call it with a default name
 def execute(gpu, exp_batch, exp_alias, json_file_path, suppress_output,
-            encoder_params = None, plot_attentions=False):
+            encoder_params = None, plot_attentions=False, rank=0, world_size=1, dist_url=None):
+    """
+        Validate the checkpoints of the TEST_SCHEDULE of an experiment as they are saved.
+    Args:
+        gpu: The GPU number, or 'cpu' to validate on the CPU
+        exp_batch: the folder with the experiments
+        exp_alias: the alias, experiment name
+        json_file_path: the json file of the validation dataset
+        suppress_output: if the output are going to be saved on a file
+        encoder_params: the pre-trained encoder folder, exp and checkpoint
+        plot_attentions: write the attention maps of the encoder
+        rank: the rank of this process on a sharded validation
+        world_size: the number of processes of a sharded validation, each one validates a
+            contiguous shard of the dataset and their metrics are summed
+        dist_url: the rendezvous address of the sharded validation
+
+    Returns:
+        None
+    """
+    # The checkpoints being validated, their output is erased if the process stops
+    unfinished = []
     try:
-        # We set the visible cuda devices
-        os.environ["CUDA_VISIBLE_DEVICES"] = gpu
+        device = select_device(gpu, world_size)
+        if world_size > 1:
+            init_distributed(rank, world_size, dist_url)
+            # Only the first process writes logs and results
+            if not is_main_process():
+                coil_logger.mute()
 
         if json_file_path is not None:
             json_file_name = json_file_path.split('/')[-1].split('.')[-2]
@@ -85,9 +184,12 @@ def execute(gpu, exp_batch, exp_alias, json_file_path, suppress_output,
             set_type_of_process('validation', json_file_name+'_plotAttention')
         else:
             set_type_of_process('validation', json_file_name)
+        # The error is written on the log of the process
+        if device.type == 'cuda' and not torch.cuda.is_available():
+            print("The gpu ", gpu, " is not available, pass cpu to validate on the CPU")
+            raise RuntimeError("The gpu %s is not available, pass cpu to validate on the CPU" % gpu)
 
-        if not os.path.exists('_output_logs'):
-            os.mkdir('_output_logs')
+        os.makedirs('_output_logs', exist_ok=True)
 
         if suppress_output:
             sys.stdout = open(os.path.join('_output_logs',
@@ -105,20 +207,17 @@ def execute(gpu, exp_batch, exp_alias, json_file_path, suppress_output,
         g_conf.immutable(False)
         g_conf.DATA_USED = 'central'
         g_conf.immutable(True)
+        if plot_attentions and g_conf.INFERENCE_BACKEND == 'onnxruntime':
+            raise ValueError("The attentions are not outputs of the ONNX graph, use the pytorch backend")
+
+        # The first process creates the summary and the preload, the others wait for them
+        if not is_main_process():
+            barrier()
         if not os.path.exists(summary_file):
             csv_outfile = open(summary_file, 'w')
-            csv_outfile.write("%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s\n"
-                              % ('step', 'accumulated_pedestrian_TP', 'accumulated_pedestrian_FP',
-                                 'accumulated_pedestrian_FN', 'accumulated_pedestrian_TN',
-                                 'accumulated_vehicle_stop_TP', 'accumulated_vehicle_stop_FP',
-                                 'accumulated_vehicle_stop_FN', 'accumulated_vehicle_stop_TN',
-                                 'accumulated_red_tl_TP', 'accumulated_red_tl_FP',
-                                 'accumulated_red_tl_FN', 'accumulated_red_tl_TN',
-                                 'MAE_relative_angle'))
+            csv_outfile.write(', '.join(SUMMARY_COLUMNS) + '\n')
             csv_outfile.close()
 
-        latest = get_latest_evaluated_checkpoint_2(summary_file)
-
         # Define the dataset. This structure is has the __get_item__ redefined in a way
         # that you can access the HDFILES positions from the root directory as a in a vector.
         #full_dataset = os.path.join(os.environ["COIL_DATASET_PATH"], dataset_name)
@@ -128,41 +227,49 @@ def execute(gpu, exp_batch, exp_alias, json_file_path, suppress_output,
                               preload_name = g_conf.PROCESS_NAME + '_' + g_conf.DATA_USED,
                               process_type='validation', vd_json_file_path = json_file_path)
         print ("Loaded Validation dataset")
+        if is_main_process():
+            barrier()
+
+        latest = get_latest_evaluated_checkpoint_2(summary_file)
 
         # Creates the sampler, this part is responsible for managing the keys. It divides
         # all keys depending on the measurements and produces a set of keys for each bach.
+        shard, first_batch = shard_range(len(dataset), g_conf.BATCH_SIZE, get_rank(), get_world_size())
+        if get_world_size() > 1:
+            print("Validating the samples ", shard.start, " to ", shard.stop, " of ", len(dataset))
 
         # The data loader is the multi threaded module from pytorch that release a number of
         # workers to get all the data.
-        data_loader = torch.utils.data.DataLoader(dataset, batch_size=g_conf.BATCH_SIZE,
+        data_loader = torch.utils.data.DataLoader(torch.utils.data.Subset(dataset, shard),
+                                                  batch_size=g_conf.BATCH_SIZE,
                                                   shuffle=False,
-                                                  num_workers=g_conf.NUMBER_OF_LOADING_WORKERS,
-                                                  pin_memory=True)
+                                                  num_workers=max(1, g_conf.NUMBER_OF_LOADING_WORKERS // world_size),
+                                                  pin_memory=device.type == 'cuda')
 
+        encoder_model = None
         if g_conf.MODEL_TYPE in ['one-step-affordances']:
             # one step training, no need to retrain FC layers, we just get the output of encoder model as prediciton
             model = EncoderModel(g_conf.ENCODER_MODEL_TYPE, g_conf.ENCODER_MODEL_CONFIGURATION)
-            model.cuda()
+            model.to(device)
             #print(model)
 
 
         elif g_conf.MODEL_TYPE in ['separate-affordances']:
             model = CoILModel(g_conf.MODEL_TYPE, g_conf.MODEL_CONFIGURATION, g_conf.ENCODER_MODEL_CONFIGURATION)
-            model.cuda()
+            model.to(device)
             #print(model)
 
             encoder_model = EncoderModel(g_conf.ENCODER_MODEL_TYPE, g_conf.ENCODER_MODEL_CONFIGURATION)
-            encoder_model.cuda()
+            encoder_model.to(device)
             encoder_model.eval()
 
             # Here we load the pre-trained encoder (not fine-tunned)
             if g_conf.FREEZE_ENCODER:
                 if encoder_params is not None:
-                    encoder_checkpoint = torch.load(
-                    os.path.join('_logs', encoder_params['encoder_folder'],
-                                        encoder_params['encoder_exp'],
-                                        'checkpoints',
-                                        str(encoder_params['encoder_checkpoint']) + '.pth'))
+                    encoder_checkpoint_path = os.path.join('_logs', encoder_params['encoder_folder'],
+                                                           encoder_params['encoder_exp'], 'checkpoints',
+                                                           str(encoder_params['encoder_checkpoint']) + '.pth')
+                    encoder_checkpoint = torch.load(encoder_checkpoint_path, map_location=device)
                     print("Encoder model ", str(encoder_params['encoder_checkpoint']), "loaded from ",
                           os.path.join('_logs', encoder_params['encoder_folder'], encoder_params['encoder_exp'],
                                        'checkpoints'))
@@ -171,223 +278,173 @@ def execute(gpu, exp_batch, exp_alias, json_file_path, suppress_output,
                 for param_ in encoder_model.parameters():
                     param_.requires_grad = False
 
-        while not maximun_checkpoint_reach(latest, g_conf.TEST_SCHEDULE):
-            latest = get_next_checkpoint_2(g_conf.TEST_SCHEDULE, summary_file)
-            if os.path.exists(os.path.join('_logs', exp_batch, g_conf.EXPERIMENT_NAME, 'checkpoints', str(latest) + '.pth')):
-                checkpoint = torch.load(os.path.join('_logs', exp_batch, g_conf.EXPERIMENT_NAME, 'checkpoints', str(latest) + '.pth'))
-                checkpoint_iteration = checkpoint['iteration']
-                model.load_state_dict(checkpoint['state_dict'])
-                print("Validation checkpoint ", checkpoint_iteration)
-                model.eval()
-                for param_ in model.parameters():
-                    param_.requires_grad = False
-
-                # Here we load the fine-tunned encoder
-                if not g_conf.FREEZE_ENCODER and g_conf.MODEL_TYPE not in ['one-step-affordances']:
-                    encoder_checkpoint = torch.load(os.path.join('_logs', exp_batch, g_conf.EXPERIMENT_NAME, 'checkpoints',
-                                     str(latest) + '_encoder.pth'))
-                    print("FINE TUNNED encoder model ", str(latest) + '_encoder.pth', "loaded from ",
-                          os.path.join('_logs', exp_batch, g_conf.EXPERIMENT_NAME,
-                                       'checkpoints'))
-                    encoder_model.load_state_dict(encoder_checkpoint['state_dict'])
-                    encoder_model.eval()
-                    for param_ in encoder_model.parameters():
-                        param_.requires_grad = False
-
-                accumulated_mae_ra = 0
-                accumulated_pedestrian_TP = 0
-                accumulated_pedestrian_TN = 0
-                accumulated_pedestrian_FN = 0
-                accumulated_pedestrian_FP = 0
-
-                accumulated_red_tl_TP = 0
-                accumulated_red_tl_TN = 0
-                accumulated_red_tl_FP = 0
-                accumulated_red_tl_FN = 0
+                # The frozen encoder gives the same embeddings for every checkpoint of the schedule.
+                # They are computed once, keyed by the hash of the encoder checkpoint, and kept on
+                # _preloads for the next validations, so only the heads run per checkpoint.
+                if g_conf.ENCODER_EMBEDDING_CACHE and encoder_params is not None:
+                    if plot_attentions or g_conf.INFERENCE_BACKEND == 'onnxruntime':
+                        print("The embedding cache is not used, the attentions and the ONNX graph need the encoder")
+                    else:
+                        # The first process fills the cache, the others open it once it is complete
+                        if is_main_process():
+                            embedding_cache = EmbeddingCache(dataset.preload_name,
+                                                             checkpoint_hash(encoder_checkpoint_path),
+                                                             len(dataset))
+                            embedding_cache.fill(encoder_model, dataset, g_conf.NUMBER_OF_LOADING_WORKERS)
+                        barrier()
+                        if not is_main_process():
+                            embedding_cache = EmbeddingCache(dataset.preload_name,
+                                                             checkpoint_hash(encoder_checkpoint_path),
+                                                             len(dataset))
+                        dataset.embedding_cache = embedding_cache
+
+        checkpoints_path = os.path.join('_logs', exp_batch, g_conf.EXPERIMENT_NAME, 'checkpoints')
+        # The frozen encoder is shared by all the checkpoints of a group, it runs once per batch
+        fine_tuned_encoder = encoder_model is not None and not g_conf.FREEZE_ENCODER
+        checkpoint_suffixes = ('.pth', '_encoder.pth') if fine_tuned_encoder else ('.pth',)
+        group_size = validation_group_size([model, encoder_model] if fine_tuned_encoder else [model], device)
+        # The models of each checkpoint of a group, the first ones are the models built above
+        group_models = [(model, encoder_model)]
+        attention_layers = [0, 1, 2] if plot_attentions else []
+        # Training publishes the checkpoints atomically on its manifest, the validation sleeps
+        # until the folder changes instead of polling it
+        watcher = CheckpointWatcher(checkpoints_path)
+        waiting_checkpoint = None
 
-                accumulated_vehicle_stop_TP = 0
-                accumulated_vehicle_stop_TN = 0
-                accumulated_vehicle_stop_FP = 0
-                accumulated_vehicle_stop_FN = 0
+        while not maximun_checkpoint_reach(latest, g_conf.TEST_SCHEDULE):
+            group = get_next_checkpoints_2(g_conf.TEST_SCHEDULE, latest, checkpoints_path, group_size,
+                                           checkpoint_suffixes)
+            if group and get_world_size() > 1:
+                # Every shard validates the checkpoints found by the first process
+                group = broadcast_object(group if is_main_process() else None)
+            if group:
+                latest = group[-1]
+                while len(group_models) < len(group):
+                    group_models.append((copy.deepcopy(model),
+                                         copy.deepcopy(encoder_model) if fine_tuned_encoder else encoder_model))
+                checkpoint_iterations = [load_checkpoint(group_model, group_encoder_model, checkpoints_path,
+                                                         checkpoint_number, device)
+                                         for checkpoint_number, (group_model, group_encoder_model)
+                                         in zip(group, group_models)]
+                unfinished = list(group)
+                if len(group) > 1:
+                    print("Validating the checkpoints ", checkpoint_iterations, " on a single pass")
+
+                # The confusion matrices and errors stay on the device until the end of the checkpoints
+                group_metrics = [AffordancesMetrics([2] * len(g_conf.AFFORDANCES_TARGETS['classification']),
+                                                    len(g_conf.AFFORDANCES_TARGETS['regression']), device=device,
+                                                    keep_regression_outputs=True)
+                                 for _ in group]
 
                 iteration_on_checkpoint = 0
 
+                # Only the encoder embedding is needed, plus the feature maps of the attentions
+                inference_models = []
+                for group_model, group_encoder_model in group_models[:len(group)]:
+                    inference_models += [m for m in [group_encoder_model, group_model]
+                                         if m is not None and m not in inference_models]
+                ort_models = [None] * len(group)
+                # The processes of a sharded validation do not export on the same file
+                onnx_suffix = '.onnx' if world_size == 1 else '_rank%d.onnx' % rank
+                # The attention maps of each checkpoint are written on the background
+                attention_writers = [AttentionWriter(os.path.join('_logs', exp_batch, g_conf.EXPERIMENT_NAME,
+                                                                  g_conf.PROCESS_NAME + '_attentions_' +
+                                                                  str(checkpoint_number)),
+                                                     every=g_conf.ATTENTION_EVERY,
+                                                     max_images=g_conf.ATTENTION_MAX_IMAGES,
+                                                     number_of_workers=g_conf.ATTENTION_WRITER_WORKERS)
+                                     for checkpoint_number in group] if plot_attentions else [None] * len(group)
+
                 for data in data_loader:
-                    if g_conf.MODEL_TYPE in ['one-step-affordances']:
-                        c_output, r_output, layers = model.forward_outputs(torch.squeeze(data['rgb'].cuda()),
-                                                                          dataset.extract_inputs(data).cuda(),
-                                                                          dataset.extract_commands(
-                                                                              data).cuda())
-
-                    elif g_conf.MODEL_TYPE in ['separate-affordances']:
-                        if g_conf.ENCODER_MODEL_TYPE in ['action_prediction', 'stdim' ,'ETEDIM',
-                                                         'FIMBC', 'one-step-affordances']:
-                            e, layers = encoder_model.forward_encoder(torch.squeeze(data['rgb'].cuda()),
-                                                                      dataset.extract_inputs(data).cuda(),
-                                                                      torch.squeeze(
-                                                                      dataset.extract_commands(
-                                                                            data).cuda())
-                                                              )
-                            c_output, r_output = model.forward_test(e)
-
-                        elif g_conf.ENCODER_MODEL_TYPE in ['ETE', 'ETE_inverse_model', 'forward',
-                                                           'ETE_stdim']:
-                            e, layers = encoder_model.forward_encoder(torch.squeeze(data['rgb'].cuda()),
-                                                                   dataset.extract_inputs(data).cuda(),
-                                                                   torch.squeeze(
-                                                                   dataset.extract_commands(
-                                                                      data).cuda())
-                                                              )
-                            c_output, r_output = model.forward_test(e)
-
-                    if plot_attentions:
-                        attentions_path = os.path.join('_logs', exp_batch, g_conf.EXPERIMENT_NAME,
-                                                       g_conf.PROCESS_NAME + '_attentions_'+
-                                                       str(latest))
-
-                        write_attentions(torch.squeeze(data['rgb']), layers, iteration_on_checkpoint,
-                                         attentions_path)
-
-                    # Accurancy = (TP+TN)/(TP+TN+FP+FN)
-                    # F1-score = 2*TP / (2*TP + FN + FP)
+                    # The batch is decoded and copied to the device once for all the checkpoints, the
+                    # frames are not decoded at all with the embedding cache
+                    images = None if dataset.embedding_cache is not None else torch.squeeze(data['rgb'].to(device))
+                    speeds = dataset.extract_inputs(data).to(device)
+                    commands = dataset.extract_commands(data).to(device)
                     classification_gt = dataset.extract_affordances_targets(data, 'classification')
                     regression_gt = dataset.extract_affordances_targets(data, 'regression')
 
-                    TP = 0
-                    FN = 0
-                    FP = 0
-                    TN = 0
-                    for i in range(classification_gt.shape[0]):
-                        if classification_gt[i, 0] == (c_output[0][i, 0] < c_output[0][i, 1]).type(torch.FloatTensor) == 1:
-                            TP += 1
-
-                        elif classification_gt[i, 0] == 1 and classification_gt[i, 0] != (c_output[0][i, 0] < c_output[0][i, 1]).type(torch.FloatTensor):
-                            FN += 1
-
-                        elif classification_gt[i, 0] == 0 and classification_gt[i, 0] != (c_output[0][i, 0] < c_output[0][i, 1]).type(torch.FloatTensor):
-                            FP += 1
-
-                        if classification_gt[i, 0] == (c_output[0][i, 0] < c_output[0][i, 1]).type(torch.FloatTensor) == 0:
-                            TN += 1
-
-                    accumulated_pedestrian_TP += TP
-                    accumulated_pedestrian_TN += TN
-                    accumulated_pedestrian_FP += FP
-                    accumulated_pedestrian_FN += FN
-
-                    TP = 0
-                    FN = 0
-                    FP = 0
-                    TN = 0
-                    for i in range(classification_gt.shape[0]):
-                        if classification_gt[i, 1] == (c_output[1][i, 0] < c_output[1][i, 1]).type(torch.FloatTensor) == 1:
-                            TP += 1
-
-                        elif classification_gt[i, 1] == 1 and classification_gt[i, 1] != (c_output[1][i, 0] < c_output[1][i, 1]).type(torch.FloatTensor):
-                            FN += 1
-
-                        elif classification_gt[i, 1] == 0 and classification_gt[i, 1] != (c_output[1][i, 0] < c_output[1][i, 1]).type(torch.FloatTensor):
-                            FP += 1
-
-                        if classification_gt[i, 1] == (c_output[1][i, 0] < c_output[1][i, 1]).type(torch.FloatTensor) == 0:
-                            TN += 1
-
-                    accumulated_red_tl_TP += TP
-                    accumulated_red_tl_TN += TN
-                    accumulated_red_tl_FP += FP
-                    accumulated_red_tl_FN += FN
-
-                    TP = 0
-                    FN = 0
-                    FP = 0
-                    TN = 0
-                    for i in range(classification_gt.shape[0]):
-                        if classification_gt[i, 2] == (c_output[2][i, 0] < c_output[2][i, 1]).type(
-                                torch.FloatTensor) == 1:
-                            TP += 1
-
-                        elif classification_gt[i, 2] == 1 and classification_gt[i, 2] !=\
-                                (c_output[2][i, 0] < c_output[2][i, 1]).type(torch.FloatTensor):
-                            FN += 1
-
-                        elif classification_gt[i, 2] == 0 and classification_gt[i, 2] !=\
-                                (c_output[2][i, 0] < c_output[2][i, 1]).type(torch.FloatTensor):
-                            FP += 1
-
-                        if classification_gt[i, 2] == (c_output[2][i, 0] <
-                                                       c_output[2][i, 1]).type(torch.FloatTensor) == 0:
-                            TN += 1
-
-                    accumulated_vehicle_stop_TP += TP
-                    accumulated_vehicle_stop_TN += TN
-                    accumulated_vehicle_stop_FP += FP
-                    accumulated_vehicle_stop_FN += FN
-
-                    # if the data was normalized during training, we need to transform it to its unit
-
-                    write_regular_output(checkpoint_iteration, torch.squeeze(r_output[0]),
-                                         regression_gt[:, 0])
-                    mae_ra = torch.abs(regression_gt[:, 0] -
-                                       torch.squeeze(r_output[0]).type(torch.FloatTensor)).\
-                                            numpy()
-                    accumulated_mae_ra += np.sum(mae_ra)
+                    if g_conf.INFERENCE_BACKEND == 'onnxruntime':
+                        outputs = []
+                        inputs = (images, speeds, torch.squeeze(commands))
+                        for i, (group_model, group_encoder_model) in enumerate(group_models[:len(group)]):
+                            if ort_models[i] is None:
+                                # Exported once per checkpoint, next to it, with the first batch as example
+                                ort_models[i] = onnx_runtime_model(
+                                    AffordancesInference.from_models(group_model, group_encoder_model),
+                                    inputs, os.path.join(checkpoints_path, str(group[i]) + onnx_suffix))
+                            outputs.append(split_affordances_outputs(*ort_models[i](*inputs)) + (None,))
+                    else:
+                        with slim_inference(inference_models, keep_layers=attention_layers):
+                            embedding = None
+                            if dataset.embedding_cache is not None:
+                                embedding = (data['embedding'].to(device), None)
+                            elif encoder_model is not None and not fine_tuned_encoder:
+                                embedding = encoder_model.forward_encoder(images, speeds, torch.squeeze(commands))
+                            outputs = [affordances_outputs(group_model, group_encoder_model, images, speeds,
+                                                           commands, embedding)
+                                       for group_model, group_encoder_model in group_models[:len(group)]]
+
+                    for attention_writer, metrics, (c_output, r_output, layers) in \
+                            zip(attention_writers, group_metrics, outputs):
+                        if attention_writer is not None:
+                            attention_writer.write(first_batch + iteration_on_checkpoint, layers, images)
+
+                        metrics.update(c_output, r_output, classification_gt, regression_gt)
 
                     if iteration_on_checkpoint % 100 == 0:
-                        print("Validation iteration: %d [%d/%d)] on Checkpoint %d " % (iteration_on_checkpoint,
-                                                                                       iteration_on_checkpoint,
-                                                                                       len(data_loader),
-                                                                                       checkpoint_iteration))
+                        print("Validation iteration: %d [%d/%d)] on Checkpoint %s " % (
+                            iteration_on_checkpoint, iteration_on_checkpoint, len(data_loader),
+                            ', '.join(str(c) for c in checkpoint_iterations)))
 
                     iteration_on_checkpoint += 1
 
+                for attention_writer in attention_writers:
+                    if attention_writer is not None:
+                        attention_writer.close()
 
-                # Here also need a better analysis. TODO divide into curve and other things
-                MAE_relative_angle = accumulated_mae_ra / (len(dataset))
-
-                csv_outfile = open(summary_file, 'a')
-                csv_outfile.write("%s, %f, %f, %f, %f, %f, %f, %f, %f, %f, %f, %f, %f, %f" %
-                                                        (checkpoint_iteration,
-                                                          accumulated_pedestrian_TP,
-                                                          accumulated_pedestrian_FP,
-                                                          accumulated_pedestrian_FN,
-                                                          accumulated_pedestrian_TN,
-                                                          accumulated_vehicle_stop_TP,
-                                                          accumulated_vehicle_stop_FP,
-                                                          accumulated_vehicle_stop_FN,
-                                                          accumulated_vehicle_stop_TN,
-                                                          accumulated_red_tl_TP,
-                                                          accumulated_red_tl_FP,
-                                                          accumulated_red_tl_FN,
-                                                          accumulated_red_tl_TN,
-                                                          MAE_relative_angle))
-
+                # The rows are written in the order of the schedule, the summary is the progress
+                for checkpoint_number, checkpoint_iteration, metrics in \
+                        zip(group, checkpoint_iterations, group_metrics):
+                    metrics.all_reduce()
+                    results = metrics.compute()
+                    # if the data was normalized during training, we need to transform it to its unit
+                    if 'regression_outputs' in results:
+                        write_regular_output(checkpoint_iteration, results['regression_outputs'][:, 0],
+                                             results['regression_gt'][:, 0])
 
-                csv_outfile.write("\n")
-                csv_outfile.close()
+                    if is_main_process():
+                        write_summary(summary_file, checkpoint_iteration, results)
+                    unfinished.remove(checkpoint_number)
 
             else:
-                print('The checkpoint you want to validate is not yet ready ', str(latest))
-
+                next_checkpoint = next_scheduled_checkpoint(g_conf.TEST_SCHEDULE, latest)
+                if next_checkpoint != waiting_checkpoint:
+                    print('The checkpoint you want to validate is not yet ready ', str(next_checkpoint))
+                    waiting_checkpoint = next_checkpoint
+                watcher.wait()
 
+        watcher.close()
 
         coil_logger.add_message('Finished', {})
         print('VALIDATION FINISHED !!')
         print('  Validation results saved in ==> ', summary_file)
+        cleanup()
 
     except KeyboardInterrupt:
         coil_logger.add_message('Error', {'Message': 'Killed By User'})
         # We erase the output that was unfinished due to some process stop.
-        if latest is not None:
-            coil_logger.erase_csv(latest)
+        for checkpoint_number in unfinished:
+            coil_logger.erase_csv(checkpoint_number)
 
     except RuntimeError as e:
-        if latest is not None:
-            coil_logger.erase_csv(latest)
+        for checkpoint_number in unfinished:
+            coil_logger.erase_csv(checkpoint_number)
         coil_logger.add_message('Error', {'Message': str(e)})
 
     except:
         traceback.print_exc()
         coil_logger.add_message('Error', {'Message': 'Something Happened'})
         # We erase the output that was unfinished due to some process stop.
-        if latest is not None:
-            coil_logger.erase_csv(latest)
+        for checkpoint_number in unfinished:
+            coil_logger.erase_csv(checkpoint_number)
@@ -0,0 +1,108 @@
+import torch
+
+from configs import g_conf
+
+
+class ActionDiscretizer(object):
+    """
+        Turn the controls (steer, throttle, brake) into the action classes given by the bin edges
+        of ACTION_CLASS_RANGE, and the predicted classes back into controls. A value v of a
+        control with edges [e_0, ..., e_n-1] belongs to the class k such that e_k-1 <= v < e_k,
+        class 0 being v < e_0 and class n being v >= e_n-1.
+
+        The whole batch is discretized with one torch.bucketize per control, on the device of
+        the values. The edge tensors are built once for each device and precision.
+    """
+
+    def __init__(self, class_range=None, control_range=None, targets=None):
+        """
+        Args:
+            class_range: the bin edges of each control, ACTION_CLASS_RANGE by default
+            control_range: the [min, max] of each control, ACTION_CONTROL_RANGE by default. Only
+                used to decode the outer classes.
+            targets: the controls, in the order of the columns of the actions, TARGETS by default
+        """
+        self.class_range = dict(class_range if class_range is not None else g_conf.ACTION_CLASS_RANGE)
+        self.control_range = dict(control_range if control_range is not None else g_conf.ACTION_CONTROL_RANGE)
+        self.targets = list(targets if targets is not None else g_conf.TARGETS)
+
+        for name in self.targets:
+            if name not in self.class_range:
+                raise ValueError("There are no action classes for the target %s" % name)
+            edges = self.class_range[name]
+            if len(edges) == 0 or any(edges[i] >= edges[i + 1] for i in range(len(edges) - 1)):
+                raise ValueError("The action class edges of %s should be increasing: %s" % (name, edges))
+
+        self._edges = {}
+        self._centers = {}
+
+    def number_of_classes(self, name=None):
+        """ The classes of a control, or of all the controls together if no name is given. """
+        if name is None:
+            return sum(self.number_of_classes(target) for target in self.targets)
+
+        return len(self.class_range[name]) + 1
+
+    def edges(self, name, device='cpu', dtype=torch.float32):
+        key = (name, torch.device(device), dtype)
+        if key not in self._edges:
+            self._edges[key] = torch.tensor(self.class_range[name], dtype=dtype, device=device)
+        return self._edges[key]
+
+    def centers(self, name, device='cpu'):
+        """
+            The control each class is decoded to: the middle of its bin, the outer bins being
+            closed by the control range.
+        """
+        device = torch.device(device)
+        if (name, device) not in self._centers:
+            if name not in self.control_range:
+                raise ValueError("There is no control range to decode the target %s" % name)
+            bounds = [self.control_range[name][0]] + list(self.class_range[name]) + [self.control_range[name][1]]
+            self._centers[(name, device)] = torch.tensor([(bounds[k] + bounds[k + 1]) / 2.0
+                                                          for k in range(len(bounds) - 1)],
+                                                         dtype=torch.float32, device=device)
+        return self._centers[(name, device)]
+
+    def classes(self, values, name):
+        """ The class ids, as a long tensor of the shape of the values, of one control. """
+        if not values.is_floating_point():
+            values = values.float()
+        # Compared on the precision of the values, as the comparisons with the edges always were
+        return torch.bucketize(values, self.edges(name, values.device, values.dtype), right=True)
+
+    def __call__(self, actions):
+        """
+        Args:
+            actions: the controls, [..., len(targets)], on any device
+
+        Returns:
+            The class ids of every control, a long tensor of the same shape
+        """
+        return torch.stack([self.classes(actions[..., i], name) for i, name in enumerate(self.targets)], -1)
+
+    def split_logits(self, logits):
+        """ Split the logits of all the controls, concatenated on the last dimension, per control. """
+        if logits.size(-1) != self.number_of_classes():
+            raise ValueError("Expected %d action logits, got %d" % (self.number_of_classes(), logits.size(-1)))
+
+        return list(torch.split(logits, [self.number_of_classes(name) for name in self.targets], -1))
+
+    def decode(self, predictions):
+        """
+            The controls of predicted classes.
+
+        Args:
+            predictions: the concatenated logits of every control, [..., number_of_classes()],
+                or the class ids, [..., len(targets)]
+
+        Returns:
+            The controls, [..., len(targets)]
+        """
+        if predictions.is_floating_point():
+            classes = [logits.argmax(-1) for logits in self.split_logits(predictions)]
+        else:
+            classes = [predictions[..., i] for i in range(len(self.targets))]
+
+        return torch.stack([self.centers(name, predictions.device)[class_ids]
+                            for class_ids, name in zip(classes, self.targets)], -1)
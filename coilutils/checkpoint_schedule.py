@@ -1,6 +1,9 @@
 import os
 import time
 import glob
+import json
+
+import torch
 
 from configs import g_conf
 from logger import monitorer
@@ -50,11 +53,90 @@ def is_ready_to_save(iteration):
     else:
         return False
 
+def _atomic_write(file_name, write_function):
+    """
+        Write a file on a temporary name of the same folder and rename it, so the readers
+        either see the previous file or the complete new one, never a partial write.
+    """
+    temporary_name = os.path.join(os.path.dirname(file_name),
+                                  '.' + os.path.basename(file_name) + '.' + str(os.getpid()) + '.tmp')
+    try:
+        write_function(temporary_name)
+        os.replace(temporary_name, file_name)
+    finally:
+        if os.path.exists(temporary_name):
+            os.remove(temporary_name)
+
+
+def read_checkpoint_manifest(checkpoints_path):
+    """
+        The checkpoints published on the manifest of a checkpoints folder.
+
+    Returns:
+        A dictionary from the checkpoint iteration to the list of its files, None when the
+        folder has no manifest, e.g. for the checkpoints of older trainings
+    """
+    manifest_file = os.path.join(checkpoints_path, 'manifest.json')
+    if not os.path.exists(manifest_file):
+        return None
+    with open(manifest_file, 'r') as f:
+        manifest = json.load(f)
+
+    return {int(iteration): files for iteration, files in manifest['checkpoints'].items()}
+
+
+def save_checkpoint(checkpoints_path, iteration, state, encoder_state=None):
+    """
+        Save a checkpoint and publish it on the manifest of the checkpoints folder. Every file
+        is written atomically and the manifest is only updated once all of them are complete,
+        so a validation waiting for the checkpoint never reads a half written file.
+    Args:
+        checkpoints_path: the checkpoints folder of the experiment
+        iteration: the iteration of the checkpoint, the name of its files
+        state: the state saved on <iteration>.pth
+        encoder_state: the state saved on <iteration>_encoder.pth, if any
+
+    """
+    files = [str(iteration) + '.pth']
+    _atomic_write(os.path.join(checkpoints_path, files[0]), lambda name: torch.save(state, name))
+    if encoder_state is not None:
+        files.append(str(iteration) + '_encoder.pth')
+        _atomic_write(os.path.join(checkpoints_path, files[1]), lambda name: torch.save(encoder_state, name))
+
+    manifest = read_checkpoint_manifest(checkpoints_path) or {}
+    manifest[int(iteration)] = files
+
+    def write_manifest(name):
+        with open(name, 'w') as f:
+            json.dump({'checkpoints': {str(k): manifest[k] for k in sorted(manifest)}}, f, indent=2)
+
+    _atomic_write(os.path.join(checkpoints_path, 'manifest.json'), write_manifest)
+
+
+def is_checkpoint_ready(checkpoints_path, checkpoint, suffixes=('.pth',)):
+    """
+        Returns if all the files of a checkpoint are saved. It is read from the manifest, or
+        from the files and their sizes when the training did not write a manifest.
+    """
+    manifest = read_checkpoint_manifest(checkpoints_path)
+    file_names = [str(checkpoint) + suffix for suffix in suffixes]
+    if manifest is not None:
+        return int(checkpoint) in manifest and all(name in manifest[int(checkpoint)] for name in file_names)
+
+    return all(os.path.exists(os.path.join(checkpoints_path, name)) and
+               not is_open(os.path.join(checkpoints_path, name)) for name in file_names)
+
+
 def get_latest_saved_checkpoint():
     """
         Returns the , latest checkpoint number that was saved
 
     """
+    manifest = read_checkpoint_manifest(os.path.join('_logs', g_conf.EXPERIMENT_BATCH_NAME,
+                                                     g_conf.EXPERIMENT_NAME, 'checkpoints'))
+    if manifest:
+        return str(max(manifest)) + '.pth'
+
     checkpoint_files = glob.glob(os.path.join('_logs', g_conf.EXPERIMENT_BATCH_NAME,
                                                g_conf.EXPERIMENT_NAME, 'checkpoints/*0.pth')
                                  )
@@ -158,6 +240,43 @@ def get_next_checkpoint_2(checkpoint_schedule, filename=None):
     return checkpoint_schedule[checkpoint_schedule.index(ltst_check) + 1]
 
 
+def next_scheduled_checkpoint(checkpoint_schedule, latest):
+    """ The checkpoint of the schedule after the latest evaluated one, the first one if latest is None. """
+    if latest is None:
+        return checkpoint_schedule[0]
+
+    if checkpoint_schedule.index(latest) + 1 == len(checkpoint_schedule):
+        raise RuntimeError("Not able to get next checkpoint, maximum checkpoint is reach")
+
+    return checkpoint_schedule[checkpoint_schedule.index(latest) + 1]
+
+
+def get_next_checkpoints_2(checkpoint_schedule, latest, checkpoints_path, group_size, suffixes=('.pth',)):
+    """
+        Get the next checkpoints to be validated together: the next ones of the schedule that
+        are ready, stopping on the first one that is not so they are always evaluated in
+        order. The group is empty when the next checkpoint is not ready yet.
+    Args:
+        checkpoint_schedule: the checkpoints to be evaluated
+        latest: the latest evaluated checkpoint, as read by get_latest_evaluated_checkpoint_2
+        checkpoints_path: the folder of the saved checkpoints
+        group_size: the maximum number of checkpoints returned
+        suffixes: the files that have to be saved for a checkpoint to be ready
+
+    Returns:
+        The list of the checkpoints of the group
+    """
+    next_check = next_scheduled_checkpoint(checkpoint_schedule, latest)
+    group = []
+    index = checkpoint_schedule.index(next_check)
+    for checkpoint in checkpoint_schedule[index:index + max(group_size, 1)]:
+        if not is_checkpoint_ready(checkpoints_path, checkpoint, suffixes):
+            break
+        group.append(checkpoint)
+
+    return group
+
+
 def check_loss_validation_stopped(checkpoint, validation_name):
     """
      Check if validation has already found a point that the curve is not going down
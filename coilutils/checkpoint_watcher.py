@@ -0,0 +1,112 @@
+"""
+    Block until something is written on the checkpoints folder of an experiment. On linux the
+    folder is watched with inotify, through the libc, so a waiting validation wakes up as soon
+    as training publishes a checkpoint and does not touch the filesystem in the meantime.
+    Elsewhere, or on filesystems without inotify support, it falls back to sleeping for a poll
+    interval.
+"""
+import os
+import time
+import errno
+import select
+import ctypes
+import ctypes.util
+
+
+# The inotify events of a file written and closed, created or renamed into the folder
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+
+
+def _load_libc():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        libc.inotify_init1, libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+
+    return libc
+
+
+class CheckpointWatcher(object):
+    """
+        Wait for the changes on a checkpoints folder.
+
+        with CheckpointWatcher(checkpoints_path) as watcher:
+            while not ready():
+                watcher.wait()
+    """
+
+    def __init__(self, checkpoints_path, poll_interval=5.0):
+        """
+        Args:
+            checkpoints_path: the folder where the checkpoints are saved, it may not exist yet
+            poll_interval: the maximum time, in seconds, a wait blocks. It is also the period of
+                the checks when inotify is not available.
+        """
+        self.checkpoints_path = checkpoints_path
+        self.poll_interval = poll_interval
+        self._libc = _load_libc()
+        self._fd = None
+        # Watched from the start, so the changes between a check and a wait are not lost
+        self._watch()
+
+    def _watch(self):
+        """ Start watching the folder, once it exists. Returns if the folder is watched. """
+        if self._fd is not None:
+            return True
+        if self._libc is None or not os.path.isdir(self.checkpoints_path):
+            return False
+
+        fd = self._libc.inotify_init1(os.O_CLOEXEC)
+        if fd < 0:
+            self._libc = None
+            return False
+        if self._libc.inotify_add_watch(fd, self.checkpoints_path.encode(),
+                                        IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE) < 0:
+            os.close(fd)
+            self._libc = None
+            return False
+        self._fd = fd
+
+        return True
+
+    def wait(self, timeout=None):
+        """
+            Block until a file of the folder is written, or the timeout ends.
+        Args:
+            timeout: in seconds, the poll interval by default
+
+        Returns:
+            If there was a change on the folder. Without inotify it is always True, the caller
+            has to check again.
+        """
+        timeout = self.poll_interval if timeout is None else timeout
+        if not self._watch():
+            time.sleep(timeout)
+            return True
+
+        try:
+            readable, _, _ = select.select([self._fd], [], [], timeout)
+        except (OSError, select.error) as e:
+            if e.args[0] != errno.EINTR:
+                raise
+            return False
+        if not readable:
+            return False
+        # The events are only wake ups, the state is read from the folder afterwards
+        os.read(self._fd, 64 * 1024)
+
+        return True
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
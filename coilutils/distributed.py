@@ -0,0 +1,165 @@
+"""
+    Helpers for the data parallel training mode. Every function works, as a no op when it makes
+    sense, on a process that is not part of a distributed group, so the training loops call them
+    unconditionally.
+"""
+import os
+import socket
+import datetime
+
+import torch
+import torch.distributed as dist
+
+# Rank 0 builds the preload and fills the embedding cache while the others wait on a barrier,
+# which takes longer than the 30 minutes gloo waits by default
+DEFAULT_TIMEOUT = datetime.timedelta(hours=12)
+
+
+def find_free_port():
+    """ Ask the OS for a free local port to rendezvous the training processes. """
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def select_device(gpu, world_size=1):
+    """
+        The device a process runs on. A gpu id selects that gpu, 'cpu' runs on the CPU and
+        shares the cores of the host among the world_size processes.
+    """
+    if gpu == 'cpu':
+        os.environ["CUDA_VISIBLE_DEVICES"] = ''
+        torch.set_num_threads(max(1, (os.cpu_count() or 1) // world_size))
+        return torch.device('cpu')
+    # We set the visible cuda devices to select the GPU
+    os.environ["CUDA_VISIBLE_DEVICES"] = gpu
+    return torch.device('cuda')
+
+
+def init_distributed(rank, world_size, dist_url, timeout=DEFAULT_TIMEOUT):
+    """
+        Join the process group with the gloo backend.
+    Args:
+        rank: the rank of this process
+        world_size: the total number of training processes
+        dist_url: the tcp address used for the rendezvous, tcp://host:port
+        timeout: how long a collective, e.g. a barrier, waits for the other processes
+    """
+    if not dist.is_available():
+        raise RuntimeError("This torch build does not support distributed training")
+    dist.init_process_group('gloo', init_method=dist_url, rank=rank, world_size=world_size, timeout=timeout)
+
+
+def cleanup():
+    if is_distributed():
+        dist.destroy_process_group()
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    if not is_distributed():
+        return 0
+    return dist.get_rank()
+
+
+def get_world_size():
+    if not is_distributed():
+        return 1
+    return dist.get_world_size()
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+def any_process(flag):
+    """ True on every process if the flag is set on at least one of them. """
+    if not is_distributed():
+        return flag
+    flag_tensor = torch.tensor([1 if flag else 0])
+    dist.all_reduce(flag_tensor, op=dist.ReduceOp.MAX)
+    return bool(flag_tensor.item())
+
+
+def broadcast_learning_rate(optimizer):
+    """
+        The learning rate schedule depends on the loss history, which is only complete on rank 0.
+        Its decision is copied to all the other processes so the replicas keep the same weights.
+    """
+    if not is_distributed():
+        return
+    learning_rates = torch.tensor([param_group['lr'] for param_group in optimizer.param_groups],
+                                  dtype=torch.float64)
+    dist.broadcast(learning_rates, 0)
+    for param_group, learning_rate in zip(optimizer.param_groups, learning_rates.tolist()):
+        param_group['lr'] = learning_rate
+
+
+def broadcast_parameters(module):
+    """ Copy the parameters and buffers of rank 0 to every other process. """
+    if not is_distributed():
+        return
+    for tensor in module.state_dict().values():
+        dist.broadcast(tensor, 0)
+
+
+def average_gradients(parameters):
+    """
+        Average the gradients over all the processes. Used for the modules that are not called
+        through their forward, which DistributedDataParallel can not synchronize.
+    """
+    if not is_distributed():
+        return
+    world_size = float(get_world_size())
+    for param in parameters:
+        if param.grad is not None:
+            dist.all_reduce(param.grad)
+            param.grad /= world_size
+
+
+def data_parallel(module):
+    """
+        Wrap a module on DistributedDataParallel. Some models do not use every parameter on
+        every forward, so the unused ones are searched for.
+    """
+    if not is_distributed():
+        return module
+    return torch.nn.parallel.DistributedDataParallel(module, find_unused_parameters=True)
+
+
+def all_gather_objects(obj):
+    """ The picklable object of every process, in rank order. """
+    if not is_distributed():
+        return [obj]
+    objects = [None] * get_world_size()
+    dist.all_gather_object(objects, obj)
+    return objects
+
+
+def broadcast_object(obj):
+    """ The picklable object of rank 0, on every process. """
+    if not is_distributed():
+        return obj
+    objects = [obj]
+    dist.broadcast_object_list(objects, 0)
+    return objects[0]
+
+
+def all_reduce_sum(tensor):
+    """
+        The sum of a tensor over all the processes. It is reduced on the cpu, which the gloo
+        backend supports for every operation, and returned on the device of the tensor.
+    """
+    if not is_distributed():
+        return tensor
+    reduced = tensor.cpu().clone()
+    dist.all_reduce(reduced)
+    return reduced.to(tensor.device)
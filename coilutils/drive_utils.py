@@ -11,6 +11,16 @@ def checkpoint_parse_configuration_file(filename):
            configuration_dict['agent_name'], configuration_dict['encoder_params']
 
 
+def checkpoint_parse_quantized_model(filename):
+    """
+        The path of the int8 model made by tools.quantize, if the agent configuration sets one.
+    """
+    with open(filename, 'r') as f:
+        configuration_dict = json.loads(f.read())
+
+    return configuration_dict.get('quantized_model', None)
+
+
 def summarize_benchmark(summary_data):
 
     final_dictionary = {}
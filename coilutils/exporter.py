@@ -1,10 +1,50 @@
 import os
+import multiprocessing
 import numpy as np
-from visualization.data_reading import read_control_csv, read_summary_csv
+from plotter.data_reading import read_control_csv, read_summary_csv
+from logger.metrics_store import MetricsStore
+from coilutils.summary_cache import SummaryCache, file_signature
 
 from configs.coil_global import get_names, merge_with_yaml, g_conf
 
-def export_csv(exp_batch, variables_to_export):
+
+def _drive_csv_files(experiment_path):
+    """ The environment and the control csv of each drive process of an experiment. """
+    return [(log.split('_')[1], os.path.join(experiment_path, log, 'control_output.csv'))
+            for log in os.listdir(experiment_path) if 'drive' in log and '_csv' in log]
+
+
+def _export_experiment(arguments):
+    """
+        The exported rows of an experiment, the values of the step with the most episodes
+        fully completed of each of its drive environments. Run on the exporter pool.
+    """
+    experiment_path, variables_to_export = arguments
+    rows = []
+    for environment, csv_file_path in _drive_csv_files(experiment_path):
+        if not os.path.exists(csv_file_path):
+            continue
+        control_csv = read_summary_csv(csv_file_path)
+        if control_csv is None:
+            continue
+        position_of_max_success = np.argmax(control_csv['episodes_fully_completed'])
+        rows.append((environment, [float(control_csv[variable][position_of_max_success])
+                                   for variable in variables_to_export]))
+
+    return rows
+
+
+def export_csv(exp_batch, variables_to_export, number_of_workers=None):
+    """
+        Export the best driving results of every experiment of a batch on _logs/<batch>/result.csv.
+        The experiments are parsed on a pool of processes and their rows are cached on
+        _logs/<batch>/.export_cache.pkl, so only the experiments with new driving results are
+        parsed again.
+    Args:
+        exp_batch: the folder with the experiments
+        variables_to_export: the columns of the control csv exported
+        number_of_workers: the processes of the pool, one per cpu by default
+    """
     # TODO: add parameter for auto versus auto.
 
     root_path = '_logs'
@@ -16,10 +56,33 @@ def export_csv(exp_batch, variables_to_export):
 
         raise ValueError(" export csv needs the episodes fully completed param on variables")
 
+    cache = SummaryCache(os.path.join(root_path, exp_batch, '.export_cache.pkl'))
+    experiments = [exp for exp in experiments if os.path.isdir(os.path.join(root_path, exp_batch, exp))]
+    signatures, rows, pending = {}, {}, []
+    for exp in experiments:
+        experiment_path = os.path.join(root_path, exp_batch, exp)
+        signatures[exp] = file_signature([csv_file_path for _, csv_file_path in _drive_csv_files(experiment_path)])
+        rows[exp] = cache.get((exp, tuple(variables_to_export)), signatures[exp])
+        if rows[exp] is None:
+            pending.append(exp)
+
+    print("Parsing ", len(pending), " of ", len(experiments), " experiments")
+    if pending:
+        pool = multiprocessing.Pool(min(number_of_workers or multiprocessing.cpu_count(), len(pending)))
+        try:
+            parsed = pool.map(_export_experiment, [(os.path.join(root_path, exp_batch, exp), variables_to_export)
+                                                   for exp in pending])
+        finally:
+            pool.close()
+            pool.join()
+        for exp, experiment_rows in zip(pending, parsed):
+            rows[exp] = experiment_rows
+            cache.put((exp, tuple(variables_to_export)), signatures[exp], experiment_rows)
+        cache.save()
+
     # Make the header of the exported csv
     csv_outfile = os.path.join(root_path, exp_batch, 'result.csv')
 
-
     with open(csv_outfile, 'w') as f:
         f.write("experiment,environment")
         for variable in variables_to_export:
@@ -27,30 +90,12 @@ def export_csv(exp_batch, variables_to_export):
 
         f.write("\n")
 
-    for exp in experiments:
-        if os.path.isdir(os.path.join(root_path, exp_batch, exp)):
-            experiments_logs = os.listdir(os.path.join(root_path, exp_batch, exp))
-            for log in experiments_logs:
-                if 'drive' in log and '_csv' in log:
-                    csv_file_path = os.path.join(root_path, exp_batch, exp, log, 'control_output.csv')
-
-                    if not os.path.exists(csv_file_path):
-                        continue
-                    control_csv = read_summary_csv(csv_file_path)
-                    if control_csv is None:
-                        continue
-                    print (control_csv)
-                    with open(csv_outfile, 'a') as f:
-                        f.write("%s,%s" % (exp, log.split('_')[1]))
-
-                        print (' var', variable)
-                        print (control_csv[variable])
-
-                        position_of_max_success = np.argmax(control_csv['episodes_fully_completed'])
-                        for variable in variables_to_export:
-                            f.write(",%f" % control_csv[variable][position_of_max_success])
-
-                        f.write("\n")
+        for exp in experiments:
+            for environment, values in rows[exp]:
+                f.write("%s,%s" % (exp, environment))
+                for value in values:
+                    f.write(",%f" % value)
+                f.write("\n")
 
 
 def export_csv_separate(exp_batch, variables_to_export, task_list):
@@ -164,6 +209,14 @@ def export_status(exp_batch, validation_datasets, driving_environments):
         names_list = get_names(exp_batch)
         count = 0
         print (names_list)
+        # The validated checkpoints of every experiment, one query per validation dataset
+        store = MetricsStore(exp_batch)
+        validated_steps = {}
+        for validation in validation_datasets:
+            columns = store.columns('validation_' + validation, ['MAE_relative_angle'])
+            validated_steps[validation] = {exp: set(experiment_columns['step'])
+                                           for exp, experiment_columns in columns.items()}
+        store.close()
         for exp in experiments:
 
             if os.path.isdir(os.path.join(root_path, exp_batch, exp)):
@@ -179,8 +232,10 @@ def export_status(exp_batch, validation_datasets, driving_environments):
 
                     log = 'validation_' + validation + '_csv'
 
-
-                    if log in os.listdir(os.path.join(root_path, exp_batch, exp)):
+                    if g_conf.TEST_SCHEDULE[-1] in validated_steps[validation].get(exp, ()):
+                        f.write(",Done")
+                    # The validations from before the metrics store only have their csv files
+                    elif log in os.listdir(os.path.join(root_path, exp_batch, exp)):
 
                         if (str(g_conf.TEST_SCHEDULE[-1]) + '.csv') in os.listdir(os.path.join(root_path,
                                                                                                exp_batch, exp, log)):
@@ -4,7 +4,11 @@ import smtplib
 import numpy as np
 
 from email.mime.text import MIMEText
-from PIL import Image
+
+from coilutils.lazy_import import lazy_import
+
+# Only used to plot images
+Image = lazy_import('PIL.Image')
 
 
 def static_vars(**kwargs):
@@ -0,0 +1,350 @@
+"""
+    Local scheduler for the training, validation and driving processes of a host. Every task
+    declares the cpu cores, RAM and gpu memory it needs and the scheduler starts it on a
+    device where they are free, best fit first, so the gpus and the cpu only hosts are packed
+    as tightly as possible. Without gpus every task runs on the cpu and only its cores and
+    RAM are packed. The usage of the running tasks is measured, from /proc and
+    nvidia-smi, and a task that uses more than it declared holds what it really uses.
+
+    Tasks run by priority, lower first, once the tasks they depend on finished and their
+    ready condition holds, e.g. a validation once its training saved a checkpoint. The end of
+    a task is its process exit code, read as soon as the process exits, and a task whose
+    heartbeat stops is terminated. A task that can never be ready, because the tasks that
+    would make it ready ended, fails instead of waiting forever.
+"""
+import os
+import time
+import heapq
+import threading
+import subprocess
+import multiprocessing
+from multiprocessing.connection import wait
+
+GB = 1024 ** 3
+
+
+def host_resources():
+    """ The cpu cores this process can use and the RAM bytes of the host. """
+    if hasattr(os, 'sched_getaffinity'):
+        cpus = len(os.sched_getaffinity(0))
+    else:
+        cpus = os.cpu_count()
+
+    return cpus, os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+
+def _nvidia_smi(query):
+    """ The rows of an nvidia-smi csv query, empty when there is no gpu or no driver. """
+    try:
+        output = subprocess.check_output(['nvidia-smi', query, '--format=csv,noheader,nounits'],
+                                         universal_newlines=True)
+    except (OSError, subprocess.CalledProcessError):
+        return []
+
+    return [[value.strip() for value in line.split(',')] for line in output.strip().splitlines() if line.strip()]
+
+
+def gpu_memory(gpus=None):
+    """
+        The memory, in bytes, of each gpu. It is read with nvidia-smi so the scheduler never
+        initializes cuda before starting its processes.
+    Args:
+        gpus: the ids of the gpus used, all of them if None
+    """
+    return {index: int(total) * 1024 * 1024 for index, total in _nvidia_smi('--query-gpu=index,memory.total')
+            if gpus is None or index in gpus}
+
+
+def gpu_memory_per_process():
+    """ The gpu memory, in bytes, used by each process id. """
+    usage = {}
+    for pid, used in _nvidia_smi('--query-compute-apps=pid,used_memory'):
+        try:
+            usage[int(pid)] = usage.get(int(pid), 0) + int(used) * 1024 * 1024
+        except ValueError:
+            continue
+    return usage
+
+
+def _stat_fields(pid):
+    # The fields after the command name, which may have spaces. Field n of stat is at n - 3.
+    with open('/proc/%d/stat' % pid, 'r') as f:
+        return f.read().rsplit(')', 1)[1].split()
+
+
+def process_tree(pid):
+    """ A process id and the ids of all its descendants, e.g. the data loading workers. """
+    if not os.path.isdir('/proc'):
+        return [pid]
+    children = {}
+    for entry in os.listdir('/proc'):
+        if entry.isdigit():
+            try:
+                children.setdefault(int(_stat_fields(int(entry))[1]), []).append(int(entry))
+            except (IOError, OSError, IndexError, ValueError):
+                continue
+    tree, stack = [], [pid]
+    while stack:
+        tree.append(stack.pop())
+        stack.extend(children.get(tree[-1], []))
+
+    return tree
+
+
+def process_usage(pids):
+    """ The cpu seconds and the resident memory bytes of a set of processes. """
+    page_size = os.sysconf('SC_PAGE_SIZE')
+    ticks = float(os.sysconf('SC_CLK_TCK'))
+    cpu_seconds, ram = 0.0, 0
+    for pid in pids:
+        try:
+            fields = _stat_fields(pid)
+        except (IOError, OSError):
+            continue
+        # utime, stime and rss
+        cpu_seconds += (int(fields[11]) + int(fields[12])) / ticks
+        ram += int(fields[21]) * page_size
+
+    return cpu_seconds, ram
+
+
+def _run_task(target, device, args, heartbeat, heartbeat_interval):
+    """ The entry of a task process. A daemon thread beats while the process is alive. """
+    def beat():
+        while True:
+            heartbeat.value = time.time()
+            time.sleep(heartbeat_interval)
+
+    thread = threading.Thread(target=beat)
+    thread.daemon = True
+    thread.start()
+    target(device, *args)
+
+
+class Task(object):
+    """
+        A process to be run by the JobScheduler. The target is called on its own process as
+        target(device, *args), device being the gpu id, or 'cpu' for the tasks without gpu
+        memory and on a host without gpus, as the execute functions of coil_core take it.
+    """
+
+    def __init__(self, name, target, args=(), priority=1, cpus=1, ram=0, gpu_memory=0, after=(), ready=None,
+                 ready_from=(), ready_timeout=None):
+        """
+        Args:
+            name: a unique name of the task
+            target: the function run by the process
+            args: the arguments after the device
+            priority: the tasks with lower priority start first
+            cpus: the cpu cores used, including the data loading workers
+            ram: the RAM bytes used
+            gpu_memory: the gpu memory bytes used, 0 for a cpu task. It is ignored when the
+                scheduler has no gpus.
+            after: the names of the tasks that have to finish before this one starts
+            ready: a function that returns if the task can start, checked by the scheduler
+            ready_from: the names of the tasks that make the ready condition hold, e.g. the
+                training of a validation. Once all of them ended the task fails if it is still
+                not ready.
+            ready_timeout: the seconds the task waits for its ready condition before failing,
+                forever if None
+        """
+        self.name = name
+        self.target = target
+        self.args = tuple(args)
+        self.priority = priority
+        self.cpus = cpus
+        self.ram = ram
+        self.gpu_memory = gpu_memory
+        self.after = list(after)
+        self.ready = ready
+        self.ready_from = list(ready_from)
+        self.ready_timeout = ready_timeout
+        self.added_time = time.time()
+
+        self.status = 'Not Started'
+        self.device = None
+        self.process = None
+        self.heartbeat = None
+        self.exitcode = None
+        self.usage = {'cpus': 0.0, 'ram': 0, 'gpu_memory': 0}
+        self._last_measure = None
+
+    def reserved(self):
+        """ The resources held: the declared ones, or the measured ones when they are larger. """
+        return {'cpus': max(self.cpus, self.usage['cpus']),
+                'ram': max(self.ram, self.usage['ram']),
+                'gpu_memory': max(self.gpu_memory, self.usage['gpu_memory'])}
+
+
+class JobScheduler(object):
+
+    def __init__(self, cpus=None, ram=None, gpus=None, poll_interval=10.0,
+                 heartbeat_interval=5.0, heartbeat_timeout=300.0):
+        """
+        Args:
+            cpus: the cpu cores available, all the ones of the process by default
+            ram: the RAM bytes available, all the host RAM by default
+            gpus: the ids of the gpus available, all of them by default. With none, e.g.
+                ['cpu'] or on a host without gpus, every task runs on the cpu.
+            poll_interval: the seconds between the measures of the usage and the checks of the
+                ready conditions. A task exit wakes the scheduler up at once.
+            heartbeat_interval: the seconds between the heartbeats of a task process
+            heartbeat_timeout: the seconds without heartbeat after which a task is terminated
+        """
+        host_cpus, host_ram = host_resources()
+        self.cpus = cpus if cpus is not None else host_cpus
+        self.ram = ram if ram is not None else host_ram
+        self.gpus = gpu_memory(gpus)
+        self.poll_interval = poll_interval
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_timeout = heartbeat_timeout
+
+        self.tasks = {}
+        self._queue = []
+        self._order = 0
+
+    def add(self, task):
+        if task.name in self.tasks:
+            raise ValueError("There is already a task named %s" % task.name)
+        if task.cpus > self.cpus or task.ram > self.ram:
+            raise ValueError("The task %s needs more cpus or RAM than the host has" % task.name)
+        if self.gpus and task.gpu_memory > 0 and \
+                not any(memory >= task.gpu_memory for memory in self.gpus.values()):
+            raise ValueError("The task %s needs more gpu memory than any gpu has" % task.name)
+        for name in task.after + task.ready_from:
+            if name not in self.tasks:
+                raise ValueError("The task %s depends on the unknown task %s" % (task.name, name))
+
+        self.tasks[task.name] = task
+        heapq.heappush(self._queue, (task.priority, self._order, task.name))
+        self._order += 1
+
+    def running_tasks(self):
+        return [task for task in self.tasks.values() if task.status == 'Running']
+
+    def free_resources(self):
+        """ The cpus, RAM and memory of each gpu that the running tasks do not hold. """
+        cpus, ram, gpus = self.cpus, self.ram, dict(self.gpus)
+        for task in self.running_tasks():
+            reserved = task.reserved()
+            cpus -= reserved['cpus']
+            ram -= reserved['ram']
+            if task.device != 'cpu':
+                gpus[task.device] -= reserved['gpu_memory']
+
+        return cpus, ram, gpus
+
+    def _dependencies(self, task):
+        """
+            Returns 'ready', 'waiting' or 'blocked', when a task it depends on failed or its ready
+            condition can not hold anymore.
+        """
+        for name in task.after:
+            if self.tasks[name].status == 'Error':
+                return 'blocked'
+            if self.tasks[name].status != 'Finished':
+                return 'waiting'
+        if task.ready is not None and not task.ready():
+            if task.ready_from and all(self.tasks[name].status in ('Finished', 'Error')
+                                       for name in task.ready_from):
+                return 'blocked'
+            if task.ready_timeout is not None and time.time() - task.added_time > task.ready_timeout:
+                return 'blocked'
+            return 'waiting'
+
+        return 'ready'
+
+    @staticmethod
+    def _place(task, cpus, ram, gpus):
+        """ The device where a task fits, 'cpu' for a cpu task, None if it does not fit now. """
+        if task.cpus > cpus or task.ram > ram:
+            return None
+        if task.gpu_memory <= 0 or not gpus:
+            return 'cpu'
+        fitting = [(free, gpu) for gpu, free in gpus.items() if free >= task.gpu_memory]
+        if not fitting:
+            return None
+
+        # Best fit, the gpu that is left with the least free memory
+        return min(fitting)[1]
+
+    def _start(self, task, device):
+        task.heartbeat = multiprocessing.Value('d', time.time(), lock=False)
+        task.process = multiprocessing.Process(target=_run_task, name=task.name,
+                                               args=(task.target, device, task.args, task.heartbeat,
+                                                     self.heartbeat_interval))
+        task.process.start()
+        task.device = device
+        task.status = 'Running'
+        print("Started ", task.name, " on ", 'cpu' if device == 'cpu' else 'gpu ' + device)
+
+    def _start_ready_tasks(self):
+        cpus, ram, gpus = self.free_resources()
+        remaining = []
+        while self._queue:
+            entry = heapq.heappop(self._queue)
+            task = self.tasks[entry[2]]
+            state = self._dependencies(task)
+            if state == 'blocked':
+                task.status = 'Error'
+                print("Not running ", task.name, ", a task it depends on failed or it was never ready")
+                continue
+            device = self._place(task, cpus, ram, gpus) if state == 'ready' else None
+            if device is None:
+                # The smaller tasks after it can still fill the resources left
+                remaining.append(entry)
+                continue
+            self._start(task, device)
+            cpus -= task.cpus
+            ram -= task.ram
+            if device != 'cpu':
+                gpus[device] -= task.gpu_memory
+        for entry in remaining:
+            heapq.heappush(self._queue, entry)
+
+    def _reap(self):
+        for task in self.running_tasks():
+            if task.process.exitcode is not None:
+                task.process.join()
+                task.exitcode = task.process.exitcode
+                task.status = 'Finished' if task.exitcode == 0 else 'Error'
+                print(task.status, " ", task.name, " exit code ", task.exitcode)
+            elif time.time() - task.heartbeat.value > self.heartbeat_timeout:
+                print("Terminating ", task.name, ", no heartbeat for ", self.heartbeat_timeout, " seconds")
+                task.process.terminate()
+                task.process.join()
+                task.exitcode = task.process.exitcode
+                task.status = 'Error'
+
+    def _measure(self):
+        running = self.running_tasks()
+        if not running:
+            return
+        gpu_usage = gpu_memory_per_process() if self.gpus else {}
+        now = time.time()
+        for task in running:
+            pids = process_tree(task.process.pid)
+            cpu_seconds, ram = process_usage(pids)
+            if task._last_measure is not None:
+                last_time, last_cpu_seconds = task._last_measure
+                task.usage['cpus'] = (cpu_seconds - last_cpu_seconds) / max(now - last_time, 1e-3)
+            task._last_measure = (now, cpu_seconds)
+            task.usage['ram'] = ram
+            task.usage['gpu_memory'] = sum(gpu_usage.get(pid, 0) for pid in pids)
+
+    def run(self):
+        """ Run every task. Blocks until all of them finished, failed or can not run. """
+        while True:
+            self._reap()
+            self._measure()
+            self._start_ready_tasks()
+            running = self.running_tasks()
+            if not running and not self._queue:
+                break
+            if running:
+                # Wakes up as soon as a task process exits
+                wait([task.process.sentinel for task in running], timeout=self.poll_interval)
+            else:
+                time.sleep(self.poll_interval)
+
+        return {name: task.status for name, task in self.tasks.items()}
@@ -0,0 +1,55 @@
+import importlib
+import sys
+import types
+
+
+class LazyModule(types.ModuleType):
+    """
+        A stand in for a module that is only imported on the first access to one of its
+        attributes. The heavy dependencies that only some processes use (plotting, image
+        augmentation, tensorboard, the simulator clients) are bound with it at module level,
+        so importing the packages does not pay for them.
+    """
+
+    def __init__(self, name, on_import=None):
+        super(LazyModule, self).__init__(name)
+        self._lazy_on_import = on_import
+        self._lazy_module = None
+
+    def _lazy_load(self):
+        if self._lazy_module is None:
+            if self._lazy_on_import is not None:
+                self._lazy_on_import()
+            self._lazy_module = importlib.import_module(self.__name__)
+        return self._lazy_module
+
+    def __getattr__(self, attribute):
+        if attribute.startswith('_lazy_'):
+            raise AttributeError(attribute)
+        return getattr(self._lazy_load(), attribute)
+
+    def __dir__(self):
+        return dir(self._lazy_load())
+
+
+def lazy_import(name, on_import=None):
+    """
+        Bind a module without importing it.
+
+    Args:
+        name: the full name of the module, e.g. 'matplotlib.pyplot'
+        on_import: called right before the actual import, e.g. to select the matplotlib backend
+
+    Returns:
+        The module if it was already imported, otherwise a LazyModule that imports it when used
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+
+    return LazyModule(name, on_import)
+
+
+def use_agg_backend():
+    """ Select the non interactive matplotlib backend, the processes here never show figures. """
+    import matplotlib
+    matplotlib.use('Agg')
@@ -0,0 +1,156 @@
+import numpy as np
+import torch
+
+from coilutils.distributed import is_distributed, all_gather_objects, all_reduce_sum
+
+
+# The classification affordances, in the order of the targets (AFFORDANCES_TARGETS)
+CLASSIFICATION_NAMES = ['pedestrian', 'red_tl', 'vehicle_stop']
+# and in the order of the columns of the validation summary csv
+SUMMARY_NAMES = ['pedestrian', 'vehicle_stop', 'red_tl']
+
+
+def binary_counts(confusion):
+    """ TP, FP, FN, TN of a binary confusion matrix indexed by [ground truth, prediction]. """
+    return confusion[1, 1], confusion[0, 1], confusion[1, 0], confusion[0, 0]
+
+
+def binary_metrics(TP, FP, FN, TN):
+    """
+        Accuracy = (TP+TN)/(TP+TN+FP+FN)
+        F1-score = 2*TP / (2*TP + FN + FP)
+    """
+    return {'accuracy': float(TP + TN) / max(TP + TN + FP + FN, 1),
+            'f1': 2.0 * TP / max(2 * TP + FN + FP, 1)}
+
+
+class AffordancesMetrics(object):
+    """
+        Accumulates the affordance metrics of a validation on the device of the outputs: a
+        confusion matrix for each classification affordance, with any number of classes, and
+        the sum of the absolute errors of each regression affordance. A batch is added with a
+        few tensor operations and nothing is copied to the host until compute(), so the
+        validation of a checkpoint only syncs once.
+    """
+
+    def __init__(self, number_of_classes, number_of_regressions, device='cpu', keep_regression_outputs=False):
+        """
+        Args:
+            number_of_classes: the number of classes of each classification affordance
+            number_of_regressions: the number of regression affordances
+            device: where the metrics are accumulated, the device of the model outputs
+            keep_regression_outputs: also keep the regression outputs and ground truth of every
+                sample, returned by compute()
+        """
+        self.number_of_classes = list(number_of_classes)
+        self.number_of_regressions = number_of_regressions
+        self.device = torch.device(device)
+        self.keep_regression_outputs = keep_regression_outputs
+        self.reset()
+
+    def reset(self):
+        self.confusion = [torch.zeros(n, n, dtype=torch.long, device=self.device) for n in self.number_of_classes]
+        self.absolute_error = torch.zeros(self.number_of_regressions, dtype=torch.float64, device=self.device)
+        self.number_of_samples = 0
+        self.regression_outputs = []
+
+    def update(self, c_output, r_output, classification_gt, regression_gt):
+        """
+            Add a batch.
+
+        Args:
+            c_output: the logits of each classification affordance, a list of [mini_batch, classes]
+                tensors or their stack
+            r_output: the regression outputs, a list of [mini_batch, 1] tensors or their
+                concatenation, [mini_batch, number_of_regressions]
+            classification_gt: the class of each classification affordance, [mini_batch, affordances]
+            regression_gt: [mini_batch, number_of_regressions]
+        """
+        if len(c_output) != len(self.number_of_classes):
+            raise ValueError("Expected %d classification outputs, got %d" % (len(self.number_of_classes),
+                                                                             len(c_output)))
+        classification_gt = classification_gt.to(self.device, non_blocking=True).long()
+        regression_gt = regression_gt.to(self.device, non_blocking=True)
+
+        for i, classes in enumerate(self.number_of_classes):
+            # On ties the first class is predicted, as the c[0] < c[1] comparison did
+            predictions = c_output[i].argmax(1).to(self.device)
+            self.confusion[i] += torch.bincount(classification_gt[:, i] * classes + predictions,
+                                                minlength=classes * classes).view(classes, classes)
+
+        if isinstance(r_output, (list, tuple)):
+            r_output = torch.cat([r.view(r.size(0), -1) for r in r_output], 1)
+        r_output = r_output.to(self.device).view(r_output.size(0), -1)[:, :self.number_of_regressions]
+        regression_gt = regression_gt.view(regression_gt.size(0), -1)[:, :self.number_of_regressions]
+        self.absolute_error += torch.abs(regression_gt.double() - r_output.double()).sum(0)
+        if self.keep_regression_outputs:
+            self.regression_outputs.append((r_output.detach(), regression_gt))
+        self.number_of_samples += classification_gt.size(0)
+
+    def all_reduce(self):
+        """
+            Sum the metrics accumulated by every process of a sharded validation. Afterwards every
+            process holds the metrics of the whole data. The processes validate contiguous shards
+            in rank order, so the kept regression outputs are concatenated in that order.
+        """
+        if not is_distributed():
+            return
+        counts = all_reduce_sum(torch.cat([c.flatten() for c in self.confusion] +
+                                          [torch.tensor([self.number_of_samples], device=self.device)]))
+        start = 0
+        for i, classes in enumerate(self.number_of_classes):
+            self.confusion[i] = counts[start:start + classes * classes].view(classes, classes)
+            start += classes * classes
+        self.number_of_samples = int(counts[start])
+        self.absolute_error = all_reduce_sum(self.absolute_error)
+
+        if self.keep_regression_outputs:
+            local = None
+            if self.regression_outputs:
+                local = (torch.cat([output for output, _ in self.regression_outputs]).cpu(),
+                         torch.cat([gt for _, gt in self.regression_outputs]).cpu())
+            # The shards without samples have nothing to add
+            gathered = [outputs for outputs in all_gather_objects(local) if outputs is not None]
+            self.regression_outputs = [(output.to(self.device), gt.to(self.device)) for output, gt in gathered]
+
+    def compute(self):
+        """
+            Copy the metrics to the host.
+
+        Returns:
+            A dictionary with the 'confusion' matrix of each classification affordance, indexed
+            by [ground truth, prediction], the 'mae' of each regression affordance and, when they
+            are kept, the 'regression_outputs' and 'regression_gt' of every sample
+        """
+        tensors = [c.flatten().double() for c in self.confusion] + [self.absolute_error]
+        if self.regression_outputs:
+            tensors += [torch.cat([output for output, _ in self.regression_outputs]).flatten().double(),
+                        torch.cat([gt for _, gt in self.regression_outputs]).flatten().double()]
+        values = torch.cat(tensors).cpu().numpy()
+
+        results = {'confusion': [], 'number_of_samples': self.number_of_samples}
+        start = 0
+        for classes in self.number_of_classes:
+            results['confusion'].append(values[start:start + classes * classes].astype(np.int64)
+                                        .reshape(classes, classes))
+            start += classes * classes
+        results['mae'] = values[start:start + self.number_of_regressions] / max(self.number_of_samples, 1)
+        start += self.number_of_regressions
+        if self.regression_outputs:
+            size = self.number_of_samples * self.number_of_regressions
+            results['regression_outputs'] = values[start:start + size].reshape(-1, self.number_of_regressions)
+            results['regression_gt'] = values[start + size:start + 2 * size].reshape(-1, self.number_of_regressions)
+
+        return results
+
+    def summary(self, names=CLASSIFICATION_NAMES, regression_names=('relative_angle',)):
+        """ The accuracy and F1 of the binary affordances and the MAE of the regression ones. """
+        results = self.compute()
+        metrics = {}
+        for name, confusion in zip(names, results['confusion']):
+            for key, value in binary_metrics(*binary_counts(confusion)).items():
+                metrics[name + '_' + key] = value
+        for name, mae in zip(regression_names, results['mae']):
+            metrics['MAE_' + name] = float(mae)
+
+        return metrics
@@ -0,0 +1,69 @@
+"""
+    A cache of the summaries parsed from the logs, so the exporter and the printer only parse
+    again the experiments whose files changed since the previous run.
+"""
+import os
+import pickle
+
+
+def file_signature(file_names):
+    """
+        The modification time and the size of each file, None for a missing file. Two equal
+        signatures mean that the files were not written in between.
+    """
+    signature = []
+    for file_name in file_names:
+        try:
+            stat = os.stat(file_name)
+            signature.append((file_name, stat.st_mtime_ns, stat.st_size))
+        except OSError:
+            signature.append((file_name, None, None))
+
+    return tuple(signature)
+
+
+class SummaryCache(object):
+    """
+        The summaries by key, each stored with the signature of the files it was parsed from.
+        The cache is kept on a pickle file when a cache_file is given, only in memory otherwise.
+    """
+
+    def __init__(self, cache_file=None):
+        self.cache_file = cache_file
+        self._entries = {}
+        if cache_file is not None and os.path.exists(cache_file):
+            try:
+                with open(cache_file, 'rb') as f:
+                    self._entries = pickle.load(f)
+            except (IOError, EOFError, pickle.UnpicklingError):
+                # A corrupted cache is parsed again
+                self._entries = {}
+
+    def get(self, key, signature):
+        """ The summary of a key, None when missing or parsed from different files. """
+        entry = self._entries.get(key)
+        if entry is None or entry[0] != signature:
+            return None
+        return entry[1]
+
+    def put(self, key, signature, summary):
+        """
+        Args:
+            signature: the file_signature taken before the files were parsed, so a write
+                during the parsing makes the next get miss
+        """
+        self._entries[key] = (signature, summary)
+
+    def save(self):
+        """ Write the cache file, through a rename so a concurrent reader never sees a partial file. """
+        if self.cache_file is None:
+            return
+        temporary_name = os.path.join(os.path.dirname(self.cache_file),
+                                      '.' + os.path.basename(self.cache_file) + '.' + str(os.getpid()) + '.tmp')
+        try:
+            with open(temporary_name, 'wb') as f:
+                pickle.dump(self._entries, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temporary_name, self.cache_file)
+        finally:
+            if os.path.exists(temporary_name):
+                os.remove(temporary_name)
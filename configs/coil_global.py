@@ -52,6 +52,8 @@ _g_conf.USE_NOISE_DATA = True
 _g_conf.TRAIN_DATASET_NAME = '1HoursW1-3-6-8'  # We only set the dataset in configuration for training
 _g_conf.LOG_SCALAR_WRITING_FREQUENCY = 2   # TODO NEEDS TO BE TESTED ON THE LOGGING FUNCTION ON  CREATE LOG
 _g_conf.LOG_IMAGE_WRITING_FREQUENCY = 1000
+_g_conf.PROFILE_STAGES = False  # Time each stage of the training iteration
+_g_conf.PROFILE_LOG_FREQUENCY = 100
 _g_conf.EXPERIMENT_BATCH_NAME = "eccv"
 _g_conf.EXPERIMENT_NAME = "default"
 _g_conf.EXPERIMENT_GENERATED_NAME = None
@@ -65,6 +67,10 @@ _g_conf.NUMBER_FRAMES_FUSION = 1
 _g_conf.NUMBER_IMAGES_SEQUENCE = 1
 _g_conf.SEQUENCE_STRIDE = 1
 _g_conf.TEST_SCHEDULE = range(0, 2000, 200)
+_g_conf.VALIDATION_CHECKPOINT_GROUP = 1  # Saved checkpoints validated together, on a single pass over the data
+_g_conf.ATTENTION_EVERY = 1  # The attention maps are written for one of every N batches or driving steps
+_g_conf.ATTENTION_MAX_IMAGES = None  # The attention maps written per checkpoint or episode at most, all if None
+_g_conf.ATTENTION_WRITER_WORKERS = 4  # The threads encoding and writing the attention maps
 _g_conf.SPEED_FACTOR = 12.0
 _g_conf.AUGMENT_LATERAL_STEERINGS = 6
 _g_conf.AUGMENT_RELATIVE_ANGLE = 1.0
@@ -85,6 +91,12 @@ _g_conf.ENCODER_MODEL_CONFIGURATION = {}
 _g_conf.PRE_TRAINED = False
 _g_conf.MAGICAL_SEED = 42
 _g_conf.FREEZE_ENCODER = False
+_g_conf.ENCODER_EMBEDDING_CACHE = False  # Store the frozen encoder embeddings on _preloads, train and validate the heads on them
+_g_conf.NUMBER_OF_BRANCHES = 4  # The conditional branches, one per high level command
+_g_conf.FUSED_HEADS = False  # Evaluate the affordance heads that share their layout with a single grouped matmul
+_g_conf.INFERENCE_BACKEND = 'pytorch'  # pytorch or onnxruntime, used by validation and the driving agents
+_g_conf.FUSED_FRAME_PAIRS = True  # Encode the two frames of the pair models with a single call on a 2B batch
+_g_conf.FRAME_PAIR_BATCHNORM = 'per_frame'  # per_frame keeps the BatchNorm statistics of each frame, joint uses the 2B batch
 _g_conf.VAE_LOSS_FUNCTION = None
 _g_conf.DISENTANGLE_BETA = 1
 _g_conf.LABELS_SUPERVISED = False
@@ -93,6 +105,7 @@ _g_conf.JOIN_CLASSES = {'0': 2, '1': 2, '2': 2, '3': 2, '5': 2, '12': 2, '9': 2,
 # The id of classes you want to keep in the label images
 _g_conf.ACTION_CLASS_RANGE = {'steer': [-0.3, -0.05, 0.05, 0.3], 'throttle': [0.4, 0.6], 'brake': [0.1]}
 _g_conf.ACTION_VARIABLE_WEIGHT = {'steer': [0.99, 0.97, 0.08, 0.98, 0.99], 'throttle': [0.66, 0.40, 0.94], 'brake': [0.32, 0.68]}
+_g_conf.ACTION_CONTROL_RANGE = {'steer': [-1.0, 1.0], 'throttle': [0.0, 1.0], 'brake': [0.0, 1.0]}  # To decode the action classes back to controls
 
 _g_conf.AFFORDANCES_CLASS_WEIGHT= [] # The class label (True or False) occurence in the training dataset. For hazard stop and red light
 _g_conf.AFFORDANCES_VARIABLE_WEIGHT = []
@@ -108,6 +121,13 @@ _g_conf.USED_LAYERS_ATT = []
 _g_conf.LOSS_FUNCTION = 'L2'
 _g_conf.LOSSES_WEIGHTS = {}
 
+"""#### Distillation Related Parameters ####"""
+# The separate-affordances experiment taught: folder, exp and checkpoint, plus the
+# encoder_folder, encoder_exp and encoder_checkpoint of its encoder
+_g_conf.DISTILL_TEACHER = {}
+_g_conf.DISTILL_TEMPERATURE = 2.0  # The softmax temperature of the classification targets
+_g_conf.DISTILL_LOSS_WEIGHTS = {'embedding': 1.0, 'classification': 1.0, 'regression': 1.0}
+
 """#### Simulation Related Parameters ####"""
 
 _g_conf.IMAGE_CUT = [115, 510]  # How you should cut the input image that is received from the server
@@ -175,23 +195,19 @@ def set_type_of_process(process_type, param=None):
     if _g_conf.PROCESS_NAME == "default":
         raise RuntimeError(" You should merge with some exp file before setting the type")
 
-    if process_type == 'train' or process_type == 'train_encoder':
+    if process_type in ['train', 'train_encoder', 'train_distill']:
         _g_conf.PROCESS_NAME = process_type
-        if not os.path.exists(os.path.join('_logs', _g_conf.EXPERIMENT_BATCH_NAME,
-                                            _g_conf.EXPERIMENT_NAME,
-                                            'checkpoints') ):
-                os.mkdir(os.path.join('_logs', _g_conf.EXPERIMENT_BATCH_NAME,
-                                      _g_conf.EXPERIMENT_NAME,
-                                      'checkpoints'))
+        # Several processes of a distributed run may get here at the same time
+        os.makedirs(os.path.join('_logs', _g_conf.EXPERIMENT_BATCH_NAME,
+                                 _g_conf.EXPERIMENT_NAME,
+                                 'checkpoints'), exist_ok=True)
 
     elif process_type == 'validation':
         _g_conf.PROCESS_NAME = process_type + '_' + param
-        if not os.path.exists(os.path.join('_logs', _g_conf.EXPERIMENT_BATCH_NAME,
-                                           _g_conf.EXPERIMENT_NAME,
-                                           _g_conf.PROCESS_NAME + '_csv')):
-            os.mkdir(os.path.join('_logs', _g_conf.EXPERIMENT_BATCH_NAME,
-                                          _g_conf.EXPERIMENT_NAME,
-                                           _g_conf.PROCESS_NAME + '_csv'))
+        # The shards of a sharded validation may get here at the same time
+        os.makedirs(os.path.join('_logs', _g_conf.EXPERIMENT_BATCH_NAME,
+                                 _g_conf.EXPERIMENT_NAME,
+                                 _g_conf.PROCESS_NAME + '_csv'), exist_ok=True)
 
     #else:  # FOr the test case we join with the name of the experimental suite.
 
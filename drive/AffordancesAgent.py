@@ -7,14 +7,14 @@ import math
 import numpy as np
 import os
 import scipy
-from torchvision.utils import save_image
-import matplotlib.pyplot as plt
 
 from scipy.misc import imresize
 from drive.affordances import  get_driving_affordances
 from drive.local_planner import LocalPlanner
 from network import CoILModel, EncoderModel
-from coilutils.drive_utils import checkpoint_parse_configuration_file
+from network.inference import slim_inference, inference_mode, split_affordances_outputs, OnnxRuntimeModel
+from coilutils.drive_utils import checkpoint_parse_configuration_file, checkpoint_parse_quantized_model
+from logger.attention_writer import AttentionWriter
 
 # TODO make a sub class for a non learnable agent
 
@@ -22,42 +22,6 @@ from coilutils.drive_utils import checkpoint_parse_configuration_file
     Interface for the CARLA basic npc agent.
 """
 
-def save_attentions(images, all_layers, iteration, folder_name, layers=None, save_input=False, big_size=False):
-
-    # Plot the attentions that are computed by the network directly here.
-    # maybe take the intermediate layers and compute the attentions  ??
-    if layers is None:
-        layers = [0, 1, 2]
-
-
-    if not os.path.exists(folder_name):
-        os.mkdir(folder_name)
-
-    if save_input:
-        # We save the images directly as a source of comparison
-        if not os.path.exists(os.path.join(folder_name, 'inputs')):
-            os.mkdir(os.path.join(folder_name, 'inputs'))
-
-        for i in range(images.shape[0]):
-            save_image(images[i], os.path.join(folder_name, 'inputs', str(iteration).zfill(8) + '.png' ))
-
-
-    # We save now the attention maps for the layers
-    cmap = plt.get_cmap('inferno')
-    for layer in layers:
-
-        if not os.path.exists(os.path.join(folder_name, 'layer' + str(layer))):
-            os.mkdir(os.path.join(folder_name, 'layer' + str(layer)))
-
-        y = all_layers[layer]      #shape [1, 64, 22, 50]
-        att = torch.abs(y).mean(1)[0].data.cpu().numpy()      #shape [22, 50]
-        att = att / att.max()                   #shape [22, 50]
-        if big_size:
-            att = scipy.misc.imresize(att, [395, 800])
-        else:
-            att = scipy.misc.imresize(att, [88, 200])
-        scipy.misc.imsave(os.path.join(folder_name, 'layer' + str(layer), str(iteration).zfill(8) + '.png' ), cmap(att))
-
 def encode_directions(directions):
     if directions == 2.0:
         return [1, 0, 0, 0]
@@ -124,6 +88,7 @@ class AffordancesAgent(object):
 
         self.setup(path_to_config_file)
         self.save_attentions = False
+        self._attention_writer = None
 
     def setup(self, path_to_config_file):
         self._agent = None
@@ -140,7 +105,21 @@ class AffordancesAgent(object):
         g_conf.immutable(False)
         merge_with_yaml(os.path.join('/', os.path.join(*path_to_config_file.split('/')[:-4]), yaml_conf), encoder_params)
 
-        if g_conf.MODEL_TYPE in ['one-step-affordances']:
+        # The int8 model made by tools.quantize, or the ONNX graph made by tools.export_onnx, runs
+        # on the CPU in place of the fp32 models
+        self._cpu_model = None
+        quantized_model_path = checkpoint_parse_quantized_model(path_to_config_file)
+        if quantized_model_path is not None:
+            self._cpu_model = torch.jit.load(quantized_model_path, map_location='cpu')
+            self._cpu_model.eval()
+            print("Quantized affordances model loaded from ", quantized_model_path)
+
+        elif g_conf.INFERENCE_BACKEND == 'onnxruntime':
+            onnx_path = os.path.join(exp_dir, 'checkpoints', str(checkpoint_number) + '.onnx')
+            self._cpu_model = OnnxRuntimeModel(onnx_path)
+            print("ONNX affordances model loaded from ", onnx_path)
+
+        elif g_conf.MODEL_TYPE in ['one-step-affordances']:
             # one step training, no need to retrain FC layers, we just get the output of encoder model as prediciton
             self._model = EncoderModel(g_conf.ENCODER_MODEL_TYPE, g_conf.ENCODER_MODEL_CONFIGURATION)
             self.checkpoint = torch.load(os.path.join(exp_dir, 'checkpoints', str(checkpoint_number) + '.pth'))
@@ -151,7 +130,8 @@ class AffordancesAgent(object):
 
 
         elif g_conf.MODEL_TYPE in ['separate-affordances']:
-            if encoder_params is not None:
+            # A fine tuned encoder, e.g. a distilled one, is loaded from the experiment checkpoints
+            if encoder_params is not None or not g_conf.FREEZE_ENCODER:
                 self.encoder_model = EncoderModel(g_conf.ENCODER_MODEL_TYPE, g_conf.ENCODER_MODEL_CONFIGURATION)
                 self.encoder_model.cuda()
                 # Here we load the pre-trained encoder (not fine-tunned)
@@ -177,7 +157,7 @@ class AffordancesAgent(object):
                     for param_ in self.encoder_model.parameters():
                         param_.requires_grad = False
             else:
-                raise RuntimeError('encoder_params can not be None in MODEL_TYPE --> separate-affordances')
+                raise RuntimeError('encoder_params can not be None in MODEL_TYPE --> separate-affordances with a frozen encoder')
 
             self._model = CoILModel(g_conf.MODEL_TYPE, g_conf.MODEL_CONFIGURATION, g_conf.ENCODER_MODEL_CONFIGURATION)
             self.checkpoint = torch.load(os.path.join(exp_dir, 'checkpoints', str(checkpoint_number) + '.pth'))
@@ -245,29 +225,53 @@ class AffordancesAgent(object):
         input_data = exp._sensor_interface.get_data()
         input_data = self._process_sensors(input_data['rgb_central'][1])    #torch.Size([1, 3, 88, 200]
 
-        if g_conf.MODEL_TYPE in ['one-step-affordances']:
-            c_output, r_output, layers= self._model.forward_outputs(input_data.cuda(),
-                                                             torch.cuda.FloatTensor([exp._forward_speed/g_conf.SPEED_FACTOR]).unsqueeze(0),
-                                                             torch.cuda.FloatTensor(encode_directions(exp._directions)).unsqueeze(0))
-        elif g_conf.MODEL_TYPE in ['separate-affordances']:
-            if g_conf.ENCODER_MODEL_TYPE in ['action_prediction', 'stdim' ,'ETEDIM',
-                                                         'FIMBC', 'one-step-affordances']:
-                e, layers = self.encoder_model.forward_encoder(input_data.cuda(),
-                                                             torch.cuda.FloatTensor([exp._forward_speed/g_conf.SPEED_FACTOR]).unsqueeze(0),
-                                                             torch.cuda.FloatTensor(encode_directions(exp._directions)).unsqueeze(0))
-                c_output, r_output = self._model.forward_test(e)
-            elif g_conf.ENCODER_MODEL_TYPE in ['ETE', 'ETE_inverse_model', 'forward',
-                                                           'ETE_stdim']:
-                e, layers = self.encoder_model.forward_encoder(input_data.cuda(),
-                                                            torch.cuda.FloatTensor([exp._forward_speed/g_conf.SPEED_FACTOR]).unsqueeze(0),
-                                                            torch.cuda.FloatTensor(encode_directions(exp._directions)).unsqueeze(0))
-                c_output, r_output = self._model.forward_test(e)
-
-        if self.save_attentions:
+        if self._cpu_model is not None:
+            with inference_mode():
+                c_output, r_output = self._cpu_model(
+                    input_data,
+                    torch.FloatTensor([exp._forward_speed/g_conf.SPEED_FACTOR]).unsqueeze(0),
+                    torch.FloatTensor(encode_directions(exp._directions)).unsqueeze(0))
+            c_output, r_output = split_affordances_outputs(c_output, r_output)
+            # The CPU graphs do not output the feature maps
+            layers = None
+
+        else:
+            # Only the outputs are needed, the feature maps are kept just for the attentions
+            inference_models = [self._model]
+            if g_conf.MODEL_TYPE in ['separate-affordances']:
+                inference_models.append(self.encoder_model)
+            with slim_inference(inference_models, keep_layers=[0, 1, 2] if self.save_attentions else []):
+                if g_conf.MODEL_TYPE in ['one-step-affordances']:
+                    c_output, r_output, layers= self._model.forward_outputs(input_data.cuda(),
+                                                                     torch.cuda.FloatTensor([exp._forward_speed/g_conf.SPEED_FACTOR]).unsqueeze(0),
+                                                                     torch.cuda.FloatTensor(encode_directions(exp._directions)).unsqueeze(0))
+                elif g_conf.MODEL_TYPE in ['separate-affordances']:
+                    if g_conf.ENCODER_MODEL_TYPE in ['action_prediction', 'stdim' ,'ETEDIM',
+                                                                 'FIMBC', 'one-step-affordances']:
+                        e, layers = self.encoder_model.forward_encoder(input_data.cuda(),
+                                                                     torch.cuda.FloatTensor([exp._forward_speed/g_conf.SPEED_FACTOR]).unsqueeze(0),
+                                                                     torch.cuda.FloatTensor(encode_directions(exp._directions)).unsqueeze(0))
+                        c_output, r_output = self._model.forward_test(e)
+                    elif g_conf.ENCODER_MODEL_TYPE in ['ETE', 'ETE_inverse_model', 'forward',
+                                                                   'ETE_stdim']:
+                        e, layers = self.encoder_model.forward_encoder(input_data.cuda(),
+                                                                    torch.cuda.FloatTensor([exp._forward_speed/g_conf.SPEED_FACTOR]).unsqueeze(0),
+                                                                    torch.cuda.FloatTensor(encode_directions(exp._directions)).unsqueeze(0))
+                        c_output, r_output = self._model.forward_test(e)
+
+        if self.save_attentions and layers is not None:
             exp_params = exp._exp_params
             attentions_full_path = os.path.join(os.environ["SRL_DATASET_PATH"], exp_params['package_name'], exp_params['env_name'],
                                                 str(exp_params['env_number'])+'_'+ exp._agent_name, str(exp_params['exp_number']))
-            save_attentions(input_data.cuda(), layers, self.count, attentions_full_path, save_input=False, big_size=False)
+            if self._attention_writer is None or self._attention_writer.folder_name != attentions_full_path:
+                self.close_attentions()
+                # The maps are written on the background, the episode keeps running
+                self._attention_writer = AttentionWriter(attentions_full_path, size=(88, 200),
+                                                         name_format='{iteration:08d}',
+                                                         every=g_conf.ATTENTION_EVERY,
+                                                         max_images=g_conf.ATTENTION_MAX_IMAGES,
+                                                         number_of_workers=g_conf.ATTENTION_WRITER_WORKERS)
+            self._attention_writer.write(self.count, layers)
 
         self.count += 1
 
@@ -354,8 +358,15 @@ class AffordancesAgent(object):
         """
         pass
 
+    def close_attentions(self):
+        """ Wait until the attention maps of the episode are written. """
+        if self._attention_writer is not None:
+            self._attention_writer.close()
+            self._attention_writer = None
+
     def reset(self):
         print (" Correctly reseted the agent")
+        self.close_attentions()
         self.route_assigned = False
         self._agent = None
         self.count = 0
@@ -382,7 +393,10 @@ class AffordancesAgent(object):
 
         sensor = np.swapaxes(sensor, 0, 1)
         sensor = np.transpose(sensor, (2, 1, 0))
-        sensor = torch.from_numpy(sensor / 255.0).type(torch.FloatTensor).cuda()
+        sensor = torch.from_numpy(sensor / 255.0).type(torch.FloatTensor)
+        # The CPU models run on hosts that may have no gpu
+        if self._cpu_model is None:
+            sensor = sensor.cuda()
         image_input = sensor.unsqueeze(0)
         self.latest_image_tensor = image_input
 
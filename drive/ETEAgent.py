@@ -6,9 +6,6 @@ import os
 import sys
 import json
 
-import matplotlib as mpl
-mpl.use('Agg')
-import matplotlib.pyplot as plt
 import numpy as np
 import scipy
 from scipy.misc import imresize
@@ -17,6 +14,11 @@ import torch
 #from coilutils.drive_utils import checkpoint_parse_configuration_file
 from configs import g_conf, merge_with_yaml
 from network import CoILModel, EncoderModel
+from network.inference import slim_inference, OnnxRuntimeModel
+from coilutils.lazy_import import lazy_import, use_agg_backend
+
+# Only used to plot the attentions
+plt = lazy_import('matplotlib.pyplot', on_import=use_agg_backend)
 
 from agents.navigation.local_planner import RoadOption
 
@@ -56,25 +58,35 @@ class ETEAgent(object):
                                               '_logs',
                                              yaml_conf.split('/')[-2], yaml_conf.split('/')[-1].split('.')[-2]
                                              , 'checkpoints', str(checkpoint_number) + '.pth'))
-        checkpoint = torch.load(os.path.join('/', os.path.join(*os.path.realpath(__file__).split('/')[:-2]),
-                                              '_logs',
-                                             yaml_conf.split('/')[-2], yaml_conf.split('/')[-1].split('.')[-2]
-                                             , 'checkpoints', str(checkpoint_number) + '.pth'))
-
+        checkpoints_path = os.path.join('/', os.path.join(*os.path.realpath(__file__).split('/')[:-2]),
+                                        '_logs', yaml_conf.split('/')[-2], yaml_conf.split('/')[-1].split('.')[-2],
+                                        'checkpoints')
         # do the merge here
         print ("yaml to merge", os.path.join('/', os.path.join(*os.path.realpath(__file__).split('/')[:-2]),
                                      yaml_conf))
         merge_with_yaml(os.path.join('/', os.path.join(*os.path.realpath(__file__).split('/')[:-2]),
                                      yaml_conf))
 
-        self.checkpoint = checkpoint  # We save the checkpoint for some interesting future use.
-        self._model = EncoderModel(g_conf.ENCODER_MODEL_TYPE, g_conf.ENCODER_MODEL_CONFIGURATION)
         self.first_iter = True
-        logging.info("Setup Model")
-        # Load the model and prepare set it for evaluation
-        self._model.load_state_dict(checkpoint['state_dict'])
-        self._model.cuda()
-        self._model.eval()
+        # The graph made by tools.export_onnx runs on the CPU in place of the model, so the
+        # agent needs no gpu and the model is not loaded
+        self._onnx_model = None
+        self._model = None
+        if g_conf.INFERENCE_BACKEND == 'onnxruntime':
+            self._device = torch.device('cpu')
+            self.checkpoint = torch.load(os.path.join(checkpoints_path, str(checkpoint_number) + '.pth'),
+                                         map_location='cpu')
+            self._onnx_model = OnnxRuntimeModel(os.path.join(checkpoints_path, str(checkpoint_number) + '.onnx'))
+        else:
+            self._device = torch.device('cuda')
+            # We save the checkpoint for some interesting future use.
+            self.checkpoint = torch.load(os.path.join(checkpoints_path, str(checkpoint_number) + '.pth'))
+            self._model = EncoderModel(g_conf.ENCODER_MODEL_TYPE, g_conf.ENCODER_MODEL_CONFIGURATION)
+            logging.info("Setup Model")
+            # Load the model and prepare set it for evaluation
+            self._model.load_state_dict(self.checkpoint['state_dict'])
+            self._model.cuda()
+            self._model.eval()
         self.latest_image = None
         self.latest_image_tensor = None
         # We add more time to the curve commands
@@ -136,14 +148,19 @@ class ETEAgent(object):
 
         # Take the forward speed and normalize it for it to go from 0-1
         norm_speed = input_data['speed'] / g_conf.SPEED_FACTOR
-        norm_speed = torch.cuda.FloatTensor([norm_speed]).unsqueeze(0)
+        norm_speed = torch.tensor([norm_speed], dtype=torch.float32, device=self._device).unsqueeze(0)
         directions = encode_directions(directions)
-        directions_tensor = torch.from_numpy(np.asarray([directions])).float().cuda()
+        directions_tensor = torch.from_numpy(np.asarray([directions])).float().to(self._device)
         # Compute the forward pass processing the sensors got from CARLA.
 
-        model_outputs = self._model.forward_action(self._process_sensors(input_data['rgb_central'][1]),
-                                                   norm_speed,
-                                                   directions_tensor)
+        if self._onnx_model is not None:
+            model_outputs = self._onnx_model(self._process_sensors(input_data['rgb_central'][1]),
+                                             norm_speed, directions_tensor)
+        else:
+            with slim_inference(self._model):
+                model_outputs = self._model.forward_action(self._process_sensors(input_data['rgb_central'][1]),
+                                                           norm_speed,
+                                                           directions_tensor)
 
         steer, throttle, brake = self._process_model_outputs(model_outputs[0])
         control = carla.VehicleControl()
@@ -167,6 +184,8 @@ class ETEAgent(object):
         """
         if layers is None:
             layers = [0, 1, 2]
+        if self._model is None:
+            raise ValueError("The attentions are not outputs of the ONNX graph, use the pytorch backend")
         if self.latest_image_tensor is None:
             raise ValueError('No step was ran yet. '
                              'No image to compute the activations, Try Running ')
@@ -191,7 +210,7 @@ class ETEAgent(object):
 
         sensor = np.swapaxes(sensor, 0, 1)
         sensor = np.transpose(sensor, (2, 1, 0))
-        sensor = torch.from_numpy(sensor / 255.0).type(torch.FloatTensor).cuda()
+        sensor = torch.from_numpy(sensor / 255.0).type(torch.FloatTensor).to(self._device)
         image_input = sensor.unsqueeze(0)
         self.latest_image_tensor = image_input
 
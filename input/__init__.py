@@ -1,4 +1,6 @@
 from .coil_dataset import CoILDataset
-from .coil_sampler import BatchSequenceSampler, RandomSampler, PreSplittedSampler
+from .coil_sampler import BatchSequenceSampler, RandomSampler, PreSplittedSampler, \
+    ShardedRandomSampler, ShardedPreSplittedSampler
 from .augmenter import Augmenter
-from .splitter import select_balancing_strategy
\ No newline at end of file
+from .splitter import select_balancing_strategy
+from .embedding_cache import EmbeddingCache, checkpoint_hash
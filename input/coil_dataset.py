@@ -24,6 +24,7 @@ from . import data_parser
 from configs import g_conf
 
 from coilutils.general import sort_nicely
+from coilutils.action_discretizer import ActionDiscretizer
 
 from cexp.cexp import CEXP
 from cexp.env.scenario_identification import identify_scenario
@@ -137,6 +138,11 @@ class CoILDataset(Dataset):
 
         self.batch_read_number = 0
 
+        # When an embedding cache is set, the frozen encoder embedding is returned
+        # instead of decoding the sensor data.
+        self.embedding_cache = None
+        self.action_discretizer = ActionDiscretizer()
+
     def __len__(self):
         return len(self.measurements)
 
@@ -165,6 +171,11 @@ class CoILDataset(Dataset):
                     pass
                     #print (measurements)
 
+            measurements['index'] = index
+            if self.embedding_cache is not None:
+                measurements['embedding'] = self.embedding_cache.lookup(index)
+                return measurements
+
             for sensor_name in self.sensor_data_names.keys():
                 if g_conf.ENCODER_MODEL_TYPE in ['forward', 'action_prediction', 'stdim', 'ETE_inverse_model'] \
                         and g_conf.PROCESS_NAME in ['train_encoder']:
@@ -721,43 +732,7 @@ class CoILDataset(Dataset):
         # here we have two frames' measurement, we pick up the latter one at time t+1
 
         if g_conf.ENCODER_MODEL_TYPE in ['forward', 'action_prediction', 'ETE_inverse_model']:
-            targets_twoframes_vec = []
-            for i in range(2):
-                targets_vec = []
-                for target_name in g_conf.TARGETS:
-                    target_c_f = torch.full(data[target_name][i].shape, 0)
-                    # for two classes, we take the first part as 0 and the rest 1
-                    if len(g_conf.ACTION_CLASS_RANGE[target_name]) == 1:
-                        target_c = torch.where(
-                            data[target_name][i] < g_conf.ACTION_CLASS_RANGE[target_name][0],
-                            torch.full(data[target_name][i].shape, 0),
-                            torch.full(data[target_name][i].shape, 1))
-                        targets_vec.append(target_c)
-
-                    else:
-                        for bin_id in range(len(g_conf.ACTION_CLASS_RANGE[target_name]) + 1):
-                            if bin_id == 0:
-                                continue
-
-                            elif bin_id == len(g_conf.ACTION_CLASS_RANGE[target_name]):
-                                target_c = torch.where(
-                                    data[target_name][i] >= g_conf.ACTION_CLASS_RANGE[target_name][-1],
-                                    torch.full(data[target_name][i].shape, bin_id),
-                                    torch.full(data[target_name][i].shape, 0))
-
-                            else:
-                                target_c_1 = torch.where(
-                                    data[target_name][i] >= g_conf.ACTION_CLASS_RANGE[target_name][bin_id - 1],
-                                    torch.full(data[target_name][i].shape, bin_id),
-                                    torch.full(data[target_name][i].shape, 0))
-                                target_c_2 = torch.where(
-                                    data[target_name][i] < g_conf.ACTION_CLASS_RANGE[target_name][bin_id],
-                                    torch.full(data[target_name][i].shape, bin_id),
-                                    torch.full(data[target_name][i].shape, 0))
-                                target_c = (target_c_1 == target_c_2).type(torch.FloatTensor) * bin_id
-
-                            target_c_f = target_c_f + target_c
-                        targets_vec.append(target_c_f)
-                targets_twoframes_vec.append(torch.cat(targets_vec, 1))
-
-            return targets_twoframes_vec
+            # The targets of each frame are discretized at once, as float class ids
+            return [self.action_discretizer(torch.cat([data[target_name][i] for target_name in g_conf.TARGETS],
+                                                      1)).float()
+                    for i in range(2)]
@@ -251,6 +251,76 @@ class LogitSplittedSampler(Sampler):
         return self.iterations_to_execute
 
 
+class ShardedRandomSampler(Sampler):
+    """ Deterministic and sharded version of the RandomSampler for data parallel training.
+
+        The keys of every global iteration are drawn from a generator seeded with the seed and
+        the iteration number, then each process takes its own slice of that global batch.
+        The union of the slices does not depend on the number of processes, so a run can be
+        resumed from a checkpoint written with a different world size.
+        g_conf.BATCH_SIZE is the batch of a single process.
+    """
+
+    def __init__(self, keys, executed_iterations, rank, world_size, seed=0):
+        self.keys = keys
+        self.rank = rank
+        self.world_size = world_size
+        self.seed = seed
+        self.start_iteration = int(executed_iterations) // g_conf.BATCH_SIZE
+        self.iterations_to_execute = max(g_conf.NUMBER_ITERATIONS - self.start_iteration, 0)
+
+    def _generator(self, iteration):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed * 1000003 + iteration)
+        return generator
+
+    def _global_batch(self, iteration):
+        generator = self._generator(iteration)
+        positions = torch.randint(len(self.keys), (g_conf.BATCH_SIZE * self.world_size,),
+                                  generator=generator)
+        return [self.keys[i] for i in positions.tolist()]
+
+    def __iter__(self):
+        for iteration in range(self.start_iteration, g_conf.NUMBER_ITERATIONS):
+            global_batch = self._global_batch(iteration)
+            for key in global_batch[self.rank * g_conf.BATCH_SIZE:(self.rank + 1) * g_conf.BATCH_SIZE]:
+                yield int(key)
+
+    def __len__(self):
+        return self.iterations_to_execute * g_conf.BATCH_SIZE
+
+
+class ShardedPreSplittedSampler(ShardedRandomSampler):
+    """ Deterministic and sharded version of the PreSplittedSampler for data parallel training.
+
+    """
+
+    def __init__(self, keys, executed_iterations, rank, world_size, seed=0, weights=None):
+        super(ShardedPreSplittedSampler, self).__init__(keys, executed_iterations, rank,
+                                                        world_size, seed)
+        self.rank_keys = get_rank(self.keys)
+        if self.rank_keys == 2:
+            if weights is None:
+                weights = [1.0 / float(len(self.keys))] * len(self.keys)
+            self.weights = torch.tensor(np.asarray(weights, dtype=np.float64))
+        elif self.rank_keys != 3:
+            raise ValueError("Keys have invalid rank")
+
+    def _global_batch(self, iteration):
+        generator = self._generator(iteration)
+        global_batch_size = g_conf.BATCH_SIZE * self.world_size
+        if self.rank_keys == 2:
+            idx = torch.multinomial(self.weights, global_batch_size, True, generator=generator).tolist()
+            splits = [self.keys[i] for i in idx]
+        else:
+            idx = torch.randint(len(self.keys), (global_batch_size,), generator=generator).tolist()
+            idy = torch.randint(len(self.keys[0]), (global_batch_size,), generator=generator).tolist()
+            splits = [self.keys[i][j] for i, j in zip(idx, idy)]
+
+        offsets = torch.rand(global_batch_size, generator=generator, dtype=torch.float64).tolist()
+        return [split[int(offset * len(split))] for split, offset in zip(splits, offsets)]
+
+
 class BatchSequenceSampler(object):
     r"""Wraps another sampler to yield a mini-batch of indices taking a certain sequence size
 
@@ -0,0 +1,160 @@
+import os
+import hashlib
+import numpy as np
+
+import torch
+
+from configs import g_conf
+from network.inference import slim_inference
+
+
+def checkpoint_hash(checkpoint_path, block_size=1 << 20):
+    """
+        Hash of the contents of a checkpoint file. It is used as key for everything that is
+        computed out of that checkpoint, so a retrained encoder never reuses stale data.
+    Args:
+        checkpoint_path: the full path to the .pth file
+        block_size: the number of bytes read at a time
+
+    Returns:
+        A short hexadecimal string
+
+    """
+    sha = hashlib.sha1()
+    with open(checkpoint_path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha.update(block)
+
+    return sha.hexdigest()[:16]
+
+
+def _split_in_batches(indices, batch_size):
+    """
+        Split the indices in batches of at most batch_size. A trailing batch of a single
+        element is avoided since the extract functions of the dataset squeeze the batch
+        dimension away on that case.
+    """
+    batches = [indices[i:i + batch_size] for i in range(0, len(indices), batch_size)]
+    if len(batches) > 1 and len(batches[-1]) == 1:
+        batches[-1] = batches[-2][-1:] + batches[-1]
+        batches[-2] = batches[-2][:-1]
+    elif len(batches) == 1 and len(batches[0]) == 1:
+        batches[0] = batches[0] * 2
+
+    return batches
+
+
+class EmbeddingCache(object):
+    """
+        Memory mapped float16 store with the embedding a frozen encoder produces for every frame
+        of a dataset. The store lives in _preloads/embeddings and it is keyed by the dataset
+        preload name and the hash of the encoder checkpoint.
+        A second array marks which frames were already computed, so an interrupted fill
+        continues where it stopped.
+    """
+
+    def __init__(self, preload_name, encoder_hash, number_of_frames):
+
+        folder = os.path.join('_preloads', 'embeddings')
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+
+        self.name = preload_name + '_' + encoder_hash
+        self.number_of_frames = number_of_frames
+        self._embeddings_path = os.path.join(folder, self.name + '.npy')
+        self._valid_path = os.path.join(folder, self.name + '_valid.npy')
+        self._embeddings = None
+        # The frames stored since the last flush, they are only marked as valid by it
+        self._pending = []
+
+        if os.path.exists(self._valid_path) and os.path.exists(self._embeddings_path):
+            self._valid = np.lib.format.open_memmap(self._valid_path, mode='r+')
+            self._embeddings = np.lib.format.open_memmap(self._embeddings_path, mode='r+')
+            if len(self._valid) != number_of_frames or len(self._embeddings) != number_of_frames:
+                raise RuntimeError("The embedding cache %s does not match the dataset size" % self.name)
+        else:
+            self._valid = np.lib.format.open_memmap(self._valid_path, mode='w+', dtype=np.uint8,
+                                                    shape=(number_of_frames,))
+
+    def __len__(self):
+        return self.number_of_frames
+
+    def missing_indices(self):
+        return np.where(self._valid == 0)[0].tolist()
+
+    def is_complete(self):
+        return self._embeddings is not None and bool(np.all(self._valid))
+
+    def lookup(self, index):
+        """
+            Returns the embedding of the frame at index as a float32 tensor.
+        """
+        if self._embeddings is None or not self._valid[index]:
+            raise KeyError("Frame %d is not on the embedding cache %s" % (index, self.name))
+
+        return torch.from_numpy(np.asarray(self._embeddings[index], dtype=np.float32))
+
+    def store(self, indices, embeddings):
+        """
+            Store a batch of embeddings, their frames are marked as valid on the next flush.
+        Args:
+            indices: numpy array with the frame indices
+            embeddings: numpy array [len(indices), embedding size]
+        """
+        if self._embeddings is None:
+            self._embeddings = np.lib.format.open_memmap(self._embeddings_path, mode='w+',
+                                                         dtype=np.float16,
+                                                         shape=(self.number_of_frames,
+                                                                embeddings.shape[1]))
+        self._embeddings[indices] = embeddings.astype(np.float16)
+        self._pending.append(np.asarray(indices))
+
+    def flush(self):
+        """
+            Write the stored embeddings and then mark their frames as valid. The embeddings file
+            is synced to disk before any valid mark is written, so a crash never leaves a frame
+            marked as valid with garbage on it.
+        """
+        if self._embeddings is not None:
+            self._embeddings.flush()
+            fd = os.open(self._embeddings_path, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        if self._pending:
+            self._valid[np.concatenate(self._pending)] = 1
+            self._pending = []
+        self._valid.flush()
+
+    def fill(self, encoder_model, dataset, number_of_workers):
+        """
+            Run the encoder once over every frame that is not yet on the cache.
+        Args:
+            encoder_model: the frozen encoder, already on the device the embeddings are computed on
+            dataset: the CoILDataset the cache refers to. It should not have the cache set.
+            number_of_workers: the number of threads used for data loading
+
+        """
+        missing = self.missing_indices()
+        if len(missing) == 0:
+            return
+
+        print("Computing the encoder embeddings of ", len(missing), " frames for ", self.name)
+        device = next(encoder_model.parameters()).device
+        data_loader = torch.utils.data.DataLoader(dataset,
+                                                  batch_sampler=_split_in_batches(missing,
+                                                                                  g_conf.BATCH_SIZE),
+                                                  num_workers=number_of_workers,
+                                                  pin_memory=device.type == 'cuda')
+        encoder_model.eval()
+        with slim_inference(encoder_model):
+            for count, data in enumerate(data_loader):
+                e, _ = encoder_model.forward_encoder(data['rgb'].to(device),
+                                                     dataset.extract_inputs(data).to(device),
+                                                     torch.squeeze(dataset.extract_commands(data).to(device)))
+                self.store(data['index'].view(-1).numpy(), e.cpu().numpy())
+                if count % 100 == 0:
+                    self.flush()
+
+        self.flush()
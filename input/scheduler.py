@@ -1,4 +1,7 @@
-from imgaug import augmenters as iaa
+from coilutils.lazy_import import lazy_import
+
+# Imported with the first augmentation, the processes without augmentation never load it
+iaa = lazy_import('imgaug.augmenters')
 
 
 def medium(image_iteration):
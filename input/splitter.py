@@ -8,7 +8,7 @@ from configs import g_conf
 from logger import coil_logger
 from coilutils.general import softmax
 
-from .coil_sampler import PreSplittedSampler, RandomSampler
+from .coil_sampler import PreSplittedSampler, RandomSampler, ShardedPreSplittedSampler, ShardedRandomSampler
 
 
 def order_sequence(steerings, keys_sequence):
@@ -373,7 +373,7 @@ def get_inverse_freq_weights(keys, dataset_size):
 
 # TODO: for now is not possible to maybe balance just labels or just steering.
 # TODO: Is either all or nothing
-def select_balancing_strategy(dataset, iteration, number_of_workers):
+def select_balancing_strategy(dataset, iteration, number_of_workers, rank=0, world_size=1):
 
     # Creates the sampler, this part is responsible for managing the keys. It divides
     # all keys depending on the measurements and produces a set of keys for each bach.
@@ -403,7 +403,14 @@ def select_balancing_strategy(dataset, iteration, number_of_workers):
                                                - g_conf.NUMBER_IMAGES_SEQUENCE)
         else:
             weights = params['weights']
-        sampler = PreSplittedSampler(keys_splitted, iteration * g_conf.BATCH_SIZE, weights)
+        if world_size > 1:
+            sampler = ShardedPreSplittedSampler(keys_splitted, iteration * g_conf.BATCH_SIZE, rank,
+                                                world_size, g_conf.MAGICAL_SEED, weights)
+        else:
+            sampler = PreSplittedSampler(keys_splitted, iteration * g_conf.BATCH_SIZE, weights)
+    elif world_size > 1:
+        sampler = ShardedRandomSampler(keys, iteration * g_conf.BATCH_SIZE, rank, world_size,
+                                       g_conf.MAGICAL_SEED)
     else:
         sampler = RandomSampler(keys, iteration * g_conf.BATCH_SIZE)
 
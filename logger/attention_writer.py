@@ -0,0 +1,138 @@
+import os
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from coilutils.lazy_import import lazy_import, use_agg_backend
+
+# Only used to encode the images and to build the colormap
+Image = lazy_import('PIL.Image')
+plt = lazy_import('matplotlib.pyplot', on_import=use_agg_backend)
+
+
+def attention_maps(feature_maps, size):
+    """
+        The attention maps of a batch: the mean of the absolute activations over the channels,
+        resized bilinearly and scaled to [0, 255] per image, as the scipy imresize bytescale did.
+        Everything is computed on the device of the feature maps.
+    Args:
+        feature_maps: a list with the [mini_batch, channels, h, w] feature map of each layer
+        size: the (height, width) of the maps
+
+    Returns:
+        An uint8 tensor [len(feature_maps), mini_batch, height, width]
+    """
+    maps = []
+    for y in feature_maps:
+        att = torch.abs(y).float().mean(1, keepdim=True)
+        att = F.interpolate(att, size=tuple(size), mode='bilinear', align_corners=False)[:, 0]
+        minimum = att.flatten(1).min(1)[0].view(-1, 1, 1)
+        maximum = att.flatten(1).max(1)[0].view(-1, 1, 1)
+        att = (att - minimum) * (255.0 / (maximum - minimum).clamp(min=1e-12))
+        maps.append((att + 0.5).clamp(0, 255).to(torch.uint8))
+
+    return torch.stack(maps)
+
+
+class AttentionWriter(object):
+    """
+        Writes the attention maps of the intermediate layers, and optionally the input images,
+        as png files: <folder>/layer<l>/<name>.png and <folder>/<images_folder>/<name>.png.
+
+        The maps of a whole batch are computed with a few tensor operations and copied to the
+        host once. The colormap and the png encoding run on a pool of threads, so the caller
+        only waits when too many images are pending. Call close() to wait for all of them.
+    """
+
+    def __init__(self, folder_name, layers=(0, 1, 2), size=(352, 800), images_folder='images',
+                 name_format='{iteration}_{index}', every=1, max_images=None, number_of_workers=4,
+                 max_pending=512, colormap='inferno'):
+        """
+        Args:
+            folder_name: the folder where the maps are written
+            layers: the indices of the feature maps written
+            size: the (height, width) of the written maps
+            images_folder: the sub folder of the input images
+            name_format: the file name of each image, formatted with its iteration and its
+                index on the batch
+            every: only the batches of one of every that many writes are written
+            max_images: the maximum number of images written, all of them if None
+            number_of_workers: the threads encoding and writing the files
+            max_pending: the images queued before a write waits for the workers
+            colormap: the matplotlib colormap of the maps
+        """
+        self.folder_name = folder_name
+        self.layers = list(layers)
+        self.size = size
+        self.images_folder = images_folder
+        self.name_format = name_format
+        self.every = max(every, 1)
+        self.max_images = max_images
+        self.max_pending = max_pending
+        self.colormap = colormap
+        self.number_of_writes = 0
+        self.number_of_images = 0
+
+        for layer in self.layers:
+            os.makedirs(os.path.join(folder_name, 'layer' + str(layer)), exist_ok=True)
+        self._lut = None
+        self._pending = collections.deque()
+        self._executor = ThreadPoolExecutor(max_workers=number_of_workers)
+
+    def _colormap_lut(self):
+        if self._lut is None:
+            lut = plt.get_cmap(self.colormap)(np.arange(256))
+            self._lut = np.round(lut * 255).astype(np.uint8)
+        return self._lut
+
+    def _write_image(self, name, maps, image):
+        if image is not None:
+            Image.fromarray(image).save(os.path.join(self.folder_name, self.images_folder, name))
+        for layer, att in zip(self.layers, maps):
+            Image.fromarray(self._lut[att]).save(os.path.join(self.folder_name, 'layer' + str(layer), name))
+
+    def write(self, iteration, all_layers, images=None):
+        """
+            Queue the attention maps of a batch.
+        Args:
+            iteration: the iteration of the batch, used on the file names
+            all_layers: the intermediate feature maps returned by the encoder
+            images: the [mini_batch, 3, h, w] input images in [0, 1], written as well if given
+        """
+        self.number_of_writes += 1
+        if (self.number_of_writes - 1) % self.every != 0:
+            return
+        mini_batch = all_layers[self.layers[0]].size(0)
+        if self.max_images is not None:
+            mini_batch = min(mini_batch, self.max_images - self.number_of_images)
+        if mini_batch <= 0:
+            return
+        self.number_of_images += mini_batch
+
+        self._colormap_lut()
+        maps = attention_maps([all_layers[layer][:mini_batch] for layer in self.layers], self.size)
+        maps = maps.cpu().numpy()
+        if images is not None:
+            os.makedirs(os.path.join(self.folder_name, self.images_folder), exist_ok=True)
+            # The same conversion as torchvision save_image
+            images = images[:mini_batch].mul(255).add_(0.5).clamp_(0, 255).permute(0, 2, 3, 1)
+            images = images.to('cpu', torch.uint8).numpy()
+            if images.shape[-1] == 1:
+                images = images[..., 0]
+
+        for index in range(mini_batch):
+            name = self.name_format.format(iteration=iteration, index=index) + '.png'
+            self._pending.append(self._executor.submit(self._write_image, name, maps[:, index],
+                                                       None if images is None else images[index]))
+        while len(self._pending) > self.max_pending:
+            # Raises the errors of the workers
+            self._pending.popleft().result()
+
+    def close(self):
+        """ Wait until every queued image is written. """
+        while self._pending:
+            self._pending.popleft().result()
+        self._executor.shutdown(wait=True)
@@ -5,6 +5,7 @@ import numpy as np
 
 from .json_formatter import filelogger, closeFileLogger
 from .tensorboard_logger import Logger
+from .metrics_store import MetricsStore
 
 
 g_logger = filelogger('None')
@@ -17,6 +18,17 @@ PROCESS_NAME = ''
 LOG_FREQUENCY = 1
 IMAGE_LOG_FREQUENCY = 1
 tl = ''
+# A muted logger does not write anything, used by the non main processes of a distributed run
+MUTED = False
+# The phase of the last message of this process, an 'Error' once the process failed
+LAST_PHASE = None
+# The metrics store of each experiments batch, opened on the first write of this process
+_metrics_stores = {}
+
+
+def mute():
+    global MUTED
+    MUTED = True
 
 
 def create_log(exp_batch_name, exp_name, process_name, log_frequency=1, image_log_frequency=15):
@@ -40,6 +52,11 @@ def create_log(exp_batch_name, exp_name, process_name, log_frequency=1, image_lo
     # Hardcoded root path
     root_path = "_logs"
 
+    if MUTED:
+        EXPERIMENT_BATCH_NAME = exp_batch_name
+        EXPERIMENT_NAME = exp_name
+        PROCESS_NAME = process_name
+        return
 
     dir_name = os.path.join(root_path, exp_batch_name, exp_name)
     full_name = os.path.join(dir_name, process_name)
@@ -59,6 +76,35 @@ def create_log(exp_batch_name, exp_name, process_name, log_frequency=1, image_lo
     IMAGE_LOG_FREQUENCY = image_log_frequency
     tl = Logger(os.path.join(root_path, exp_batch_name, exp_name, 'tensorboard_logs_'+process_name))
 
+def get_log_state():
+    """
+    Returns the module level logging state, so a process serving several experiments
+    can alternate between their logs with set_log_state.
+    """
+    return {'g_logger': g_logger, 'EXPERIMENT_BATCH_NAME': EXPERIMENT_BATCH_NAME,
+            'EXPERIMENT_NAME': EXPERIMENT_NAME, 'PROCESS_NAME': PROCESS_NAME,
+            'LOG_FREQUENCY': LOG_FREQUENCY, 'IMAGE_LOG_FREQUENCY': IMAGE_LOG_FREQUENCY,
+            'tl': tl}
+
+
+def set_log_state(state):
+    global g_logger
+    global EXPERIMENT_BATCH_NAME
+    global EXPERIMENT_NAME
+    global PROCESS_NAME
+    global LOG_FREQUENCY
+    global IMAGE_LOG_FREQUENCY
+    global tl
+
+    g_logger = state['g_logger']
+    EXPERIMENT_BATCH_NAME = state['EXPERIMENT_BATCH_NAME']
+    EXPERIMENT_NAME = state['EXPERIMENT_NAME']
+    PROCESS_NAME = state['PROCESS_NAME']
+    LOG_FREQUENCY = state['LOG_FREQUENCY']
+    IMAGE_LOG_FREQUENCY = state['IMAGE_LOG_FREQUENCY']
+    tl = state['tl']
+
+
 def close():
 
     full_path_name = os.path.join('_logs', EXPERIMENT_BATCH_NAME,
@@ -78,6 +124,13 @@ def add_message(phase, message, iteration=None):
 
     """
 
+    global LAST_PHASE
+    if phase != 'Profile':
+        LAST_PHASE = phase
+
+    if MUTED:
+        return
+
     if phase == 'Iterating' and iteration is None:
         raise ValueError(" Iterating messages should have the iteration/checkpoint.")
 
@@ -130,6 +183,9 @@ def write_on_csv(checkpoint_name, output):
     Returns:
 
     """
+    if MUTED:
+        return
+
     root_path = "_logs"
 
     full_path_name = os.path.join(root_path, EXPERIMENT_BATCH_NAME,
@@ -144,6 +200,33 @@ def write_on_csv(checkpoint_name, output):
         f.write("\n")
 
 
+
+def write_rows_on_csv(checkpoint_name, rows):
+    """
+    The same as write_on_csv for several rows, the file is opened once.
+    Args
+        checkpoint_name: the name of the checkpoint being writen
+        rows: the list of outputs being written on the file, one per row
+
+    Returns:
+
+    """
+    if MUTED:
+        return
+
+    root_path = "_logs"
+
+    full_path_name = os.path.join(root_path, EXPERIMENT_BATCH_NAME,
+                                  EXPERIMENT_NAME, PROCESS_NAME + '_csv')
+
+    file_name = os.path.join(full_path_name, str(checkpoint_name) + '.csv')
+
+    with open(file_name, 'a+') as f:
+        for output in rows:
+            f.write(','.join('%f' % value for value in output))
+            f.write("\n")
+
+
 def write_on_error_csv(error_file_name, output):
     """
     Keep the errors writen to quickly recover
@@ -155,6 +238,9 @@ def write_on_error_csv(error_file_name, output):
     Returns:
 
     """
+    if MUTED:
+        return
+
     root_path = "_logs"
 
     full_path_name = os.path.join(root_path, EXPERIMENT_BATCH_NAME,
@@ -180,6 +266,9 @@ def write_stop(validation_dataset, checkpoint):
     Returns:
 
     """
+    if MUTED:
+        return
+
     root_path = "_logs"
 
     full_path_name = os.path.join(root_path, EXPERIMENT_BATCH_NAME,
@@ -199,6 +288,9 @@ def erase_csv(checkpoint_name):
     Returns:
 
     """
+    if MUTED:
+        return
+
     root_path = "_logs"
 
     full_path_name = os.path.join(root_path, EXPERIMENT_BATCH_NAME,
@@ -206,7 +298,9 @@ def erase_csv(checkpoint_name):
 
     file_name = os.path.join(full_path_name, str(checkpoint_name) + '.csv')
 
-    os.remove(file_name)
+    # The outputs of a checkpoint are only written once it is validated
+    if os.path.exists(file_name):
+        os.remove(file_name)
 
 
 def recover_loss_window(dataset_name, iteration):
@@ -218,6 +312,8 @@ def recover_loss_window(dataset_name, iteration):
     if not os.path.exists(file_name):
         return []
     recovered_list = list(np.loadtxt(file_name))[0:iteration]
+    if MUTED:
+        return recovered_list
 
     # Now we need to rewrite on top of the recovered list, so everything syncs
 
@@ -230,6 +326,25 @@ def recover_loss_window(dataset_name, iteration):
 
 
 
+def add_metrics(step, metrics):
+    """
+    Append the summary results of the current process, e.g. of a validated checkpoint, to the
+    metrics store of its batch, that the printer and the exporter query.
+    Args
+        step: the iteration or checkpoint of the results
+        metrics: a dictionary from the name of each result to its value
+
+    Returns:
+
+    """
+    if MUTED:
+        return
+
+    if EXPERIMENT_BATCH_NAME not in _metrics_stores:
+        _metrics_stores[EXPERIMENT_BATCH_NAME] = MetricsStore(EXPERIMENT_BATCH_NAME)
+    _metrics_stores[EXPERIMENT_BATCH_NAME].append(EXPERIMENT_NAME, PROCESS_NAME, step, metrics)
+
+
 def add_scalar(tag, value, iteration=None, force_writing=False):
 
     """
@@ -239,6 +354,11 @@ def add_scalar(tag, value, iteration=None, force_writing=False):
     # TODO: The problem is that we dont want that in a main
     """
 
+    if MUTED:
+        return
+
+    # The per iteration scalars only go to tensorboard, a transaction on the metrics store
+    # of the batch for each of them would stall the training loops
     if iteration is not None:
         if iteration % LOG_FREQUENCY == 0 or force_writing:
             tl.scalar_summary(tag, value, iteration + 1)
@@ -255,6 +375,8 @@ def add_scalar(tag, value, iteration=None, force_writing=False):
 def add_image(tag, images, iteration=None):
     # Add the image to a log, the monitorer is the module responsible by checking this
     # and eventually put some of the images to tensorboard.
+    if MUTED:
+        return
 
 
     # TODO: change to sampling 10 images instead
@@ -0,0 +1,124 @@
+"""
+    The summary results of every experiment of a batch on a single SQLite database,
+    _logs/<exp_batch>/metrics.db, that the validation processes append to once per validated
+    checkpoint. A value is identified by its experiment, process, step and name, so the summaries of
+    all the experiments of a batch are a single indexed query instead of one csv or json log
+    read per experiment.
+"""
+import os
+import sqlite3
+import collections
+
+
+class MetricsStore(object):
+
+    def __init__(self, exp_batch, root_path='_logs', timeout=60.0):
+        """
+        Args:
+            exp_batch: the folder with the experiments
+            root_path: the folder of the logs
+            timeout: the seconds a write waits for the writes of the other processes
+        """
+        os.makedirs(os.path.join(root_path, exp_batch), exist_ok=True)
+        self.path = os.path.join(root_path, exp_batch, 'metrics.db')
+        self._connection = sqlite3.connect(self.path, timeout=timeout)
+        # Many processes append to the same database while the printer reads it
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.execute('CREATE TABLE IF NOT EXISTS metrics (experiment TEXT, process TEXT, '
+                                 'name TEXT, step INTEGER, value REAL, '
+                                 'PRIMARY KEY (process, name, experiment, step)) WITHOUT ROWID')
+        self._connection.commit()
+
+    def append(self, experiment, process, step, metrics):
+        """
+            Store the values of a step. A value already stored for the same step is replaced,
+            e.g. when a checkpoint is validated again.
+        Args:
+            metrics: a dictionary from the name of each metric to its value
+        """
+        with self._connection:
+            self._connection.executemany('INSERT OR REPLACE INTO metrics VALUES (?, ?, ?, ?, ?)',
+                                         [(experiment, process, name, int(step), float(value))
+                                          for name, value in metrics.items()])
+
+    def import_csv(self, experiment, process, csv_file, step_column='step'):
+        """
+            Store the rows of a summary csv written before the store existed.
+        """
+        with open(csv_file, 'r') as f:
+            header = [name.strip() for name in f.readline().split(',')]
+            for line in f:
+                if line.strip():
+                    row = dict(zip(header, [float(value) for value in line.split(',')]))
+                    self.append(experiment, process, row.pop(step_column), row)
+
+    def processes(self, pattern='%'):
+        """ The processes with stored values, filtered with a SQL LIKE pattern, e.g. 'drive_%'. """
+        return [row[0] for row in self._connection.execute(
+            'SELECT DISTINCT process FROM metrics WHERE process LIKE ? ORDER BY process', (pattern,))]
+
+    def columns(self, process, names, experiments=None):
+        """
+            The values of a process by experiment, as columns.
+
+        Args:
+            process: the process name, e.g. validation_<dataset>
+            names: the names of the metrics
+            experiments: the experiments read, all of them if None
+
+        Returns:
+            A dictionary from each experiment to a dictionary with the 'step' column and one
+            column per metric, ordered by step. A metric missing on a step is None.
+        """
+        query = 'SELECT experiment, step, name, value FROM metrics WHERE process = ? AND name IN (%s)' \
+                % ','.join('?' * len(names))
+        arguments = [process] + list(names)
+        if experiments is not None:
+            query += ' AND experiment IN (%s)' % ','.join('?' * len(experiments))
+            arguments += list(experiments)
+
+        rows = collections.defaultdict(dict)
+        for experiment, step, name, value in self._connection.execute(query, arguments):
+            rows[experiment].setdefault(step, {})[name] = value
+
+        columns = {}
+        for experiment, steps in rows.items():
+            ordered_steps = sorted(steps)
+            columns[experiment] = {'step': ordered_steps}
+            for name in names:
+                columns[experiment][name] = [steps[step].get(name) for step in ordered_steps]
+
+        return columns
+
+    def best(self, process, name, maximize=True, names=()):
+        """
+            The best step of each experiment of a process.
+
+        Args:
+            process: the process name
+            name: the metric that is maximized or minimized
+            names: the other metrics returned at the best step
+
+        Returns:
+            A dictionary from each experiment to a dictionary with the 'step', the metric and
+            the other names at that step.
+        """
+        # SQLite takes the bare step of the row where the MAX or MIN is
+        best = {experiment: {'step': step, name: value} for experiment, step, value in self._connection.execute(
+            'SELECT experiment, step, %s(value) FROM metrics WHERE process = ? AND name = ? GROUP BY experiment'
+            % ('MAX' if maximize else 'MIN'), (process, name))}
+        if names:
+            query = 'SELECT m.experiment, m.name, m.value FROM metrics m JOIN ' \
+                    '(SELECT experiment, step, %s(value) FROM metrics WHERE process = ? AND name = ? ' \
+                    'GROUP BY experiment) b ON m.experiment = b.experiment AND m.step = b.step ' \
+                    'WHERE m.process = ? AND m.name IN (%s)' % ('MAX' if maximize else 'MIN',
+                                                                ','.join('?' * len(names)))
+            for experiment, other_name, value in self._connection.execute(
+                    query, [process, name, process] + list(names)):
+                best[experiment][other_name] = value
+
+        return best
+
+    def close(self):
+        self._connection.close()
@@ -1,15 +1,18 @@
 import os
 import re
+import json
 import numpy as np
 
-from logger import json_formatter
 from configs import g_conf
 from coilutils.general import sort_nicely
 
 
 from .carla_metrics_parser import get_averaged_metrics
 from plotter.data_reading import read_summary_csv
-from cexp.benchmark import check_benchmarked_episodes_metric
+from coilutils.lazy_import import lazy_import
+
+# The benchmark client is only needed to monitor the driving processes
+benchmark = lazy_import('cexp.benchmark')
 # Check the log and also put it to tensorboard
 
 
@@ -21,7 +24,7 @@ def get_episode_number(json_filename, agent_checkpoint_name):
 
     #TODO take repetition into consideration
 
-    summary_benchmark = check_benchmarked_episodes_metric(json_filename, agent_checkpoint_name)
+    summary_benchmark = benchmark.check_benchmarked_episodes_metric(json_filename, agent_checkpoint_name)
 
 
     if not summary_benchmark:
@@ -37,7 +40,7 @@ def get_number_episodes_completed(json_filename, agent_checkpoint_name):
     :return:
     """
 
-    summary_benchmark = check_benchmarked_episodes_metric(json_filename, agent_checkpoint_name)
+    summary_benchmark = benchmark.check_benchmarked_episodes_metric(json_filename, agent_checkpoint_name)
 
     if not summary_benchmark:
         return 0
@@ -149,89 +152,156 @@ def get_latest_checkpoint(filename):
         raise ValueError("The process name is not producing checkpoints")
 
 
-def get_status(exp_batch, experiment, process_name):
-
+class StatusMonitor(object):
+    """
+        Follows the json logs of the processes. For each log it keeps the byte offset read so
+        far and the few records the status depends on, so a query only parses the lines
+        appended since the previous one, and none when the log did not grow. A log rewritten
+        by a restarted process is read again from its start.
     """
 
-    Args:
-        exp_batch: The experiment batch name
-        experiment: The experiment name.
+    def __init__(self):
+        self._logs = {}
+
+    def _update(self, log_file_path):
+        """
+            Parse the complete lines appended to a log.
+
+        Returns:
+            The state of the log: the last record, the latest iteration output, the latest
+            summary and if the log ends on a line still being written.
+        """
+        stat = os.stat(log_file_path)
+        state = self._logs.get(log_file_path)
+        if state is not None and stat.st_size == state['offset'] and state['inode'] == stat.st_ino:
+            return state
+
+        with open(log_file_path, 'rb') as f:
+            # The log was rewritten if it shrank or its first line changed
+            if state is None or state['inode'] != stat.st_ino or stat.st_size < state['offset'] \
+                    or not state['head'] or f.read(len(state['head'])) != state['head']:
+                f.seek(0)
+                state = {'inode': stat.st_ino, 'head': f.readline(256), 'offset': 0,
+                         'partial': False, 'number_of_records': 0, 'last': None, 'output': None, 'summary': ''}
+                self._logs[log_file_path] = state
+            f.seek(state['offset'])
+            lines = f.read(stat.st_size - state['offset']).split(b'\n')
 
-    Returns:
-        A status that is a vector with two fields
-        [ Status, Summary]
+        state['partial'] = len(lines[-1]) > 0
+        for line in lines[:-1]:
+            # A broken line raises a ValueError and is parsed again on the next query
+            record = json.loads(line.decode('utf-8'))
+            state['offset'] += len(line) + 1
+            # The profiling records do not change the status of the process
+            if 'Profile' in record:
+                continue
+            # As get_latest_output and get_summary, the first record is never an output
+            if state['number_of_records'] > 0 and 'Iterating' in record:
+                if 'Summary' in record['Iterating']:
+                    state['summary'] = record
+                elif 'Iteration' in record['Iterating'] or 'Checkpoint' in record['Iterating']:
+                    state['output'] = record
+            state['last'] = record
+            state['number_of_records'] += 1
 
-        Status is from the set = (Does Not Exist, Not Started, Loading, Iterating, Error, Finished)
-        Summary constains a string message summarizing what is happening on this phase.
+        return state
 
-        * Not existent
-        * To Run
-        * Running
-            * Loading - sumarize position ( Briefly)
-            * Iterating  - summarize
-        * Error ( Show the error)
-        * Finished ( Summarize)
+    def get_status(self, exp_batch, experiment, process_name):
+        """
+            The same status get_status returns.
+        """
+        # Configuration file path
+        config_file_path = os.path.join('configs', exp_batch, experiment + '.yaml')
 
-    """
+        # The path for log
+        log_file_path = os.path.join('_logs', exp_batch, experiment, process_name)
 
-    # Configuration file path
-    config_file_path = os.path.join('configs', exp_batch, experiment + '.yaml')
+        # First we check if the experiment exist
 
-    # The path for log
-    log_file_path = os.path.join('_logs', exp_batch, experiment, process_name)
+        if not os.path.exists(config_file_path):
 
-    # First we check if the experiment exist
+            return ['Does Not Exist', '']
 
-    if not os.path.exists(config_file_path):
+        # The experiment exist ! However, check if the log file exist.
 
-        return ['Does Not Exist', '']
+        if not os.path.exists(log_file_path):
 
-    # The experiment exist ! However, check if the log file exist.
+            return ['Not Started', '']
 
-    if not os.path.exists(log_file_path):
+        # Read the lines appended to the json file.
+        try:
+            state = self._update(log_file_path)
+        except ValueError:
+            return ['Loading', 'Writing Logs']
 
-        return ['Not Started', '']
+        except Exception:
+            import traceback
+            traceback.print_exc()
+            return ['Error', "Couldn't read the json"]
 
-    # Read the full json file.
-    try:
-        data = json_formatter.readJSONlog(open(log_file_path, 'r'))
-    except ValueError:
-        return ['Loading', 'Writing Logs']
+        if state['partial']:
+            return ['Loading', 'Writing Logs']
 
-    except Exception:
-        import traceback
-        traceback.print_exc()
-        return ['Error', "Couldn't read the json"]
+        last = state['last']
+        if last is None:
+            return ['Not Started', '']
 
-    if len(data) == 0:
-        return ['Not Started', '']
+        # Now check if the latest data is loading
+        if 'Loading' in last:
+            return ['Loading', '']
 
-    # Now check if the latest data is loading
-    if 'Loading' in data[-1]:
-        return ['Loading', '']
+        # Then we check if finished or is going on
 
-    # Then we check if finished or is going on
+        if 'Iterating' in last:
 
-    if 'Iterating' in data[-1]:
+            if 'validation' in process_name:
+                return ['Iterating', [state['output'], state['summary']]]
+            elif 'train' in process_name:
+                return ['Iterating', state['output']]
+            elif 'drive' in process_name:
+                return ['Iterating', state['output']]  # We in theory just return
+            else:
+                raise ValueError("Not Valid Experiment name")
 
-        if 'validation' in process_name:
-            return ['Iterating', [get_latest_output(data), get_summary(data)]]
-        elif 'train' in process_name:
-            return ['Iterating', get_latest_output(data)]
-        elif 'drive' in process_name:
-            return ['Iterating', get_latest_output(data)]  # We in theory just return
-        else:
-            raise ValueError("Not Valid Experiment name")
+        # TODO: there is the posibility of some race conditions on not having error as last
+
+        if 'Finished' in last:
+            return ['Finished', ' ']
+        if 'Error' in last:
+            return ['Error', last['Error']['Message']]
+
+        raise ValueError(" No valid status found")
 
-    # TODO: there is the posibility of some race conditions on not having error as last
 
-    if 'Finished' in data[-1]:
-        return ['Finished', ' ']
-    if 'Error' in data[-1]:
-        return ['Error', get_error_summary(data)]
+# Shared by the schedulers and the printer, that query the status of every process on each loop
+_status_monitor = StatusMonitor()
+
 
+def get_status(exp_batch, experiment, process_name):
+
+    """
+
+    Args:
+        exp_batch: The experiment batch name
+        experiment: The experiment name.
+
+    Returns:
+        A status that is a vector with two fields
+        [ Status, Summary]
 
-    raise ValueError(" No valid status found")
+        Status is from the set = (Does Not Exist, Not Started, Loading, Iterating, Error, Finished)
+        Summary constains a string message summarizing what is happening on this phase.
 
+        * Not existent
+        * To Run
+        * Running
+            * Loading - sumarize position ( Briefly)
+            * Iterating  - summarize
+        * Error ( Show the error)
+        * Finished ( Summarize)
 
+        Only the lines appended to the log since the previous call are read.
+
+    """
 
+    return _status_monitor.get_status(exp_batch, experiment, process_name)
@@ -3,9 +3,11 @@ import time
 import json
 
 from .monitorer import get_status, get_episode_number, get_number_episodes_completed
+from .metrics_store import MetricsStore
 from configs import g_conf, merge_with_yaml
 from configs.coil_global import get_names
 from coilutils.general import sort_nicely,  static_vars
+from coilutils.summary_cache import SummaryCache, file_signature
 
 from agents.tools.misc import vector
 
@@ -98,6 +100,25 @@ def print_drive_summary(json_filename,  agent_checkpoint_name, checkpoint):
         return
 
 
+def get_cached_names(exp_batch):
+    """
+        The generated name of each experiment of a folder, as get_names. The yaml files are
+        only merged again when one of them changed, the names are cached on
+        _logs/<exp_batch>/.names_cache.pkl.
+    """
+    folder = os.path.join('configs', exp_batch)
+    signature = file_signature([os.path.join(folder, file_name) for file_name in sorted(os.listdir(folder))])
+    cache_folder = os.path.join('_logs', exp_batch)
+    cache = SummaryCache(os.path.join(cache_folder, '.names_cache.pkl') if os.path.isdir(cache_folder) else None)
+    names_list = cache.get(exp_batch, signature)
+    if names_list is None:
+        names_list = get_names(exp_batch)
+        cache.put(exp_batch, signature, names_list)
+        cache.save()
+
+    return names_list
+
+
 def plot_folder_summaries(exp_batch, train, validation_datasets, drive_environments, verbose=False):
     """
         Main plotting function for the folder mode.
@@ -131,7 +152,13 @@ def plot_folder_summaries(exp_batch, train, validation_datasets, drive_environme
 
     experiments_list = [experiment.split('.')[-2] for experiment in experiments_list]
 
-    names_list = get_names(exp_batch)
+    # The best validated checkpoint of every experiment, a single query per dataset
+    store = MetricsStore(exp_batch)
+    best_validations = {process: store.best(process, 'MAE_relative_angle', maximize=False)
+                        for process in process_names if 'validation' in process}
+    store.close()
+
+    names_list = get_cached_names(exp_batch)
     sorted_keys = sorted(range(len(names_list)),
                          key=lambda k: names_list[experiments_list[k] + '.yaml'])
 
@@ -142,9 +169,11 @@ def plot_folder_summaries(exp_batch, train, validation_datasets, drive_environme
         if experiment == '':
             raise ValueError("Empty Experiment on List")
 
-        g_conf.immutable(False)
+        # Only the drive summaries read the configuration of the experiment
+        if drive_environments:
+            g_conf.immutable(False)
 
-        merge_with_yaml(os.path.join('configs', exp_batch, experiment + '.yaml'))
+            merge_with_yaml(os.path.join('configs', exp_batch, experiment + '.yaml'))
 
         print(BOLD + experiment + ' : ' + generated_name + END)
 
@@ -202,15 +231,17 @@ def plot_folder_summaries(exp_batch, train, validation_datasets, drive_environme
 
                     print_drive_summary(drive_files[process], agent_checkpoint_name, checkpoint)
 
+            if 'validation' in process and experiment in best_validations[process]:
+                best = best_validations[process][experiment]
+                print('        BEST MAE: ', LIGHT_GREEN + UNDERLINE + str(best['MAE_relative_angle']) + END,
+                      ' Checkpoint: ', BLUE + UNDERLINE + str(best['step']) + END)
+
 
 def print_folder_process_names(exp_batch):
     experiments_list = os.listdir(os.path.join('configs', exp_batch))
     sort_nicely(experiments_list)
 
+    names_list = get_cached_names(exp_batch)
     for experiment in experiments_list:
         if '.yaml' in experiment:
-            g_conf.immutable(False)
-
-            merge_with_yaml(os.path.join('configs', exp_batch, experiment))
-
-            print(experiment.split('.')[-2] + ': ' + g_conf.EXPERIMENT_GENERATED_NAME)
+            print(experiment.split('.')[-2] + ': ' + names_list[experiment])
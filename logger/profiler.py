@@ -0,0 +1,119 @@
+import time
+import collections
+import numpy as np
+
+import torch
+
+from . import coil_logger
+
+
+class StageProfiler(object):
+    """
+        Wall clock timers for the stages of a training iteration.
+
+        The time of a stage is the time since the previous call to toc (or to start), so the
+        training loop only needs a toc after each stage. The GPU is synchronized before reading
+        the clock, otherwise asynchronous kernels are charged to whatever stage syncs next.
+        When the profiler is disabled every call returns immediately.
+
+        Rolling percentiles over the last `window` iterations are written on the coil_logger
+        json log as 'Profile' messages every `log_frequency` iterations.
+    """
+
+    def __init__(self, enabled=False, log_frequency=100, window=1000):
+        self.enabled = enabled
+        self.log_frequency = log_frequency
+        self._window = window
+        self._synchronize = enabled and torch.cuda.is_available()
+        self._times = collections.OrderedDict()
+        self._totals = collections.OrderedDict()
+        self._start = None
+        self._last = None
+        self._samples = 0
+        self._iterations = 0
+
+    def start(self):
+        if not self.enabled:
+            return
+        self._start = time.time()
+        self._last = self._start
+
+    def toc(self, stage):
+        """
+            Close the given stage, charging it with the time since the previous toc.
+        """
+        if not self.enabled:
+            return
+        if self._synchronize:
+            torch.cuda.synchronize()
+        now = time.time()
+        if stage not in self._times:
+            self._times[stage] = collections.deque(maxlen=self._window)
+            self._totals[stage] = 0.0
+        self._times[stage].append(now - self._last)
+        self._totals[stage] += now - self._last
+        self._last = now
+
+    def end_iteration(self, iteration, batch_size):
+        """
+            Count the samples of this iteration and log the rolling statistics when it is time.
+        """
+        if not self.enabled:
+            return
+        self._iterations += 1
+        self._samples += batch_size
+        if iteration % self.log_frequency == 0:
+            coil_logger.add_message('Profile', {'Iteration': iteration,
+                                                'Stages': self.percentiles(),
+                                                'Samples/s': self.samples_per_second()})
+            # The logging of the profile itself is not charged to the next stage
+            self._last = time.time()
+
+    def samples_per_second(self):
+        if not self.enabled or self._start is None or self._last == self._start:
+            return 0.0
+        return self._samples / (self._last - self._start)
+
+    def percentiles(self):
+        """
+            Returns the mean and the 50th, 90th and 99th percentiles of each stage, in milliseconds,
+            over the rolling window.
+        """
+        stages = collections.OrderedDict()
+        for stage, times in self._times.items():
+            times_ms = np.asarray(times) * 1000.0
+            p50, p90, p99 = np.percentile(times_ms, [50, 90, 99])
+            stages[stage] = {'mean': float(np.mean(times_ms)), 'p50': float(p50),
+                             'p90': float(p90), 'p99': float(p99)}
+        return stages
+
+    def summary(self):
+        """
+            Returns a printable table with the time spent on each stage during the whole run,
+            the rolling percentiles and the throughput.
+        """
+        if not self.enabled:
+            return ''
+        total_time = sum(self._totals.values())
+        lines = ['{:<12} {:>10} {:>10} {:>10} {:>10} {:>12} {:>8}'.format(
+            'Stage', 'mean(ms)', 'p50(ms)', 'p90(ms)', 'p99(ms)', 'total(s)', 'share')]
+        for stage, statistics in self.percentiles().items():
+            lines.append('{:<12} {:>10.2f} {:>10.2f} {:>10.2f} {:>10.2f} {:>12.1f} {:>7.1f}%'.format(
+                stage, statistics['mean'], statistics['p50'], statistics['p90'], statistics['p99'],
+                self._totals[stage], 100.0 * self._totals[stage] / max(total_time, 1e-9)))
+        lines.append('{} iterations, {} samples, {:.1f} samples/s'.format(
+            self._iterations, self._samples, self.samples_per_second()))
+
+        return '\n'.join(lines)
+
+    def finish(self):
+        """
+            Print the summary table and write the final statistics on the log.
+        """
+        if not self.enabled:
+            return
+        print(self.summary())
+        coil_logger.add_message('Profile', {'Summary': {
+            'Stages': self.percentiles(),
+            'TotalSeconds': dict(self._totals),
+            'Samples/s': self.samples_per_second()}})
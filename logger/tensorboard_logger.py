@@ -1,9 +1,13 @@
 
 
 # Code referenced from https://gist.github.com/gyglim/1f8dfb1b5c82627ae3efcfbbadb9f514
-import tensorflow as tf
 import numpy as np
-import scipy.misc
+
+from coilutils.lazy_import import lazy_import
+
+# Only imported when the first summary is written
+tf = lazy_import('tensorflow')
+misc = lazy_import('scipy.misc')
 
 try:
     from StringIO import StringIO  # Python 2.7
@@ -18,7 +22,15 @@ class Logger(object):
         #from datetime import datetime
         #now = datetime.now()
         #log_dir = log_dir + now.strftime("%Y%m%d-%H%M%S")
-        self.writer = tf.summary.FileWriter(log_dir)
+        self.log_dir = log_dir
+        self._writer = None
+
+    @property
+    def writer(self):
+        """The summary writer, created with the first summary so tensorflow is not loaded before."""
+        if self._writer is None:
+            self._writer = tf.summary.FileWriter(self.log_dir)
+        return self._writer
 
     def scalar_summary(self, tag, value, step):
         """Log a scalar variable."""
@@ -35,7 +47,7 @@ class Logger(object):
                 s = StringIO()
             except:
                 s = BytesIO()
-            scipy.misc.toimage(img).save(s, format="png")
+            misc.toimage(img).save(s, format="png")
 
             # Create an Image object
             img_sum = tf.Summary.Image(encoded_image_string=s.getvalue(),
@@ -1,6 +1,7 @@
 import argparse
 
-from coil_core import execute_train, execute_validation, execute_train_encoder
+from coil_core import execute_train, execute_validation, execute_train_encoder, execute_train_multi, \
+    execute_train_distributed, execute_train_distill, execute_validation_sharded, execute_scheduled
 from coilutils.general import create_log_folder
 
 # You could send the module to be executed and they could have the same interface.
@@ -17,7 +18,8 @@ if __name__ == '__main__':
         '--gpus',
         nargs='+',
         dest='gpus',
-        type=str
+        type=str,
+        help='The gpu ids used, or cpu to run the train, train_encoder and validation modes on the CPU'
     )
     argparser.add_argument(
         '-f',
@@ -29,6 +31,13 @@ if __name__ == '__main__':
         '--exp',
         type=str
     )
+    argparser.add_argument(
+        '--exps',
+        nargs='+',
+        dest='exps',
+        type=str,
+        help='The exp aliases trained together sharing the data pipeline on train_multi'
+    )
     argparser.add_argument(
         '-encoder-f',
         '--encoder-folder',
@@ -52,30 +61,51 @@ if __name__ == '__main__':
         type=int,
         help='The pre-trained encoder model you want to use'
     )
+    argparser.add_argument(
+        '--world-size',
+        default=1,
+        dest='world_size',
+        type=int,
+        help='The number of data parallel processes for train and train_encoder, or of shards for validation'
+    )
     argparser.add_argument(
         '-vj', '--val-json',
         dest='val_json',
         help=' Path to the VALIDATION json file',
         default=None)
+    argparser.add_argument(
+        '--val-jsons',
+        nargs='+',
+        dest='val_jsons',
+        default=[],
+        help='The VALIDATION json files of the scheduled mode, each experiment is validated on all of them')
 
     args = argparser.parse_args()
 
-    # Check if the vector of GPUs passed are valid.
+    # Check if the vector of GPUs passed are valid, 'cpu' runs on the CPU.
     for gpu in args.gpus:
+        if gpu == 'cpu':
+            continue
         try:
             int(gpu)
         except ValueError:  # Reraise a meaningful error.
-            raise ValueError("GPU is not a valid int number")
+            raise ValueError("GPU is not a valid int number or cpu")
 
     # There are two modes of execution
     if args.single_process is not None:
-        if args.single_process in ['train', 'validation']:
+        if args.single_process in ['train', 'validation', 'train_multi', 'scheduled']:
             # Check if the mandatory folder argument is passed
             if args.folder is None:
                 raise ValueError("You should set a folder name where the experiments are placed")
             # This is the folder creation of the logs
             create_log_folder(args.folder)
-            if args.exp is None:
+            if args.single_process == 'train_multi':
+                if args.exps is None or len(args.exps) < 2:
+                    raise ValueError("You should set at least two exp aliases with --exps")
+            elif args.single_process == 'scheduled':
+                if args.exps is None:
+                    raise ValueError("You should set the exp aliases with --exps")
+            elif args.exp is None:
                 raise ValueError("You should set the exp alias")
             # The definition of pre-trained encoder model used for training affordances
             if args.encoder_checkpoint and args.encoder_folder and args.encoder_exp:
@@ -89,12 +119,27 @@ if __name__ == '__main__':
                 raise ValueError(
                     "You should set all three arugments for using encoder: --encoder-folder, --encoder-exp and --encoder-checkpoint")
 
-            if args.single_process == 'train':
+            if args.single_process == 'train' and args.world_size > 1:
+                execute_train_distributed(gpus=args.gpus, exp_batch=args.folder, exp_alias=args.exp,
+                                          world_size=args.world_size, process_type='train',
+                                          suppress_output=False, encoder_params=encoder_params)
+            elif args.single_process == 'train':
                 execute_train(gpu=args.gpus[0], exp_batch=args.folder, exp_alias=args.exp,
                               suppress_output=False, encoder_params=encoder_params)
+            elif args.single_process == 'validation' and args.world_size > 1:
+                execute_validation_sharded(gpus=args.gpus, exp_batch=args.folder, exp_alias=args.exp,
+                                           json_file_path=args.val_json, world_size=args.world_size,
+                                           suppress_output=False, encoder_params=encoder_params)
             elif args.single_process == 'validation':
                 execute_validation(gpu=args.gpus[0], exp_batch=args.folder, exp_alias=args.exp,
                                    json_file_path=args.val_json, suppress_output=False, encoder_params=encoder_params)
+            elif args.single_process == 'train_multi':
+                execute_train_multi(gpu=args.gpus[0], exp_batch=args.folder, exp_aliases=args.exps,
+                                    suppress_output=False, encoder_params=encoder_params)
+            elif args.single_process == 'scheduled':
+                # Trains and validates all the experiments on the resources of the given gpus
+                execute_scheduled(exp_batch=args.folder, exp_aliases=args.exps, validation_datasets=args.val_jsons,
+                                  gpus=args.gpus, encoder_params=encoder_params)
 
 
         # train_encoder and validation_encoder are for training the encoder model only.
@@ -106,11 +151,26 @@ if __name__ == '__main__':
             create_log_folder(args.encoder_folder)
             if args.encoder_exp is None:
                 raise ValueError("You should set the exp alias")
-            execute_train_encoder(gpu=args.gpus[0], exp_batch=args.encoder_folder, exp_alias=args.encoder_exp,
-                          suppress_output=False)
+            if args.world_size > 1:
+                execute_train_distributed(gpus=args.gpus, exp_batch=args.encoder_folder,
+                                          exp_alias=args.encoder_exp, world_size=args.world_size,
+                                          process_type='train_encoder', suppress_output=False)
+            else:
+                execute_train_encoder(gpu=args.gpus[0], exp_batch=args.encoder_folder, exp_alias=args.encoder_exp,
+                              suppress_output=False)
+
+        # train_distill trains a smaller encoder to reproduce the DISTILL_TEACHER experiment
+        elif args.single_process == 'train_distill':
+            if args.folder is None:
+                raise ValueError("You should set a folder name where the experiments are placed")
+            create_log_folder(args.folder)
+            if args.exp is None:
+                raise ValueError("You should set the exp alias")
+            execute_train_distill(gpu=args.gpus[0], exp_batch=args.folder, exp_alias=args.exp,
+                                  suppress_output=False)
 
         else:
-            raise Exception("Invalid name for single process, chose from (train, validation, test)")
+            raise Exception("Invalid name for single process, chose from (train, train_multi, train_distill, validation, scheduled, test)")
 
     else:
         raise Exception("You need to define the process type with argument '--single-process': train_encoder, train, validation")
@@ -0,0 +1,252 @@
+"""
+    Helpers to run the models only for inference, on validation and on the driving agents.
+"""
+import contextlib
+import os
+
+import torch
+
+from configs import g_conf
+from .coil_model import CoILModel, EncoderModel
+from .models.building_blocks.resnet import ResNet
+
+
+def inference_mode():
+    """
+        torch.inference_mode when this torch version has it, otherwise torch.no_grad.
+    """
+    if hasattr(torch, 'inference_mode'):
+        return torch.inference_mode()
+
+    return torch.no_grad()
+
+
+def set_intermediate_outputs(model, layers):
+    """
+        Select the intermediate feature maps that the ResNet encoders inside a model return.
+
+    Args:
+        model: any module, all the ResNets inside it are changed
+        layers: the indices of the feature maps to keep, None to keep all of them
+
+    Returns:
+        The previous selection of each ResNet, to restore it with restore_intermediate_outputs
+
+    """
+    previous = []
+    for module in model.modules():
+        if isinstance(module, ResNet):
+            previous.append((module, module.intermediate_outputs))
+            module.intermediate_outputs = None if layers is None else frozenset(layers)
+
+    return previous
+
+
+def restore_intermediate_outputs(previous):
+    for module, layers in previous:
+        module.intermediate_outputs = layers
+
+
+@contextlib.contextmanager
+def slim_inference(models, keep_layers=()):
+    """
+        Run the models without autograd and computing only the outputs that are used. The
+        intermediate feature maps of the encoders are not kept, except the keep_layers ones,
+        e.g. the layers of the attention maps.
+
+    Args:
+        models: a module or a list of modules
+        keep_layers: the indices of the intermediate feature maps still returned
+
+    """
+    if isinstance(models, torch.nn.Module):
+        models = [models]
+    previous = []
+    for model in models:
+        previous += set_intermediate_outputs(model, keep_layers)
+    try:
+        with inference_mode():
+            yield
+    finally:
+        restore_intermediate_outputs(previous)
+
+
+class AffordancesInference(torch.nn.Module):
+    """
+        The encoder and the affordance heads as a single module with tensor outputs, to be traced
+        and exported (e.g. quantized) as one graph.
+
+        forward(x, speed, command) returns the classification logits stacked as
+        [number_of_classification, mini_batch, 2] and the regression outputs as
+        [mini_batch, number_of_regression].
+    """
+
+    def __init__(self, encoder_model, classification_heads, regression_heads):
+        super(AffordancesInference, self).__init__()
+        self.encoder_model = encoder_model
+        self.classification_heads = classification_heads
+        self.regression_heads = regression_heads
+
+    @classmethod
+    def from_models(cls, model, encoder_model=None):
+        """
+            Build it from the models of the affordances experiments: the encoder and the
+            Separate_Affordances heads, or a single one-step-affordances model.
+        """
+        if encoder_model is None:
+            encoder_model = model
+        return cls(encoder_model, model.affordances_classification, model.affordances_regression)
+
+    def forward(self, x, speed, command):
+        e, _ = self.encoder_model.forward_encoder(x, speed, command)
+        c_output = self.classification_heads(e)
+        r_output = self.regression_heads(e)
+
+        return torch.stack(c_output), torch.cat(r_output, 1)
+
+
+def split_affordances_outputs(c_output, r_output):
+    """
+        Back from the AffordancesInference outputs to the lists the heads return.
+    """
+    return [c_output[i] for i in range(c_output.size(0))], \
+           [r_output[:, j:j + 1] for j in range(r_output.size(1))]
+
+
+def load_affordances_inference(exp_batch, checkpoint_number, encoder_params, map_location='cpu'):
+    """
+        Load the models of an affordances experiment, as validation does, as one
+        AffordancesInference module. The configuration has to be merged already.
+
+    Args:
+        exp_batch: the folder with the experiments
+        checkpoint_number: the checkpoint of the experiment
+        encoder_params: the pre-trained encoder folder, exp and checkpoint
+        map_location: where the checkpoints are loaded
+
+    Returns:
+        The AffordancesInference module on evaluation mode
+    """
+    checkpoints_path = os.path.join('_logs', exp_batch, g_conf.EXPERIMENT_NAME, 'checkpoints')
+    checkpoint = torch.load(os.path.join(checkpoints_path, str(checkpoint_number) + '.pth'),
+                            map_location=map_location)
+
+    if g_conf.MODEL_TYPE in ['one-step-affordances']:
+        model = EncoderModel(g_conf.ENCODER_MODEL_TYPE, g_conf.ENCODER_MODEL_CONFIGURATION)
+        model.load_state_dict(checkpoint['state_dict'])
+        inference_model = AffordancesInference.from_models(model)
+
+    elif g_conf.MODEL_TYPE in ['separate-affordances']:
+        if g_conf.FREEZE_ENCODER and encoder_params is None:
+            raise ValueError("The separate-affordances experiments with a frozen encoder need the encoder parameters")
+        encoder_model = EncoderModel(g_conf.ENCODER_MODEL_TYPE, g_conf.ENCODER_MODEL_CONFIGURATION)
+        if g_conf.FREEZE_ENCODER:
+            encoder_checkpoint_path = os.path.join('_logs', encoder_params['encoder_folder'],
+                                                   encoder_params['encoder_exp'], 'checkpoints',
+                                                   str(encoder_params['encoder_checkpoint']) + '.pth')
+        else:
+            encoder_checkpoint_path = os.path.join(checkpoints_path, str(checkpoint_number) + '_encoder.pth')
+        encoder_model.load_state_dict(torch.load(encoder_checkpoint_path,
+                                                 map_location=map_location)['state_dict'])
+
+        model = CoILModel(g_conf.MODEL_TYPE, g_conf.MODEL_CONFIGURATION, g_conf.ENCODER_MODEL_CONFIGURATION)
+        model.load_state_dict(checkpoint['state_dict'])
+        inference_model = AffordancesInference.from_models(model, encoder_model)
+
+    else:
+        raise ValueError("Not an affordances experiment: " + g_conf.MODEL_TYPE)
+
+    inference_model.eval()
+
+    return inference_model
+
+
+class ETEInference(torch.nn.Module):
+    """
+        The action prediction of an end to end driving model, forward_action already returns
+        the branch of the command.
+
+        forward(x, speed, command) returns the actions, [mini_batch, len(TARGETS)].
+    """
+
+    def __init__(self, model):
+        super(ETEInference, self).__init__()
+        self.model = model
+
+    def forward(self, x, speed, command):
+        return self.model.forward_action(x, speed, command)
+
+
+# The output names and the batch axis of each output of the exported graphs
+ONNX_OUTPUTS = {
+    AffordancesInference: {'classification': 1, 'regression': 0},
+    ETEInference: {'action': 0}
+}
+
+
+def export_onnx(model, example_inputs, path, opset_version=11):
+    """
+        Export an AffordancesInference or ETEInference module to ONNX, with a dynamic batch.
+
+    Args:
+        model: the module on evaluation mode
+        example_inputs: a tuple with the rgb, speed and command tensors
+        path: the .onnx file
+        opset_version: the ONNX operator set
+    """
+    outputs = ONNX_OUTPUTS[type(model)]
+    input_names = ['rgb', 'speed', 'command']
+    dynamic_axes = {name: {0: 'batch'} for name in input_names}
+    for name, batch_axis in outputs.items():
+        dynamic_axes[name] = {batch_axis: 'batch'}
+
+    previous = set_intermediate_outputs(model, [])
+    try:
+        with torch.no_grad():
+            torch.onnx.export(model, tuple(example_inputs), path, input_names=input_names,
+                              output_names=list(outputs.keys()), dynamic_axes=dynamic_axes,
+                              opset_version=opset_version)
+    finally:
+        restore_intermediate_outputs(previous)
+
+
+class OnnxRuntimeModel(object):
+    """
+        An exported graph run by ONNX Runtime on the CPU. It is called with the same torch
+        tensors as the PyTorch module it was exported from, and returns torch tensors.
+    """
+
+    def __init__(self, path, number_of_threads=None):
+        try:
+            import onnxruntime
+        except ImportError:
+            raise RuntimeError("The onnxruntime inference backend needs the onnxruntime package")
+
+        options = onnxruntime.SessionOptions()
+        if number_of_threads is not None:
+            options.intra_op_num_threads = number_of_threads
+        self.path = path
+        self._session = onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        # The exporter drops the inputs a graph does not use
+        self._input_names = [graph_input.name for graph_input in self._session.get_inputs()]
+
+    def __call__(self, x, speed, command):
+        feed = {}
+        for name, tensor in zip(['rgb', 'speed', 'command'], [x, speed, command]):
+            if name in self._input_names:
+                feed[name] = tensor.detach().cpu().float().numpy()
+        outputs = self._session.run(None, feed)
+        outputs = tuple(torch.from_numpy(output) for output in outputs)
+
+        return outputs if len(outputs) > 1 else outputs[0]
+
+
+def onnx_runtime_model(model, example_inputs, path):
+    """
+        The ONNX Runtime version of a module, exporting it to path the first time.
+    """
+    if not os.path.exists(path):
+        print("Exporting the ONNX graph ", path)
+        export_onnx(model, example_inputs, path)
+
+    return OnnxRuntimeModel(path)
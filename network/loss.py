@@ -39,25 +39,16 @@ def branched_loss_without_speed(loss_function, params):
         The computed loss function, but also a dictionary with plotable variables for tensorboard
     """
 
-    controls_mask = LF.compute_branches_masks(params['controls'],
-                                              params['branches'][0].shape[1])
+    # Each sample only contributes with the output of the branch of its command
+    selected_params = LF.select_branches(params, g_conf.NUMBER_OF_BRANCHES)
 
-    # Update the dictionary to add also the controls mask.
-    params.update({'controls_mask': controls_mask})
-
-    # calculate loss for each branch with specific activation
-    loss_branches_vec = loss_function(params)
+    # calculate loss for the selected branch outputs
+    loss_branches_vec = loss_function(selected_params)
 
     # Apply the variable weights
-    # This is applied to all branches except the last one, that is the speed branch...
-    # TODO This is hardcoded to have 4 branches not using speed.
-    for i in range(4):
-        loss_branches_vec[i] = loss_branches_vec[i][:, 0] * params['variable_weights']['Steer'] \
-                               + loss_branches_vec[i][:, 1] * params['variable_weights']['Gas'] \
-                               + loss_branches_vec[i][:, 2] * params['variable_weights']['Brake']
-
-    loss = loss_branches_vec[0] + loss_branches_vec[1] + loss_branches_vec[2] + \
-                    loss_branches_vec[3]
+    loss = loss_branches_vec[0][:, 0] * params['variable_weights']['Steer'] \
+           + loss_branches_vec[0][:, 1] * params['variable_weights']['Gas'] \
+           + loss_branches_vec[0][:, 2] * params['variable_weights']['Brake']
 
     return torch.sum(loss) / (params['branches'][0].shape[0])
 
@@ -68,7 +59,7 @@ def CrossEntropy_L1(params):
     relative_angle_gt = params['affordances_gt'][:, 0]
     hazard_stop_gt = params['affordances_gt'][:, 1]
 
-    CE = F.cross_entropy(hazard_stop_output, hazard_stop_gt.long(), weight = torch.FloatTensor(params['class_weights']['hazard_stop']).cuda())
+    CE = F.cross_entropy(hazard_stop_output, hazard_stop_gt.long(), weight=LF.device_constant(tuple(params['class_weights']['hazard_stop']), hazard_stop_output.device))
     L1 = F.l1_loss(relative_angle_output, relative_angle_gt)
 
     # TODO: hardcoded......
@@ -88,9 +79,9 @@ def CrossEntropy_MAE(params):
     #regression_output = params['outputs'][:, 6:7]
     #regression_gt = params['targets'][:, 3]
 
-    CE_1 = F.cross_entropy(hazard_stop_output, hazard_stop_gt.long(), weight = torch.FloatTensor(params['class_weights']['hazard_stop']).cuda())
-    CE_2 = F.cross_entropy(red_light_output, red_light_gt.long(), weight = torch.FloatTensor(params['class_weights']['red_traffic_light']).cuda())
-    CE_3 = F.cross_entropy(vehicle_stop_output, vehicle_stop_gt.long(), weight=torch.FloatTensor(params['class_weights']['vehicle_stop']).cuda())
+    CE_1 = F.cross_entropy(hazard_stop_output, hazard_stop_gt.long(), weight=LF.device_constant(tuple(params['class_weights']['hazard_stop']), hazard_stop_output.device))
+    CE_2 = F.cross_entropy(red_light_output, red_light_gt.long(), weight=LF.device_constant(tuple(params['class_weights']['red_traffic_light']), red_light_output.device))
+    CE_3 = F.cross_entropy(vehicle_stop_output, vehicle_stop_gt.long(), weight=LF.device_constant(tuple(params['class_weights']['vehicle_stop']), vehicle_stop_output.device))
     CE_loss = (CE_1 + CE_2 + CE_3) / 3.0
 
     i = 0
@@ -255,28 +246,20 @@ def branched_loss(loss_function, params):
         The computed loss function, but also a dictionary with plotable variables for tensorboard
     """
 
-    controls_mask = LF.compute_branches_masks(params['controls'],
-                                              params['branches'][0].shape[1])
+    # Each sample only contributes with the output of the branch of its command, so the
+    # output is gathered instead of masking every branch.
+    selected_params = LF.select_branches(params, g_conf.NUMBER_OF_BRANCHES)
 
-    # Update the dictionary to add also the controls mask.
-    params.update({'controls_mask': controls_mask})
-
-    # calculate loss for each branch with specific activation
-    loss_branches_vec, plotable_params = loss_function(params)
+    # calculate loss for the selected branch outputs and the speed branch
+    loss_branches_vec, plotable_params = loss_function(selected_params)
 
     # Apply the variable weights
     # This is applied to all branches except the last one, that is the speed branch...
-    # TODO This is hardcoded to  have 4 branches not using speed.
-
-    for i in range(4):
-        loss_branches_vec[i] = loss_branches_vec[i][:, 0] * params['variable_weights']['Steer'] \
-                               + loss_branches_vec[i][:, 1] * params['variable_weights']['Gas'] \
-                               + loss_branches_vec[i][:, 2] * params['variable_weights']['Brake']
+    loss = loss_branches_vec[0][:, 0] * params['variable_weights']['Steer'] \
+           + loss_branches_vec[0][:, 1] * params['variable_weights']['Gas'] \
+           + loss_branches_vec[0][:, 2] * params['variable_weights']['Brake']
 
-    loss = loss_branches_vec[0] + loss_branches_vec[1] + loss_branches_vec[2] + \
-                    loss_branches_vec[3]
-
-    speed_loss = loss_branches_vec[4]
+    speed_loss = loss_branches_vec[-1]
 
     return torch.sum(loss) / (params['branches'][0].shape[0])\
                 + torch.sum(speed_loss) / (params['branches'][0].shape[0]), plotable_params
@@ -300,7 +283,7 @@ def command_input_loss(loss_function, params):
     """
     # Update the dictionary to add also the controls mask.
     # TODO branches name is not updated.
-    params.update({'controls_mask': torch.ones(params['branches'][0].size()).cuda()})
+    params.update({'controls_mask': torch.ones_like(params['branches'][0])})
     # calculate loss for each branch with specific activation
     loss_branches_vec, plotable_params = loss_function(params)
 
@@ -320,6 +303,42 @@ def command_input_loss(loss_function, params):
            plotable_params
 
 
+def distillation(params):
+
+    """
+    Args
+        params: the outputs of the student and of the teacher, including
+                student_embedding, teacher_embedding: the embeddings of the encoders
+                student_classification, teacher_classification: the logits of each classification head
+                student_regression, teacher_regression: the outputs of each regression head
+                temperature: the softmax temperature of the classification targets
+                weights: the weight of the embedding, classification and regression terms
+
+    Returns
+        The computed loss function, but also a dictionary with plotable variables for tensorboard
+    """
+    temperature = params['temperature']
+    embedding_loss = F.mse_loss(params['student_embedding'], params['teacher_embedding'])
+
+    classification_loss = 0.0
+    for student, teacher in zip(params['student_classification'], params['teacher_classification']):
+        # Scaled by T^2 so the gradient magnitude does not depend on the temperature
+        classification_loss += F.kl_div(F.log_softmax(student / temperature, dim=1),
+                                        F.softmax(teacher / temperature, dim=1),
+                                        reduction='batchmean') * temperature * temperature
+
+    regression_loss = 0.0
+    for student, teacher in zip(params['student_regression'], params['teacher_regression']):
+        regression_loss += F.l1_loss(student, teacher)
+
+    loss = params['weights']['embedding'] * embedding_loss \
+           + params['weights']['classification'] * classification_loss \
+           + params['weights']['regression'] * regression_loss
+
+    return loss, {'embedding_loss': embedding_loss, 'classification_loss': classification_loss,
+                  'regression_loss': regression_loss}
+
+
 
 def Loss(loss_name):
     """ Factory function
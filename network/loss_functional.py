@@ -52,7 +52,51 @@ def weight_decay_l2(loss, model, intention_factors, alpha, gating):
     return loss
 
 
-def compute_branches_masks(controls, number_targets):
+# Constant tensors used by the losses, created once per device
+_device_constants = {}
+
+
+def device_constant(values, device, dtype=torch.float32):
+    """
+        A tensor with the given values that is created only the first time it is asked for
+        on a device.
+    Args:
+        values: a tuple of numbers, it has to be hashable
+        device: the device where the tensor lives
+        dtype: the tensor type
+    """
+    key = (values, str(device), dtype)
+    if key not in _device_constants:
+        _device_constants[key] = torch.tensor(values, dtype=dtype, device=device)
+
+    return _device_constants[key]
+
+
+def compute_branch_index(controls, number_of_branches):
+    """
+        Args
+            controls
+            the commands, either as the command flags: 2 - follow lane; 3 - turn left;
+            4 - turn right; 5 - go straight ... with shape [B] or [B, 1], or one hot
+            with shape [B, number_of_branches]
+            number_of_branches:
+            the number of conditional branches of the network
+        Returns
+            the index of the branch of each sample, [B] long, and a [B] bool mask that is
+            False for the samples whose command has no branch.
+    """
+    if controls.dim() > 1 and controls.size(-1) == number_of_branches and number_of_branches > 1:
+        index = controls.argmax(-1)
+        valid = controls.sum(-1) > 0
+    else:
+        index = controls.reshape(-1).long() - 2
+        valid = (index >= 0) & (index < number_of_branches)
+        index = index.clamp(0, number_of_branches - 1)
+
+    return index, valid
+
+
+def compute_branches_masks(controls, number_targets, number_of_branches=4):
     """
         Args
             controls
@@ -66,31 +110,44 @@ def compute_branches_masks(controls, number_targets):
     """
 
     """ A vector with a mask for each of the control branches"""
+    index, valid = compute_branch_index(controls, number_of_branches)
     controls_masks = []
+    for i in range(number_of_branches):
+        controls_masks.append(((index == i) & valid).float().unsqueeze(1).expand(-1, number_targets))
+
+    return controls_masks
 
-    # when command = 2, branch 1 (follow lane) is activated
-    controls_b1 = (controls == 2)
-    controls_b1 = torch.tensor(controls_b1, dtype=torch.float32).cuda()
-    controls_b1 = torch.cat([controls_b1] * number_targets, 1)
-    controls_masks.append(controls_b1)
-    # when command = 3, branch 2 (turn left) is activated
-    controls_b2 = (controls == 3)
-    controls_b2 = torch.tensor(controls_b2, dtype=torch.float32).cuda()
-    controls_b2 = torch.cat([controls_b2] * number_targets, 1)
-    controls_masks.append(controls_b2)
-    # when command = 4, branch 3 (turn right) is activated
-    controls_b3 = (controls == 4)
-    controls_b3 = torch.tensor(controls_b3, dtype=torch.float32).cuda()
-    controls_b3 = torch.cat([controls_b3] * number_targets, 1)
-    controls_masks.append(controls_b3)
-    # when command = 5, branch 4 (go strange) is activated
-    controls_b4 = (controls == 5)
-    controls_b4 = torch.tensor(controls_b4, dtype=torch.float32).cuda()
-    controls_b4 = torch.cat([controls_b4] * number_targets, 1)
-    controls_masks.append(controls_b4)
 
+def select_branches(params, number_of_branches):
+    """
+        Select, with a single gather, the output of the branch of each sample.
+
+        Args
+            params: the loss parameters, with the branches outputs, the controls and the
+                    branch weights
+            number_of_branches: the number of conditional branches, the branches after
+                    them (the speed branch) are not selected from.
+        Returns
+            A copy of params where the conditional branches are replaced by a single branch
+            with the selected outputs, its weight per sample and a mask of the samples with
+            a valid command, ready for the loss functionals.
+    """
+    branches = torch.stack(params['branches'][:number_of_branches])  # [branches, B, targets]
+    index, valid = compute_branch_index(params['controls'], number_of_branches)
+    selected = branches.gather(0, index.view(1, -1, 1).expand(1, -1, branches.size(2))).squeeze(0)
+    branch_weights = device_constant(tuple(params['branch_weights'][:number_of_branches]),
+                                     selected.device, selected.dtype)
+
+    selected_params = dict(params)
+    selected_params.update({
+        'branches': [selected] + list(params['branches'][number_of_branches:]),
+        'controls_mask': [valid.to(selected.dtype).unsqueeze(1).expand_as(selected)],
+        'branch_weights': [branch_weights[index].unsqueeze(1)] +
+                          list(params['branch_weights'][number_of_branches:])
+    })
+
+    return selected_params
 
-    return controls_masks
 
 def l2_loss(params):
     """
@@ -109,7 +166,6 @@ def l2_loss(params):
     """
     """ It is a vec for each branch"""
     loss_branches_vec = []
-    # TODO This is hardcoded but all our cases rigth now uses four branches
     for i in range(len(params['branches']) -1):
         loss_branches_vec.append(((params['branches'][i] - params['targets']) **2
                                            * params['controls_mask'][i])
@@ -138,7 +194,6 @@ def l1_loss(params):
     """
     """ It is a vec for each branch"""
     loss_branches_vec = []
-    # TODO This is hardcoded but all our cases rigth now uses four branches
     for i in range(len(params['branches']) - 1):
         loss_branches_vec.append(torch.abs((params['branches'][i] - params['targets'])
                                            * params['controls_mask'][i])
@@ -166,7 +221,6 @@ def l1_loss_without_speed(params):
     """
     """ It is a vec for each branch"""
     loss_branches_vec = []
-    # TODO This is hardcoded but all our cases rigth now uses four branches
     for i in range(len(params['branches'])):
         loss_branches_vec.append(torch.abs((params['branches'][i] - params['targets'])
                                            * params['controls_mask'][i])
@@ -1,6 +1,9 @@
 from .branching import Branching
+from .grouped_fc import GroupedFC, fused_branching, branching_to_grouped_state_dict, \
+    grouped_to_branching_state_dict
 from .mu_logvar import Mu_Logvar
 from .conv import Conv, Conv_Encode, ConvTrans_Decode
 from .fc import FC, FC_Bottleneck
+from .frame_pair import ChunkedBatchNorm2d, convert_chunked_batchnorm, batchnorm_chunks, encode_frame_pair
 from .join import Join
 from .resnet_enc import BasicBlock, Resnet34_Encode, Resnet34_Decode
@@ -6,6 +6,32 @@ import torch
 import torch.nn.functional as F
 
 
+
+def conv_output_shape(layers, shape):
+    """
+        The output shape of a stack of convolutions, computed from the kernel sizes, strides,
+        paddings and dilations of its Conv2d layers instead of a forward of a dummy input.
+        The other layers (batch normalizations, dropouts and relus) keep the shape.
+
+    Args:
+        layers: the module with the convolutions, applied in order
+        shape: the input shape, [channels, height, width]
+
+    Returns:
+        The output shape, [channels, height, width]
+    """
+    channels, height, width = shape
+    for module in layers.modules():
+        if isinstance(module, nn.Conv2d):
+            height, width = [(size + 2 * padding - dilation * (kernel - 1) - 1) // stride + 1
+                             for size, kernel, stride, padding, dilation in
+                             zip([height, width], module.kernel_size, module.stride, module.padding,
+                                 module.dilation)]
+            channels = module.out_channels
+
+    return [channels, height, width]
+
+
 class ConvTrans_Decode(nn.Module):
     def __init__(self, params=None, module_name='Default'):
         super(ConvTrans_Decode, self).__init__()
@@ -82,12 +108,11 @@ class Conv_Encode(nn.Module):
         return flatten, x.shape
 
     def get_conv_output(self, shape):
-
-        bs = 1
-        input = torch.autograd.Variable(torch.rand(bs, *shape))
-        output_feat, _= self.forward(input)
-        n_size = output_feat.data.view(bs, -1).size(1)
-        return n_size
+        """
+           By inputing the shape of the input, compute what is the flattened ouput size.
+        """
+        channels, height, width = conv_output_shape(self.layers, shape)
+        return channels * height * width
 
 
 class Conv(nn.Module):
@@ -153,12 +178,8 @@ class Conv(nn.Module):
 
     def get_conv_output(self, shape):
         """
-           By inputing the shape of the input, simulate what is the ouputsize.
+           By inputing the shape of the input, compute what is the flattened ouput size.
         """
-
-        bs = 1
-        input = torch.autograd.Variable(torch.rand(bs, *shape))
-        output_feat, _ = self.forward(input)
-        n_size = output_feat.data.view(bs, -1).size(1)
-        return n_size
+        channels, height, width = conv_output_shape(self.layers, shape)
+        return channels * height * width
 
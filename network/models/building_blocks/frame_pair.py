@@ -0,0 +1,98 @@
+import contextlib
+
+import torch
+import torch.nn as nn
+
+
+class ChunkedBatchNorm2d(nn.BatchNorm2d):
+    """
+        A BatchNorm2d that, while training, can normalize consecutive chunks of the batch with
+        their own statistics. With the two frames of a pair concatenated on the batch, each
+        frame is normalized, and updates the running statistics, as if it was a separate
+        forward. On evaluation it is a plain BatchNorm2d.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(ChunkedBatchNorm2d, self).__init__(*args, **kwargs)
+        self.chunks = 1
+
+    def forward(self, x):
+        if self.chunks > 1 and self.training:
+            return torch.cat([super(ChunkedBatchNorm2d, self).forward(chunk)
+                              for chunk in x.chunk(self.chunks)])
+
+        return super(ChunkedBatchNorm2d, self).forward(x)
+
+
+def convert_chunked_batchnorm(module):
+    """
+        Replace, in place, the BatchNorm2d layers of a module with ChunkedBatchNorm2d ones. The
+        parameter names do not change, so the checkpoints load on both versions.
+
+    Returns:
+        The module, or the new layer if the module itself is a BatchNorm2d
+    """
+    if type(module) is nn.BatchNorm2d:
+        chunked = ChunkedBatchNorm2d(module.num_features, module.eps, module.momentum,
+                                     module.affine, module.track_running_stats)
+        chunked.load_state_dict(module.state_dict())
+        return chunked
+
+    for name, child in module.named_children():
+        setattr(module, name, convert_chunked_batchnorm(child))
+
+    return module
+
+
+@contextlib.contextmanager
+def batchnorm_chunks(module, chunks):
+    """ Normalize the batch of the ChunkedBatchNorm2d layers of a module in chunks. """
+    layers = [m for m in module.modules() if isinstance(m, ChunkedBatchNorm2d)]
+    for layer in layers:
+        layer.chunks = chunks
+    try:
+        yield
+    finally:
+        for layer in layers:
+            layer.chunks = 1
+
+
+def split_pair(output):
+    """
+        Split the output of an encoder called on a concatenated pair into the outputs of each
+        frame. Tensors are split on the batch, lists and tuples element wise, anything else
+        (e.g. the feature maps that were not kept) is given to both frames.
+    """
+    if torch.is_tensor(output):
+        return output.chunk(2)
+    if isinstance(output, (list, tuple)) and not isinstance(output, torch.Size):
+        first, second = zip(*[split_pair(element) for element in output]) if output else ((), ())
+        return type(output)(first), type(output)(second)
+
+    return output, output
+
+
+def encode_frame_pair(encoder, *pairs, fused=True, per_frame_batchnorm=True):
+    """
+        Encode the two frames of a pair. By default they are concatenated into a single batch of
+        twice the size, so every layer of the encoder runs once.
+
+    Args:
+        encoder: the module applied on each frame
+        pairs: the pairs of inputs of the encoder, [first, second], e.g. the images and, for the
+            encoders that take them, the measurements and the commands
+        fused: encode both frames with a single call, otherwise one call per frame
+        per_frame_batchnorm: on a fused call, normalize each frame with its own batch statistics
+            as the separate calls do. The ChunkedBatchNorm2d layers of the encoder are used.
+
+    Returns:
+        The output of the encoder for the first and for the second frame
+    """
+    if not fused:
+        return encoder(*[pair[0] for pair in pairs]), encoder(*[pair[1] for pair in pairs])
+
+    inputs = [torch.cat([pair[0], pair[1]]) for pair in pairs]
+    with batchnorm_chunks(encoder, 2 if per_frame_batchnorm else 1):
+        output = encoder(*inputs)
+
+    return split_pair(output)
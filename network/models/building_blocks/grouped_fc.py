@@ -0,0 +1,176 @@
+import math
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from .branching import Branching
+from .fc import FC
+
+
+def branching_to_grouped_state_dict(state_dict, prefix, number_of_groups, number_of_layers):
+    """
+        Convert, in place, the parameters of a Branching of FC modules into the ones of the
+        equivalent GroupedFC.
+
+    Args:
+        state_dict: a model state dict
+        prefix: the name of the branching module followed by a dot, e.g. 'affordances_classification.'
+        number_of_groups: the number of branches
+        number_of_layers: the number of linear layers of each branch
+
+    """
+    for layer in range(number_of_layers):
+        weights = []
+        biases = []
+        for group in range(number_of_groups):
+            key = prefix + 'branched_modules.%d.layers.%d.0.' % (group, layer)
+            # nn.Linear keeps the weight as [out, in]
+            weights.append(state_dict.pop(key + 'weight').t())
+            biases.append(state_dict.pop(key + 'bias'))
+        state_dict[prefix + 'weight.%d' % layer] = torch.stack(weights)
+        state_dict[prefix + 'bias.%d' % layer] = torch.stack(biases).unsqueeze(1)
+
+
+def grouped_to_branching_state_dict(state_dict, prefix, number_of_layers):
+    """
+        Convert, in place, the parameters of a GroupedFC back to the ones of a Branching of
+        FC modules, so checkpoints trained with fused heads load on the original models.
+
+    Args:
+        state_dict: a model state dict
+        prefix: the name of the grouped module followed by a dot
+        number_of_layers: the number of linear layers of each branch
+
+    """
+    for layer in range(number_of_layers):
+        weight = state_dict.pop(prefix + 'weight.%d' % layer)
+        bias = state_dict.pop(prefix + 'bias.%d' % layer)
+        for group in range(weight.size(0)):
+            key = prefix + 'branched_modules.%d.layers.%d.0.' % (group, layer)
+            state_dict[key + 'weight'] = weight[group].t().contiguous()
+            state_dict[key + 'bias'] = bias[group, 0].contiguous()
+
+
+class GroupedFC(nn.Module):
+    """
+        A group of fully connected stacks with the same layer sizes, that take the same input and
+        are evaluated together with batched weights. It replaces a Branching of FC modules: each
+        layer is a single grouped matmul instead of one small matmul per branch.
+
+        The forward returns a list with the output of each group, as the Branching does.
+        Checkpoints of the Branching version are converted when they are loaded.
+    """
+
+    def __init__(self, params=None, module_name='Default'):
+
+        super(GroupedFC, self).__init__()
+
+        if params is None:
+            raise ValueError("Creating a NULL fully connected block")
+        if 'groups' not in params:
+            raise ValueError(" Missing the groups parameter ")
+        if 'neurons' not in params:
+            raise ValueError(" Missing the kernel sizes parameter ")
+        if 'dropouts' not in params:
+            raise ValueError(" Missing the dropouts parameter ")
+        if 'end_layer' not in params:
+            raise ValueError(" Missing the end module parameter ")
+
+        if len(params['dropouts']) != len(params['neurons']) - 1:
+            raise ValueError("Dropouts should be from the len of kernels minus 1")
+
+        self.groups = params['groups']
+        self.end_layer = params['end_layer']
+        self.dropouts = list(params['dropouts'])
+        self.weight = nn.ParameterList()
+        self.bias = nn.ParameterList()
+        for i in range(0, len(params['neurons']) - 1):
+            self.weight.append(nn.Parameter(torch.Tensor(self.groups, params['neurons'][i],
+                                                         params['neurons'][i + 1])))
+            self.bias.append(nn.Parameter(torch.Tensor(self.groups, 1, params['neurons'][i + 1])))
+
+        self.reset_parameters()
+        self._register_load_state_dict_pre_hook(self._load_branching_state_dict)
+
+    def reset_parameters(self):
+        # The same initialization nn.Linear does for every branch
+        for weight, bias in zip(self.weight, self.bias):
+            bound = 1.0 / math.sqrt(weight.size(1))
+            nn.init.uniform_(weight, -bound, bound)
+            nn.init.uniform_(bias, -bound, bound)
+
+    @classmethod
+    def from_fc_modules(cls, fc_modules):
+        """
+            Build a GroupedFC with the weights of a list of FC modules with the same layers.
+            Returns None if the modules can not be grouped.
+        """
+        if len(fc_modules) == 0 or not all(isinstance(m, FC) for m in fc_modules):
+            return None
+
+        def layer_description(fc):
+            description = []
+            for layer in fc.layers:
+                linear, dropout = layer[0], layer[1]
+                description.append((linear.in_features, linear.out_features, dropout.p,
+                                    len(layer) > 2))
+            return description
+
+        description = layer_description(fc_modules[0])
+        if any(layer_description(m) != description for m in fc_modules[1:]):
+            return None
+        # Only the last layer may come without activation
+        if any(not has_relu for _, _, _, has_relu in description[:-1]):
+            return None
+
+        grouped = cls(params={'groups': len(fc_modules),
+                              'neurons': [description[0][0]] + [out for _, out, _, _ in description],
+                              'dropouts': [p for _, _, p, _ in description],
+                              'end_layer': not description[-1][3]})
+        state_dict = {}
+        for group, fc in enumerate(fc_modules):
+            for key, value in fc.state_dict().items():
+                state_dict['branched_modules.%d.%s' % (group, key)] = value
+        branching_to_grouped_state_dict(state_dict, '', len(fc_modules), len(description))
+        grouped.load_state_dict(state_dict)
+
+        return grouped
+
+    def _load_branching_state_dict(self, state_dict, prefix, local_metadata, strict,
+                                   missing_keys, unexpected_keys, error_msgs):
+        if prefix + 'branched_modules.0.layers.0.0.weight' in state_dict:
+            branching_to_grouped_state_dict(state_dict, prefix, self.groups, len(self.weight))
+
+    def forward_stacked(self, x):
+        """
+            Returns the outputs of all the groups as a single tensor [groups, mini_batch, output].
+        """
+        number_of_layers = len(self.weight)
+        # The input is shared by every group, the first matmul broadcasts it
+        x = torch.matmul(x, self.weight[0]) + self.bias[0]
+        for i in range(number_of_layers):
+            if i > 0:
+                x = torch.baddbmm(self.bias[i], x, self.weight[i])
+            x = F.dropout(x, p=self.dropouts[i], training=self.training)
+            if i < number_of_layers - 1 or not self.end_layer:
+                x = F.relu(x, inplace=True)
+
+        return x
+
+    def forward(self, x):
+        # Indexed instead of unbind, so the module can be symbolically traced
+        x = self.forward_stacked(x)
+        return [x[i] for i in range(self.groups)]
+
+
+def fused_branching(branched_modules):
+    """
+        A GroupedFC for the given modules when all of them are FC stacks with the same layers,
+        otherwise the usual Branching.
+    """
+    grouped = GroupedFC.from_fc_modules(branched_modules)
+    if grouped is None:
+        return Branching(branched_modules)
+
+    return grouped
@@ -122,6 +122,11 @@ class ResNet(nn.Module):
                 nn.init.constant_(m.weight, 1)
                 nn.init.constant_(m.bias, 0)
 
+        # The indices of the intermediate feature maps returned by forward, None for all of them.
+        # The ones not requested are returned as None, so they are freed as soon as the next
+        # layer is computed. See network.inference.
+        self.intermediate_outputs = None
+
     def _make_layer(self, block, planes, blocks, stride=1):
         downsample = None
         if stride != 1 or self.inplanes != planes * block.expansion:
@@ -143,17 +148,21 @@ class ResNet(nn.Module):
         x = self.conv1(x)
         x = self.bn1(x)
         x = self.relu(x)
-        x0 = self.maxpool(x)
-        x1 = self.layer1(x0)
-        x2 = self.layer2(x1)
-        x3 = self.layer3(x2)
-        x4 = self.layer4(x3)
+        x = self.maxpool(x)
+
+        intermediate = [x if self._keep_intermediate(0) else None]
+        for i, layer in enumerate([self.layer1, self.layer2, self.layer3, self.layer4]):
+            x = layer(x)
+            intermediate.append(x if self._keep_intermediate(i + 1) else None)
 
-        x = self.avgpool(x4)
+        x = self.avgpool(x)
         x = x.view(x.size(0), -1)
         x = self.fc(x)
 
-        return x, [x0, x1, x2, x3, x4]  # output, intermediate
+        return x, intermediate  # output, intermediate [x0, x1, x2, x3, x4]
+
+    def _keep_intermediate(self, index):
+        return self.intermediate_outputs is None or index in self.intermediate_outputs
 
     def get_layers_features(self, x):
         # Just get the intermediate layers directly.
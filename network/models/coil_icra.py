@@ -6,15 +6,27 @@ from torch.nn import functional as F
 
 from configs import g_conf
 from coilutils.general import command_number_to_index
+from network.loss_functional import device_constant
 
 from .building_blocks import Conv, Conv_Encode, ConvTrans_Decode
-from .building_blocks import Branching
+from .building_blocks import Branching, fused_branching
 from .building_blocks import Mu_Logvar
 from .building_blocks import FC, FC_Bottleneck
 from .building_blocks import Join
 from .building_blocks import Resnet34_Encode, Resnet34_Decode
 
 
+def ete_embedding_size(ENCODER_params):
+    """
+        The size of the embedding an ETE like encoder gives to the heads: the number of classes
+        of a residual perception, or the join output of a conv one (e.g. a distilled student).
+    """
+    if 'res' in ENCODER_params['perception']:
+        return ENCODER_params['perception']['res']['num_classes']
+
+    return ENCODER_params['join']['fc']['neurons'][-1]
+
+
 class Separate_Affordances(nn.Module):
     def __init__(self, params, ENCODER_params = None):
         super(Separate_Affordances, self).__init__()
@@ -33,7 +45,7 @@ class Separate_Affordances(nn.Module):
                     resnet_module = getattr(resnet_module,
                                             params['affordances']['c_res']['name'])
                     res_mlp = resnet_module(
-                        inplanes=ENCODER_params['perception']['res']['num_classes'],
+                        inplanes=ete_embedding_size(ENCODER_params),
                         num_classes=params['affordances']['c_res'][
                                                          'num_classes'])
 
@@ -70,7 +82,7 @@ class Separate_Affordances(nn.Module):
 
                 elif g_conf.ENCODER_MODEL_TYPE in ['ETE', 'ETE_inverse_model', 'forward']:
                     affordances_classification_fc_vector.append(
-                        FC(params={'neurons': [ENCODER_params['perception']['res']['num_classes']] + [2],
+                        FC(params={'neurons': [ete_embedding_size(ENCODER_params)] + [2],
                                    'dropouts': [0.0],
                                    'end_layer': True}))
 
@@ -82,7 +94,7 @@ class Separate_Affordances(nn.Module):
             else:
                 if g_conf.ENCODER_MODEL_TYPE in ['ETE', 'ETE_inverse_model', 'forward']:
                     affordances_classification_fc_vector.append(
-                        FC(params={'neurons': [ENCODER_params['perception']['res']['num_classes']] +params['affordances']['c_fc']['neurons']+ [2],
+                        FC(params={'neurons': [ete_embedding_size(ENCODER_params)] +params['affordances']['c_fc']['neurons']+ [2],
                                    'dropouts': params['affordances']['c_fc']['dropouts'],
                                    'end_layer': True}))
 
@@ -99,7 +111,7 @@ class Separate_Affordances(nn.Module):
                     resnet_module = getattr(resnet_module,
                                             params['affordances']['r_res']['name'])
                     res_mlp = resnet_module(
-                        inplanes=ENCODER_params['perception']['res']['num_classes'],
+                        inplanes=ete_embedding_size(ENCODER_params),
                         num_classes=params['affordances']['r_res'][
                                                          'num_classes'])
                 elif g_conf.ENCODER_MODEL_TYPE in ['action_prediction', 'stdim']:
@@ -132,7 +144,7 @@ class Separate_Affordances(nn.Module):
 
                 elif g_conf.ENCODER_MODEL_TYPE in ['ETE', 'ETE_inverse_model', 'forward']:
                     affordances_regression_fc_vector.append(
-                        FC(params={'neurons': [ENCODER_params['perception']['res']['num_classes']] +
+                        FC(params={'neurons': [ete_embedding_size(ENCODER_params)] +
                                               [1],
                                    'dropouts': [0.0],
                                    'end_layer': True}))
@@ -146,7 +158,7 @@ class Separate_Affordances(nn.Module):
             else:
                 if g_conf.ENCODER_MODEL_TYPE in ['ETE', 'ETE_inverse_model', 'forward']:
                     affordances_regression_fc_vector.append(
-                        FC(params={'neurons': [ENCODER_params['perception']['res']['num_classes']] +
+                        FC(params={'neurons': [ete_embedding_size(ENCODER_params)] +
                                               params['affordances']['r_fc']['neurons'] + [1],
                                    'dropouts': params['affordances']['r_fc']['dropouts'],
                                    'end_layer': True}))
@@ -158,8 +170,13 @@ class Separate_Affordances(nn.Module):
                                    'dropouts': params['affordances']['r_fc']['dropouts'],
                                    'end_layer': True}))
 
-        self.affordances_classification = Branching(affordances_classification_fc_vector)  # Here we set branching automatically
-        self.affordances_regression = Branching(affordances_regression_fc_vector)  # Here we set branching automatically
+        if g_conf.FUSED_HEADS:
+            # The heads with the same layers are evaluated together
+            self.affordances_classification = fused_branching(affordances_classification_fc_vector)
+            self.affordances_regression = fused_branching(affordances_regression_fc_vector)
+        else:
+            self.affordances_classification = Branching(affordances_classification_fc_vector)  # Here we set branching automatically
+            self.affordances_regression = Branching(affordances_regression_fc_vector)  # Here we set branching automatically
 
 
     def forward(self, z, params):
@@ -172,7 +189,7 @@ class Separate_Affordances(nn.Module):
 
         for i in range(len(c_output)):
             c_loss += F.cross_entropy(c_output[i], params['classification_gt'][:, i].long(),
-                                      weight=torch.FloatTensor(params['class_weights'][i]).cuda())
+                                      weight=device_constant(tuple(params['class_weights'][i]), c_output[i].device))
 
         for j in range(len(r_output)):
             r_loss += F.l1_loss(torch.squeeze(r_output[j]), params['regression_gt'][:, j]) *\
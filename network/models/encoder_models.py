@@ -6,6 +6,7 @@ from torch.nn import functional as F
 
 from configs import g_conf
 from coilutils.general import command_number_to_index
+from network.loss_functional import device_constant
 
 
 from logger import coil_logger
@@ -19,14 +20,27 @@ from configs import g_conf
 from coilutils.general import command_number_to_index
 
 from .building_blocks import Conv, Conv_Encode, ConvTrans_Decode
-from .building_blocks import Branching
+from .building_blocks import Branching, fused_branching
 from .building_blocks import Mu_Logvar
 from .building_blocks import FC, FC_Bottleneck
 from .building_blocks import Join
 from .building_blocks import Resnet34_Encode, Resnet34_Decode
+from .building_blocks import encode_frame_pair, convert_chunked_batchnorm
 from .building_blocks import utils
 
 
+def encode_pair(encoder, *pairs):
+    """
+        Encode the two frames of a pair models take, following the FUSED_FRAME_PAIRS and
+        FRAME_PAIR_BATCHNORM configuration. Returns the outputs for the first and second frame.
+    """
+    if g_conf.FRAME_PAIR_BATCHNORM not in ['per_frame', 'joint']:
+        raise ValueError("FRAME_PAIR_BATCHNORM should be per_frame or joint")
+
+    return encode_frame_pair(encoder, *pairs, fused=g_conf.FUSED_FRAME_PAIRS,
+                             per_frame_batchnorm=g_conf.FRAME_PAIR_BATCHNORM == 'per_frame')
+
+
 class VAE(nn.Module):
 
     def __init__(self, params):
@@ -171,8 +185,13 @@ class Affordances_Separate(nn.Module):
                                'dropouts': params['affordances']['r_fc']['dropouts'] ,
                                'end_layer': True}))
 
-        self.affordances_classification = Branching(affordances_classification_fc_vector)  # Here we set branching automatically
-        self.affordances_regression = Branching(affordances_regression_fc_vector)  # Here we set branching automatically
+        if g_conf.FUSED_HEADS:
+            # The heads with the same layers are evaluated together
+            self.affordances_classification = fused_branching(affordances_classification_fc_vector)
+            self.affordances_regression = fused_branching(affordances_regression_fc_vector)
+        else:
+            self.affordances_classification = Branching(affordances_classification_fc_vector)  # Here we set branching automatically
+            self.affordances_regression = Branching(affordances_regression_fc_vector)  # Here we set branching automatically
 
 
     def forward(self, x, m, c, params):
@@ -188,7 +207,7 @@ class Affordances_Separate(nn.Module):
         r_loss = 0.0
 
         for i in range(len(c_output)):
-            c_loss += F.cross_entropy(c_output[i], params['classification_gt'][:,i].long(), weight=torch.FloatTensor(params['class_weights'][i]).cuda())
+            c_loss += F.cross_entropy(c_output[i], params['classification_gt'][:,i].long(), weight=device_constant(tuple(params['class_weights'][i]), c_output[i].device))
 
         for j in range(len(r_output)):
             r_loss += F.l1_loss(torch.squeeze(r_output[j]), params['regression_gt'][:, j]) *params['variable_weights'][j]
@@ -460,12 +479,12 @@ class ETE(nn.Module):
         branch_number = command_number_to_index(branch_number)
 
         if len(branch_number) > 1:
-            branch_number = torch.squeeze(branch_number.type(torch.cuda.LongTensor))
+            branch_number = torch.squeeze(branch_number.long().to(output_vec.device))
         else:
-            branch_number = branch_number.type(torch.cuda.LongTensor)
+            branch_number = branch_number.long().to(output_vec.device)
 
         branch_number = torch.stack([branch_number,
-                                     torch.cuda.LongTensor(range(0, len(branch_number)))])
+                                     torch.arange(len(branch_number), device=output_vec.device)])
 
         return output_vec[branch_number[0], branch_number[1], :]
 
@@ -554,6 +573,9 @@ class ACTION_PREDICTION(nn.Module):
                                  'dropouts': params['decode']['fc']['dropouts'] + [0.0],
                                  'end_layer': True})
 
+        # The frames of a pair may be encoded together and still normalized separately
+        convert_chunked_batchnorm(self)
+
 
 
     def forward(self, x, m, c, a):
@@ -576,8 +598,8 @@ class ACTION_PREDICTION(nn.Module):
 
         # the forward part of model
         # To input image to model
-        x_t, inter = self.encode_conv(x[0])  # frame before the action
-        x_ti, inter = self.encode_conv(x[1]) # frame after the action
+        # frame before and after the action
+        (x_t, inter), (x_ti, inter) = encode_pair(self.encode_conv, x)
 
         """ ###### APPLY THE MEASUREMENT MODULE """
         m_t = self.measurements(m[0])
@@ -702,6 +724,9 @@ class ETE_inverse_model(nn.Module):
                 nn.init.xavier_uniform_(m.weight)
                 nn.init.constant_(m.bias, 0.1)
 
+        # The frames of a pair may be encoded together and still normalized separately
+        convert_chunked_batchnorm(self)
+
     def forward(self, x,  m,  c,  a):
         """
         Args:
@@ -716,8 +741,8 @@ class ETE_inverse_model(nn.Module):
         # lateral cameral at time t after action becomes central camera time t+1
         # the forward part of model
         # To input image to model
-        x_t, inter = self.perception(x[0])  # frame before the action
-        x_ti, inter = self.perception(x[1]) # frame after the action
+        # frame before and after the action
+        (x_t, inter), (x_ti, inter) = encode_pair(self.perception, x)
 
         """ ###### APPLY THE MEASUREMENT MODULE """
         m_t = self.measurements(m[0])
@@ -770,12 +795,12 @@ class ETE_inverse_model(nn.Module):
         branch_number = command_number_to_index(branch_number)
 
         if len(branch_number) > 1:
-            branch_number = torch.squeeze(branch_number.type(torch.cuda.LongTensor))
+            branch_number = torch.squeeze(branch_number.long().to(output_vec.device))
         else:
-            branch_number = branch_number.type(torch.cuda.LongTensor)
+            branch_number = branch_number.long().to(output_vec.device)
 
         branch_number = torch.stack([branch_number,
-                                     torch.cuda.LongTensor(range(0, len(branch_number)))])
+                                     torch.arange(len(branch_number), device=output_vec.device)])
 
         return output_vec[branch_number[0], branch_number[1], :]
 
@@ -863,6 +888,10 @@ class STDIM(nn.Module):
                                             'dropouts': params['join']['fc']['dropouts'],
                                             'end_layer': False}),
                     'mode': 'cat'})
+
+        # The frames of a pair may be encoded together and still normalized separately
+        convert_chunked_batchnorm(self)
+
     def forward(self, x, m, c):
         """
         Args:
@@ -878,8 +907,8 @@ class STDIM(nn.Module):
         # NOTE all the samples are positive. Less than N frames distance.
 
         # global features from previous t-1 and current t
-        x_t_prev, inter_prev = self.encode_conv(x[0])  # frame before the action
-        x_t, inter = self.encode_conv(x[1])  # frame after the action
+        # frame before and after the action
+        (x_t_prev, inter_prev), (x_t, inter) = encode_pair(self.encode_conv, x)
 
         """ ###### APPLY THE MEASUREMENT MODULE """
         m_t_prev = self.measurements(m[0])
@@ -894,45 +923,57 @@ class STDIM(nn.Module):
         x_t_prev_local = inter_prev[4]  # get the feature maps of the last resnet layer
         x_t_local = inter[4]
 
-        sy = x_t_prev_local.size(2)
-        sx = x_t_prev_local.size(3)
-
-        # Loss 1: Global at time t-1, the local features from previous patches at time t
-        N = f_t_global.size(0)
-        loss1 = 0.
-        # iterate over the local features that have 512 channels
-        for y in range(sy):
-            for x in range(sx):
-
-                # take the global features of time t -> shape [120, 512]
-                predictions = f_t_global
-                # the local features of time t-1 at [y,x] -> shape [120, 512]
-                positive = self.join_obs(x_t_prev_local[:, :, y, x],
-                                         m_t_prev, c_t_prev)
-                logits = torch.matmul(predictions, positive.t())
-                step_loss = F.cross_entropy(logits, torch.arange(N).cuda())
-                loss1 += step_loss
-        loss1 = loss1 / (sx * sy)
-
-        loss2 = 0.
-        for y in range(sy):
-            for x in range(sx):
-
-                # take the local features of time t
-                predictions = self.join_obs(x_t_local[:, :, y, x],
-                                            m_t, c_t)
-                # the local features of time t-1
-                positive = self.join_obs(x_t_prev_local[:, :, y, x],
-                                         m_t_prev, c_t_prev)
-
-                logits = torch.matmul(predictions, positive.t())
-                step_loss = F.cross_entropy(logits, torch.arange(N).cuda())
-                loss2 += step_loss
-        loss2 = loss2 / (sx * sy)
+        # The local features of every position are projected at once, [positions, N, 512]
+        positive = self.join_local(x_t_prev_local, m_t_prev, c_t_prev)
+        predictions_local = self.join_local(x_t_local, m_t, c_t)
+
+        # Loss 1: Global at time t, the local features from previous patches at time t-1
+        loss1 = self.infonce_loss(f_t_global, positive)
+
+        # Loss 2: local features of time t, the local features of time t-1 at the same patch
+        loss2 = self.infonce_loss(predictions_local, positive)
         loss = loss1 + loss2
 
         return loss, x_t_prev_local, x_t_local
 
+    def join_local(self, local_features, m, c):
+        """
+            Apply the join module to the local features of every spatial position in a single call.
+        Args:
+            local_features: the feature maps, [mini_batch, channels, sy, sx]
+            m: the processed measurements, [mini_batch, neurons]
+            c: the processed commands, [mini_batch, neurons]
+        Returns:
+            The joined features, [sy * sx, mini_batch, join neurons]
+        """
+        N, C, sy, sx = local_features.size()
+        positions = sy * sx
+        # Sample major, so each sample repeats its measurements and commands for all its positions
+        local_features = local_features.permute(0, 2, 3, 1).reshape(N * positions, C)
+        joined = self.join_obs(local_features,
+                               m.repeat_interleave(positions, dim=0),
+                               c.repeat_interleave(positions, dim=0))
+
+        return joined.view(N, positions, -1).transpose(0, 1)
+
+    @staticmethod
+    def infonce_loss(predictions, positive):
+        """
+            InfoNCE over all the spatial positions at once. For each position the positive pair
+            of a sample is the same sample, all the other samples of the batch are negatives.
+        Args:
+            predictions: [positions, mini_batch, neurons], or [mini_batch, neurons] to use the
+                same prediction on every position
+            positive: [positions, mini_batch, neurons]
+        Returns:
+            The cross entropy averaged over the positions and the batch
+        """
+        positions, N = positive.size(0), positive.size(1)
+        logits = torch.matmul(predictions, positive.transpose(1, 2))  # [positions, N, N]
+        targets = torch.arange(N, device=logits.device).repeat(positions)
+
+        return F.cross_entropy(logits.reshape(positions * N, N), targets)
+
     def forward_encoder(self, x, m, c):
         """
         Args:
@@ -996,6 +1037,9 @@ class ForwardInverse(nn.Module):
                                   'dropouts': params['decode']['fc']['dropouts'] + [0.0],
                                   'end_layer': True})
 
+        # The frames of a pair may be encoded together and still normalized separately
+        convert_chunked_batchnorm(self)
+
     def forward(self, x, m, c, a):
         """
         Args:
@@ -1009,8 +1053,7 @@ class ForwardInverse(nn.Module):
         Returns:
         """
         # Encode f_t and f_t+1
-        f_t, x_t, inter = self.encoder(x[0], m[0], c[0])
-        f_ti, x_ti, inter_2 = self.encoder(x[1], m[1], c[1])
+        (f_t, x_t, inter), (f_ti, x_ti, inter_2) = encode_pair(self.encoder, x, m, c)
 
         """ We expand the action representation"""
         # Perform the action space expansion, the action at time t input expansion
@@ -1144,15 +1187,15 @@ class FIMBC(nn.Module):
         y_pos = len(g_conf.ACTION_CLASS_RANGE['throttle']) + 1
         z_pos = len(g_conf.ACTION_CLASS_RANGE['brake']) + 1
         loss1 = F.cross_entropy(inverse_out[:, 0:x_pos], a_c[:, 0].long(),
-                                weight=torch.FloatTensor(
-                                    g_conf.ACTION_VARIABLE_WEIGHT['steer']).cuda())
+                                weight=device_constant(
+                                    tuple(g_conf.ACTION_VARIABLE_WEIGHT['steer']), inverse_out.device))
         loss2 = F.cross_entropy(inverse_out[:, x_pos:x_pos + y_pos], a_c[:, 1].long(),
-                                weight=torch.FloatTensor(
-                                    g_conf.ACTION_VARIABLE_WEIGHT['throttle']).cuda())
+                                weight=device_constant(
+                                    tuple(g_conf.ACTION_VARIABLE_WEIGHT['throttle']), inverse_out.device))
         loss3 = F.cross_entropy(inverse_out[:, x_pos + y_pos:x_pos + y_pos + z_pos],
                                 a_c[:, 2].long(),
-                                weight=torch.FloatTensor(
-                                    g_conf.ACTION_VARIABLE_WEIGHT['brake']).cuda())
+                                weight=device_constant(
+                                    tuple(g_conf.ACTION_VARIABLE_WEIGHT['brake']), inverse_out.device))
         inverse_loss = loss1 + loss2 + loss3
 
         loss = loss_bc * g_conf.LOSSES_WEIGHTS['bc'] + \
@@ -1262,15 +1305,15 @@ class FIMBC2(nn.Module):
         y_pos = len(g_conf.ACTION_CLASS_RANGE['throttle']) + 1
         z_pos = len(g_conf.ACTION_CLASS_RANGE['brake']) + 1
         loss1 = F.cross_entropy(inverse_out[:, 0:x_pos], a_c[:, 0].long(),
-                                weight=torch.FloatTensor(
-                                    g_conf.ACTION_VARIABLE_WEIGHT['steer']).cuda())
+                                weight=device_constant(
+                                    tuple(g_conf.ACTION_VARIABLE_WEIGHT['steer']), inverse_out.device))
         loss2 = F.cross_entropy(inverse_out[:, x_pos:x_pos + y_pos], a_c[:, 1].long(),
-                                weight=torch.FloatTensor(
-                                    g_conf.ACTION_VARIABLE_WEIGHT['throttle']).cuda())
+                                weight=device_constant(
+                                    tuple(g_conf.ACTION_VARIABLE_WEIGHT['throttle']), inverse_out.device))
         loss3 = F.cross_entropy(inverse_out[:, x_pos + y_pos:x_pos + y_pos + z_pos],
                                 a_c[:, 2].long(),
-                                weight=torch.FloatTensor(
-                                    g_conf.ACTION_VARIABLE_WEIGHT['brake']).cuda())
+                                weight=device_constant(
+                                    tuple(g_conf.ACTION_VARIABLE_WEIGHT['brake']), inverse_out.device))
         inverse_loss = loss1 + loss2 + loss3
 
 
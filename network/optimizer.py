@@ -1,6 +1,8 @@
-import dlib
-
 from configs import g_conf
+from coilutils.lazy_import import lazy_import
+
+# Only the automatic learning rate schedule needs it
+dlib = lazy_import('dlib')
 
 
 
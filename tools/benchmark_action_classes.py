@@ -0,0 +1,91 @@
+"""
+    Benchmark of the action discretization. It compares the ActionDiscretizer, one bucketize
+    per control, with the original implementation that builds the classes with a torch.where
+    per bin edge, and checks that both give the same class ids, edges included.
+
+    python3 -m tools.benchmark_action_classes --batch-size 120 --device cpu
+"""
+import argparse
+import time
+
+import torch
+
+from configs import g_conf
+from coilutils.action_discretizer import ActionDiscretizer
+
+
+def loop_classes(values, edges):
+    """
+        The classes of one control computed bin by bin, as CoILDataset.action_class did before
+        the ActionDiscretizer. Only used as reference.
+    """
+    if len(edges) == 1:
+        return torch.where(values < edges[0], torch.full(values.shape, 0, device=values.device),
+                           torch.full(values.shape, 1, device=values.device)).float()
+
+    classes = torch.full(values.shape, 0, device=values.device).float()
+    for bin_id in range(1, len(edges) + 1):
+        if bin_id == len(edges):
+            target_c = torch.where(values >= edges[-1], torch.full(values.shape, bin_id, device=values.device),
+                                   torch.full(values.shape, 0, device=values.device)).float()
+        else:
+            target_c_1 = torch.where(values >= edges[bin_id - 1],
+                                     torch.full(values.shape, bin_id, device=values.device),
+                                     torch.full(values.shape, 0, device=values.device))
+            target_c_2 = torch.where(values < edges[bin_id], torch.full(values.shape, bin_id, device=values.device),
+                                     torch.full(values.shape, 0, device=values.device))
+            target_c = (target_c_1 == target_c_2).float() * bin_id
+        classes = classes + target_c
+
+    return classes
+
+
+def loop_discretize(actions):
+    return torch.cat([loop_classes(actions[:, i:i + 1], g_conf.ACTION_CLASS_RANGE[name])
+                      for i, name in enumerate(g_conf.TARGETS)], 1)
+
+
+def time_iterations(function, actions, iterations, warmup):
+    """ Mean time in milliseconds of a discretization of the batch. """
+    for i in range(warmup + iterations):
+        if i == warmup:
+            if actions.is_cuda:
+                torch.cuda.synchronize()
+            start = time.time()
+        function(actions)
+    if actions.is_cuda:
+        torch.cuda.synchronize()
+
+    return (time.time() - start) * 1000.0 / iterations
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description=__doc__)
+    argparser.add_argument('--batch-size', dest='batch_size', default=120, type=int)
+    argparser.add_argument('--iterations', default=200, type=int)
+    argparser.add_argument('--warmup', default=10, type=int)
+    argparser.add_argument('--device', default='cpu', type=str)
+    args = argparser.parse_args()
+
+    discretizer = ActionDiscretizer()
+    actions = torch.stack([torch.rand(args.batch_size) * 2.0 - 1.0, torch.rand(args.batch_size),
+                           torch.rand(args.batch_size)], 1).to(args.device)
+    # The values on the edges are the ones a wrong comparison would misplace
+    edges = torch.tensor([[edge if name == target else 0.0 for target in g_conf.TARGETS]
+                          for name in g_conf.TARGETS for edge in g_conf.ACTION_CLASS_RANGE[name]])
+    actions = torch.cat([actions, edges.to(args.device)])
+
+    reference = loop_discretize(actions)
+    vectorised = discretizer(actions).float()
+    mismatches = int((reference != vectorised).sum())
+    print("Class ids that differ: %d of %d" % (mismatches, reference.numel()))
+    if mismatches:
+        raise RuntimeError("The ActionDiscretizer classes do not match the reference")
+    if not torch.equal(discretizer(discretizer.decode(discretizer(actions))), discretizer(actions)):
+        raise RuntimeError("The decoded controls do not fall in their classes")
+
+    loop_ms = time_iterations(loop_discretize, actions, args.iterations, args.warmup)
+    vectorised_ms = time_iterations(discretizer, actions, args.iterations, args.warmup)
+    print("Batch %d on %s" % (actions.size(0), args.device))
+    print("Discretization time   loop: %.3f ms   bucketize: %.3f ms   speedup: %.2fx" % (
+        loop_ms, vectorised_ms, loop_ms / vectorised_ms))
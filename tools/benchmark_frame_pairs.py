@@ -0,0 +1,125 @@
+"""
+    Training throughput of the encoders that take pairs of frames, with the two frames encoded
+    by separate calls or fused in a single call (FUSED_FRAME_PAIRS), normalizing each frame
+    with its own statistics or both together (FRAME_PAIR_BATCHNORM). It first checks that the
+    fused per_frame loss matches the one of the separate calls.
+
+    python3 -m tools.benchmark_frame_pairs --gpu 0 -e configs/ENCODER/forward_im_20HoursRandom_seed1.yaml \
+        configs/ENCODER/inverse_im_20HoursRandom_seed1.yaml configs/ENCODER/stdim_im_20HoursRandom_seed1.yaml
+"""
+import argparse
+import copy
+import os
+import time
+
+import torch
+import torch.nn as nn
+
+from configs import g_conf, merge_with_yaml
+from network import EncoderModel
+
+
+PAIR_MODEL_TYPES = ['forward', 'action_prediction', 'stdim', 'ETE_inverse_model']
+
+# The modes compared, as (FUSED_FRAME_PAIRS, FRAME_PAIR_BATCHNORM)
+MODES = {'separate': (False, 'per_frame'),
+         'fused per_frame': (True, 'per_frame'),
+         'fused joint': (True, 'joint')}
+
+
+def set_mode(mode):
+    g_conf.FUSED_FRAME_PAIRS, g_conf.FRAME_PAIR_BATCHNORM = MODES[mode]
+
+
+def pair_loss(model, x, m, c, a):
+    # The STDIM model learns without the actions
+    if g_conf.ENCODER_MODEL_TYPE == 'stdim':
+        return model(x, m, c)[0]
+
+    return model(x, m, c, a)[0]
+
+
+def time_iterations(model, inputs, iterations, warmup):
+    """ Mean time in milliseconds of a forward and backward pass. """
+    for i in range(warmup + iterations):
+        if i == warmup:
+            torch.cuda.synchronize()
+            start = time.time()
+        model.zero_grad()
+        pair_loss(model, *inputs).backward()
+    torch.cuda.synchronize()
+
+    return (time.time() - start) * 1000.0 / iterations
+
+
+def check_equivalence(model, inputs):
+    """
+        Compare the loss of the separate calls with the fused per_frame one, in training mode so
+        the batch statistics are used. The dropouts are disabled on copies of the model.
+    """
+    losses = {}
+    for mode in ['separate', 'fused per_frame']:
+        reference = copy.deepcopy(model).train()
+        for module in reference.modules():
+            if isinstance(module, nn.modules.dropout._DropoutNd):
+                module.p = 0.0
+        set_mode(mode)
+        with torch.no_grad():
+            losses[mode] = pair_loss(reference, *inputs).item()
+
+    difference = abs(losses['separate'] - losses['fused per_frame'])
+    print("Loss   separate: %.6f   fused per_frame: %.6f   abs diff: %.2e" % (
+        losses['separate'], losses['fused per_frame'], difference))
+    if difference > 1e-4 * max(1.0, abs(losses['separate'])):
+        raise RuntimeError("The fused per_frame loss does not match the separate calls")
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description=__doc__)
+    argparser.add_argument('--gpu', default='0', type=str)
+    argparser.add_argument('-e', '--exp-configs', dest='exp_configs', nargs='+', type=str,
+                           default=[os.path.join('configs', 'ENCODER', name + '.yaml')
+                                    for name in ['forward_im_20HoursRandom_seed1',
+                                                 'inverse_im_20HoursRandom_seed1',
+                                                 'stdim_im_20HoursRandom_seed1']],
+                           help='The encoder yamls used to build the models, one per model type')
+    argparser.add_argument('--batch-size', dest='batch_size', default=None, type=int,
+                           help='Defaults to the BATCH_SIZE of each configuration')
+    argparser.add_argument('--iterations', default=20, type=int)
+    argparser.add_argument('--warmup', default=5, type=int)
+    args = argparser.parse_args()
+
+    os.environ["CUDA_VISIBLE_DEVICES"] = args.gpu
+    for exp_config in args.exp_configs:
+        merge_with_yaml(exp_config)
+        if g_conf.ENCODER_MODEL_TYPE not in PAIR_MODEL_TYPES:
+            raise ValueError("The configuration %s is not one of the pair models %s" % (exp_config,
+                                                                                     PAIR_MODEL_TYPES))
+        # No need to download the ImageNet weights to measure time
+        g_conf.PRE_TRAINED = False
+        if args.batch_size is not None:
+            # The losses are normalized by the configured batch size
+            g_conf.BATCH_SIZE = args.batch_size
+        batch_size = g_conf.BATCH_SIZE
+
+        torch.manual_seed(0)
+        model = EncoderModel(g_conf.ENCODER_MODEL_TYPE, g_conf.ENCODER_MODEL_CONFIGURATION).cuda()
+
+        channels, height, width = next(iter(g_conf.SENSORS.values()))
+        commands = torch.zeros(batch_size, 4)
+        commands[torch.arange(batch_size), torch.randint(0, 4, (batch_size,))] = 1.0
+        inputs = ([torch.randn(batch_size, channels, height, width).cuda() for _ in range(2)],
+                  [torch.rand(batch_size, 1).cuda() for _ in range(2)],
+                  [commands.cuda(), commands.cuda()],
+                  torch.rand(batch_size, 3).cuda())
+
+        print("%s (%s), input %dx%d, batch %d" % (os.path.basename(exp_config), g_conf.ENCODER_MODEL_TYPE,
+                                                 height, width, batch_size))
+        check_equivalence(model, inputs)
+        model.train()
+        times = {}
+        for mode in MODES:
+            set_mode(mode)
+            times[mode] = time_iterations(model, inputs, args.iterations, args.warmup)
+            print("   %-16s %8.1f ms   %8.1f pairs/s   speedup: %.2fx" % (
+                mode, times[mode], batch_size * 1000.0 / times[mode], times['separate'] / times[mode]))
@@ -0,0 +1,102 @@
+"""
+    Benchmark of the fused affordance heads (FUSED_HEADS) against the Branching ones. It builds
+    the head model of an experiment both ways with the same weights, checks that the outputs
+    match and times a training iteration (forward, loss and backward over BATCH_SIZE embeddings)
+    and an agent step (a forward of a single embedding).
+
+    python3 -m tools.benchmark_heads --gpu 0 -e configs/EXP/stdim_im_20HoursRandom_seed1_encoder_frozen_1FC_30mins_s1.yaml
+"""
+import argparse
+import os
+import time
+
+import torch
+
+from configs import g_conf, merge_with_yaml
+from network import CoILModel
+
+
+def build_model(fused):
+    g_conf.FUSED_HEADS = fused
+    torch.manual_seed(0)
+    return CoILModel(g_conf.MODEL_TYPE, g_conf.MODEL_CONFIGURATION,
+                     g_conf.ENCODER_MODEL_CONFIGURATION).cuda()
+
+
+def time_function(function, iterations, warmup):
+    """ Mean time in milliseconds of a call. """
+    for i in range(warmup + iterations):
+        if i == warmup:
+            torch.cuda.synchronize()
+            start = time.time()
+        function()
+    torch.cuda.synchronize()
+
+    return (time.time() - start) * 1000.0 / iterations
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description=__doc__)
+    argparser.add_argument('--gpu', default='0', type=str)
+    argparser.add_argument('-e', '--exp-config', dest='exp_config', type=str,
+                           default=os.path.join('configs', 'EXP',
+                                                'stdim_im_20HoursRandom_seed1_encoder_frozen_1FC_30mins_s1.yaml'))
+    argparser.add_argument('--iterations', default=200, type=int)
+    argparser.add_argument('--warmup', default=20, type=int)
+    args = argparser.parse_args()
+
+    os.environ["CUDA_VISIBLE_DEVICES"] = args.gpu
+    merge_with_yaml(args.exp_config)
+
+    branching_model = build_model(False)
+    fused_model = build_model(True)
+    # The Branching weights are converted when loaded on the fused heads
+    fused_model.load_state_dict(branching_model.state_dict())
+
+    embedding_size = next(m for m in branching_model.modules()
+                          if isinstance(m, torch.nn.Linear)).in_features
+    number_of_classification = g_conf.MODEL_CONFIGURATION['affordances']['number_of_classification']
+    number_of_regression = g_conf.MODEL_CONFIGURATION['affordances']['number_of_regression']
+    batch_size = g_conf.BATCH_SIZE
+    z = torch.randn(batch_size, embedding_size).cuda()
+    loss_function_params = {
+        'classification_gt': torch.randint(0, 2, (batch_size, number_of_classification)).float().cuda(),
+        'class_weights': [[1.0, 1.0]] * number_of_classification,
+        'regression_gt': torch.randn(batch_size, number_of_regression).cuda(),
+        'variable_weights': [1.0] * number_of_regression
+    }
+
+    with torch.no_grad():
+        branching_model.eval()
+        fused_model.eval()
+        branching_outputs = branching_model.forward_test(z)
+        fused_outputs = fused_model.forward_test(z)
+        difference = max((a - b).abs().max().item()
+                         for outputs_a, outputs_b in zip(branching_outputs, fused_outputs)
+                         for a, b in zip(outputs_a, outputs_b))
+    print("Max output difference: %.2e" % difference)
+    if difference > 1e-5:
+        raise RuntimeError("The fused heads do not match the Branching ones")
+
+    results = {}
+    for name, model in [('branching', branching_model), ('fused', fused_model)]:
+
+        def train_step():
+            model.zero_grad()
+            model(z, loss_function_params).backward()
+
+        def agent_step():
+            with torch.no_grad():
+                model.forward_test(z[:1])
+
+        model.train()
+        train_ms = time_function(train_step, args.iterations, args.warmup)
+        model.eval()
+        agent_ms = time_function(agent_step, args.iterations, args.warmup)
+        results[name] = (train_ms, agent_ms)
+
+    print("Batch %d, %d classification and %d regression heads" % (batch_size, number_of_classification,
+                                                                   number_of_regression))
+    print("{:<10} {:>18} {:>16}".format('Heads', 'iteration (ms)', 'agent step (ms)'))
+    for name, (train_ms, agent_ms) in results.items():
+        print("{:<10} {:>18.3f} {:>16.3f}".format(name, train_ms, agent_ms))
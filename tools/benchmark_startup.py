@@ -0,0 +1,63 @@
+"""
+    Startup time of the entry points. Each one is imported in a fresh interpreter, as the
+    processes started by the executer and the driving benchmark do, and the time of the
+    import is reported together with the heavy dependencies it loaded.
+
+    python3 -m tools.benchmark_startup
+    python3 -m tools.benchmark_startup --entry-points main coil_core.validate drive.AffordancesAgent
+"""
+import argparse
+import json
+import subprocess
+import sys
+
+
+ENTRY_POINTS = ['main', 'coil_core.train', 'coil_core.train_encoder', 'coil_core.validate',
+                'drive.AffordancesAgent', 'drive.ETEAgent', 'tools.export_onnx', 'tools.quantize']
+
+# The dependencies that are worth loading only when they are used
+HEAVY_MODULES = ['torch', 'torchvision', 'cv2', 'matplotlib', 'scipy', 'imgaug', 'dlib', 'tensorflow',
+                 'PIL', 'carla', 'cexp', 'onnxruntime']
+
+IMPORT_SCRIPT = """
+import json, sys, time
+start = time.time()
+import %s
+elapsed = time.time() - start
+print(json.dumps({'seconds': elapsed, 'modules': [m for m in %r if m in sys.modules]}))
+"""
+
+
+def time_import(entry_point):
+    """
+        Import an entry point on a new interpreter.
+
+    Returns:
+        The import time in seconds and the heavy modules loaded, or the error of the import
+    """
+    process = subprocess.run([sys.executable, '-c', IMPORT_SCRIPT % (entry_point, HEAVY_MODULES)],
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    if process.returncode != 0:
+        error = process.stderr.strip().splitlines()
+        raise RuntimeError(error[-1] if error else "exit code %d" % process.returncode)
+
+    return json.loads(process.stdout.strip().splitlines()[-1])
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description=__doc__)
+    argparser.add_argument('--entry-points', dest='entry_points', nargs='+', default=ENTRY_POINTS,
+                           help='The modules to import, the driving agents need the carla client')
+    argparser.add_argument('--repetitions', default=3, type=int,
+                           help='The best time of the repetitions is reported')
+    args = argparser.parse_args()
+
+    print("{:<26} {:>10}   {}".format('entry point', 'import s', 'heavy modules loaded'))
+    for entry_point in args.entry_points:
+        try:
+            results = [time_import(entry_point) for _ in range(args.repetitions)]
+        except RuntimeError as error:
+            print("{:<26} {:>10}   {}".format(entry_point, 'failed', error))
+            continue
+        print("{:<26} {:>10.3f}   {}".format(entry_point, min(result['seconds'] for result in results),
+                                            ' '.join(results[0]['modules'])))
@@ -0,0 +1,120 @@
+"""
+    Benchmark of the STDIM InfoNCE loss. It compares the vectorised loss of the STDIM model with
+    the original implementation, that loops over every position of the feature map, and checks
+    that both give the same value.
+
+    python3 -m tools.benchmark_stdim --gpu 0 -e configs/ENCODER/stdim_im_20HoursRandom_seed1.yaml
+"""
+import argparse
+import os
+import time
+
+import torch
+from torch.nn import functional as F
+
+from configs import g_conf, merge_with_yaml
+from network import EncoderModel
+
+
+def loop_loss(model, x, m, c):
+    """
+        The STDIM loss computed one position of the feature map at a time, as it was done before
+        the vectorised version. Only used as reference.
+    """
+    x_t_prev, inter_prev = model.encode_conv(x[0])
+    x_t, inter = model.encode_conv(x[1])
+    m_t_prev = model.measurements(m[0])
+    m_t = model.measurements(m[1])
+    c_t_prev = model.command(c[0])
+    c_t = model.command(c[1])
+    f_t_global = model.join_obs(x_t, m_t, c_t)
+
+    x_t_prev_local = inter_prev[4]
+    x_t_local = inter[4]
+    sy = x_t_prev_local.size(2)
+    sx = x_t_prev_local.size(3)
+    N = f_t_global.size(0)
+
+    loss1 = 0.
+    for y in range(sy):
+        for x in range(sx):
+            positive = model.join_obs(x_t_prev_local[:, :, y, x], m_t_prev, c_t_prev)
+            logits = torch.matmul(f_t_global, positive.t())
+            loss1 += F.cross_entropy(logits, torch.arange(N).cuda())
+    loss1 = loss1 / (sx * sy)
+
+    loss2 = 0.
+    for y in range(sy):
+        for x in range(sx):
+            predictions = model.join_obs(x_t_local[:, :, y, x], m_t, c_t)
+            positive = model.join_obs(x_t_prev_local[:, :, y, x], m_t_prev, c_t_prev)
+            logits = torch.matmul(predictions, positive.t())
+            loss2 += F.cross_entropy(logits, torch.arange(N).cuda())
+    loss2 = loss2 / (sx * sy)
+
+    return loss1 + loss2
+
+
+def vectorised_loss(model, x, m, c):
+    loss, _, _ = model(x, m, c)
+    return loss
+
+
+def time_iterations(loss_function, model, inputs, iterations, warmup):
+    """ Mean time in milliseconds of a forward and backward pass. """
+    for i in range(warmup + iterations):
+        if i == warmup:
+            torch.cuda.synchronize()
+            start = time.time()
+        model.zero_grad()
+        loss_function(model, *inputs).backward()
+    torch.cuda.synchronize()
+
+    return (time.time() - start) * 1000.0 / iterations
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description=__doc__)
+    argparser.add_argument('--gpu', default='0', type=str)
+    argparser.add_argument('-e', '--exp-config', dest='exp_config', type=str,
+                           default=os.path.join('configs', 'ENCODER', 'stdim_im_20HoursRandom_seed1.yaml'),
+                           help='The STDIM encoder yaml used to build the model')
+    argparser.add_argument('--batch-size', dest='batch_size', default=None, type=int,
+                           help='Defaults to the BATCH_SIZE of the configuration')
+    argparser.add_argument('--iterations', default=20, type=int)
+    argparser.add_argument('--warmup', default=5, type=int)
+    args = argparser.parse_args()
+
+    os.environ["CUDA_VISIBLE_DEVICES"] = args.gpu
+    merge_with_yaml(args.exp_config)
+    if g_conf.ENCODER_MODEL_TYPE != 'stdim':
+        raise ValueError("The configuration %s is not a STDIM encoder" % args.exp_config)
+    # No need to download the ImageNet weights to measure time
+    g_conf.PRE_TRAINED = False
+    batch_size = args.batch_size if args.batch_size is not None else g_conf.BATCH_SIZE
+
+    torch.manual_seed(0)
+    model = EncoderModel(g_conf.ENCODER_MODEL_TYPE, g_conf.ENCODER_MODEL_CONFIGURATION).cuda()
+    # The dropouts would make the two losses differ
+    model.eval()
+
+    channels, height, width = next(iter(g_conf.SENSORS.values()))
+    commands = torch.zeros(batch_size, 4)
+    commands[torch.arange(batch_size), torch.randint(0, 4, (batch_size,))] = 1.0
+    inputs = ([torch.randn(batch_size, channels, height, width).cuda() for _ in range(2)],
+              [torch.rand(batch_size, 1).cuda() for _ in range(2)],
+              [commands.cuda(), commands.cuda()])
+
+    with torch.no_grad():
+        reference = loop_loss(model, *inputs).item()
+        vectorised = vectorised_loss(model, *inputs).item()
+    print("Loss   loop: %.6f   vectorised: %.6f   abs diff: %.2e" % (reference, vectorised,
+                                                                     abs(reference - vectorised)))
+    if abs(reference - vectorised) > 1e-4 * max(1.0, abs(reference)):
+        raise RuntimeError("The vectorised STDIM loss does not match the reference")
+
+    loop_ms = time_iterations(loop_loss, model, inputs, args.iterations, args.warmup)
+    vectorised_ms = time_iterations(vectorised_loss, model, inputs, args.iterations, args.warmup)
+    print("Input %dx%d, batch %d" % (height, width, batch_size))
+    print("Iteration time   loop: %.1f ms   vectorised: %.1f ms   speedup: %.2fx" % (
+        loop_ms, vectorised_ms, loop_ms / vectorised_ms))
@@ -0,0 +1,60 @@
+"""
+    Convert the affordance heads of a checkpoint between the Branching layout and the fused
+    GroupedFC layout (FUSED_HEADS). Loading a Branching checkpoint on a fused model is done
+    automatically, this is needed to go back, or to store the converted file.
+
+    The optimizer state is not kept, since the number of parameters changes; a converted
+    checkpoint is meant for validation and driving, not to resume a training.
+
+    python3 -m tools.convert_fused_heads _logs/EXP/alias/checkpoints/100000.pth out.pth --to branching
+"""
+import argparse
+import re
+
+import torch
+
+from network.models.building_blocks import branching_to_grouped_state_dict, grouped_to_branching_state_dict
+
+
+HEADS = ['affordances_classification.', 'affordances_regression.']
+
+
+def to_fused(state_dict):
+    for prefix in HEADS:
+        layout = [re.match(re.escape(prefix) + r'branched_modules\.(\d+)\.layers\.(\d+)\.0\.(weight|bias)$', key)
+                  for key in state_dict if key.startswith(prefix)]
+        if len(layout) == 0:
+            continue
+        if any(match is None for match in layout):
+            print("Skipping", prefix[:-1], ": its branches are not plain FC stacks")
+            continue
+        number_of_groups = max(int(match.group(1)) for match in layout) + 1
+        number_of_layers = max(int(match.group(2)) for match in layout) + 1
+        branching_to_grouped_state_dict(state_dict, prefix, number_of_groups, number_of_layers)
+
+
+def to_branching(state_dict):
+    for prefix in HEADS:
+        layers = [re.match(re.escape(prefix) + r'weight\.(\d+)$', key) for key in state_dict]
+        layers = [match for match in layers if match is not None]
+        if len(layers) == 0:
+            continue
+        grouped_to_branching_state_dict(state_dict, prefix, max(int(match.group(1)) for match in layers) + 1)
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description=__doc__)
+    argparser.add_argument('checkpoint', type=str)
+    argparser.add_argument('output', type=str)
+    argparser.add_argument('--to', choices=['fused', 'branching'], required=True)
+    args = argparser.parse_args()
+
+    checkpoint = torch.load(args.checkpoint, map_location='cpu')
+    state_dict = checkpoint['state_dict']
+    if args.to == 'fused':
+        to_fused(state_dict)
+    else:
+        to_branching(state_dict)
+    checkpoint.pop('optimizer', None)
+    torch.save(checkpoint, args.output)
+    print("Saved", args.output)
@@ -0,0 +1,130 @@
+"""
+    The speed and quality trade-off of a distillation experiment against its teacher.
+
+    For both models it reports the encoder parameters, the inference latency of the encoder
+    plus the affordance heads, at batch 1 as the driving agents run and at a validation batch,
+    and the affordance metrics of their validation summaries on the same validation json.
+    Validate the distillation experiment first, as any other experiment. It is also driven as
+    any other separate-affordances experiment, so the benchmark results compare the same way.
+
+    python3 -m tools.distill_report -f DISTILL -e EXP_ALIAS -vj VALIDATION_JSON
+"""
+import argparse
+import os
+import time
+
+import torch
+
+from configs import g_conf, merge_with_yaml
+from coil_core.train_distill import load_teacher, teacher_experiment_name
+from network.inference import AffordancesInference, load_affordances_inference, set_intermediate_outputs
+from coilutils.metrics import binary_metrics, SUMMARY_NAMES
+
+
+def read_validation_summary(path):
+    """
+        The affordance metrics of each checkpoint of a validation summary csv.
+
+    Returns:
+        A dictionary from the checkpoint to its metrics
+    """
+    summary = {}
+    with open(path, 'r') as f:
+        next(f)  # header
+        for line in f:
+            if not line.strip():
+                continue
+            values = [float(value) for value in line.split(',')]
+            metrics = {}
+            for i, name in enumerate(SUMMARY_NAMES):
+                for key, value in binary_metrics(*values[1 + 4 * i: 5 + 4 * i]).items():
+                    metrics[name + '_' + key] = value
+            metrics['MAE_relative_angle'] = values[-1]
+            summary[int(values[0])] = metrics
+
+    return summary
+
+
+def random_inputs(batch_size, device):
+    channels, height, width = next(iter(g_conf.SENSORS.values()))
+    command = torch.zeros(batch_size, 4)
+    command[:, 0] = 1.0
+
+    return (torch.rand(batch_size, channels, height, width, device=device),
+            torch.rand(batch_size, 1, device=device), command.to(device))
+
+
+def time_model(model, inputs, iterations, warmup):
+    """ Mean time in milliseconds of a forward. """
+    with torch.no_grad():
+        for i in range(warmup + iterations):
+            if i == warmup:
+                if inputs[0].is_cuda:
+                    torch.cuda.synchronize()
+                start = time.time()
+            model(*inputs)
+        if inputs[0].is_cuda:
+            torch.cuda.synchronize()
+
+    return (time.time() - start) * 1000.0 / iterations
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description=__doc__)
+    argparser.add_argument('-f', '--folder', type=str, required=True)
+    argparser.add_argument('-e', '--exp', type=str, required=True)
+    argparser.add_argument('--checkpoint', default=None, type=int,
+                           help='The student checkpoint, the last validated one by default')
+    argparser.add_argument('-vj', '--val-json', dest='val_json', required=True,
+                           help='The validation json both experiments were validated on')
+    argparser.add_argument('--batch-size', dest='batch_size', default=120, type=int)
+    argparser.add_argument('--iterations', default=50, type=int)
+    argparser.add_argument('--warmup', default=5, type=int)
+    argparser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    args = argparser.parse_args()
+
+    merge_with_yaml(os.path.join('configs', args.folder, args.exp + '.yaml'))
+    # The weights come from the checkpoints
+    g_conf.PRE_TRAINED = False
+    teacher = g_conf.DISTILL_TEACHER
+    json_file_name = args.val_json.split('/')[-1].split('.')[-2]
+    summary_name = os.path.join('validation_' + json_file_name + '_csv', 'valid_summary_1camera.csv')
+
+    teacher_summary = read_validation_summary(os.path.join('_logs', teacher['folder'],
+                                                           teacher_experiment_name(teacher), summary_name))
+    student_summary = read_validation_summary(os.path.join('_logs', args.folder, g_conf.EXPERIMENT_NAME,
+                                                           summary_name))
+    if args.checkpoint is None:
+        if not student_summary:
+            raise RuntimeError("The distillation experiment was not validated yet")
+        args.checkpoint = max(student_summary.keys())
+    for name, summary, checkpoint in [('teacher', teacher_summary, teacher['checkpoint']),
+                                      ('student', student_summary, args.checkpoint)]:
+        if checkpoint not in summary:
+            raise RuntimeError("The %s checkpoint %d was not validated on %s" % (name, checkpoint, json_file_name))
+
+    teacher_encoder, teacher_model = load_teacher(teacher, map_location='cpu')
+    models = {'teacher': AffordancesInference.from_models(teacher_model, teacher_encoder),
+              'student': load_affordances_inference(args.folder, args.checkpoint, None)}
+    metrics = {'teacher': teacher_summary[teacher['checkpoint']],
+               'student': student_summary[args.checkpoint]}
+
+    rows = {}
+    for name, model in models.items():
+        model.to(args.device).eval()
+        set_intermediate_outputs(model, [])
+        rows[name] = {'encoder_parameters': sum(p.numel() for p in model.encoder_model.parameters()),
+                      'ms_batch_1': time_model(model, random_inputs(1, args.device),
+                                               args.iterations, args.warmup),
+                      'ms_batch_%d' % args.batch_size: time_model(model, random_inputs(args.batch_size, args.device),
+                                                                  args.iterations, args.warmup)}
+        rows[name].update(metrics[name])
+
+    print("Teacher %s checkpoint %d, student %s checkpoint %d, on %s" %
+          (teacher_experiment_name(teacher), teacher['checkpoint'], g_conf.EXPERIMENT_NAME, args.checkpoint,
+           args.device))
+    print("{:<28} {:>14} {:>14} {:>14}".format('', 'teacher', 'student', 'student/teacher'))
+    for key in rows['teacher']:
+        teacher_value, student_value = rows['teacher'][key], rows['student'][key]
+        print("{:<28} {:>14.4f} {:>14.4f} {:>14.4f}".format(key, teacher_value, student_value,
+                                                             student_value / teacher_value if teacher_value else 0.0))
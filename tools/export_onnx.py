@@ -0,0 +1,122 @@
+"""
+    Export an experiment to ONNX, check it against PyTorch under ONNX Runtime and compare their
+    latency on the CPU.
+
+    Affordances experiments are exported as the encoder plus the affordance heads, end to end
+    driving encoders (ETE) as the action prediction of the commanded branch.
+    By default the graph is written next to the checkpoint, as <checkpoint>.onnx, where the
+    onnxruntime INFERENCE_BACKEND of validation and of the agents looks for it.
+
+    python3 -m tools.export_onnx -f EXP -e EXP_ALIAS --checkpoint 100000 --encoder-folder ENCODER \
+        --encoder-exp ENCODER_ALIAS --encoder-checkpoint 100000
+    python3 -m tools.export_onnx --model ete -f ENCODER -e ETE_ALIAS --checkpoint 100000
+"""
+import argparse
+import os
+import time
+
+import torch
+
+from configs import g_conf, merge_with_yaml
+from network import EncoderModel
+from network.inference import load_affordances_inference, ETEInference, export_onnx, OnnxRuntimeModel, \
+    set_intermediate_outputs
+
+
+def random_inputs(batch_size):
+    """ Inputs in the ranges of the dataset ones: images in [0, 1], speed and one hot commands. """
+    channels, height, width = next(iter(g_conf.SENSORS.values()))
+    command = torch.zeros(batch_size, 4)
+    command[torch.arange(batch_size), torch.randint(0, 4, (batch_size,))] = 1.0
+
+    return (torch.rand(batch_size, channels, height, width), torch.rand(batch_size, 1), command)
+
+
+def as_tuple(outputs):
+    return outputs if isinstance(outputs, tuple) else (outputs,)
+
+
+def time_function(function, inputs, iterations, warmup):
+    """ Mean time in milliseconds of a call. """
+    for i in range(warmup + iterations):
+        if i == warmup:
+            start = time.time()
+        function(*inputs)
+
+    return (time.time() - start) * 1000.0 / iterations
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description=__doc__)
+    argparser.add_argument('--model', default='affordances', choices=['affordances', 'ete'])
+    argparser.add_argument('-f', '--folder', type=str, required=True)
+    argparser.add_argument('-e', '--exp', type=str, required=True)
+    argparser.add_argument('--checkpoint', type=int, required=True)
+    argparser.add_argument('-encoder-f', '--encoder-folder', dest='encoder_folder', default=None, type=str)
+    argparser.add_argument('-encoder-e', '--encoder-exp', dest='encoder_exp', default=None, type=str)
+    argparser.add_argument('--encoder-checkpoint', dest='encoder_checkpoint', default=None, type=int)
+    argparser.add_argument('--batch-size', dest='batch_size', default=32, type=int,
+                           help='The batch of the validation-like latency measure')
+    argparser.add_argument('--opset', default=11, type=int)
+    argparser.add_argument('--iterations', default=50, type=int)
+    argparser.add_argument('--warmup', default=5, type=int)
+    argparser.add_argument('--threads', default=None, type=int)
+    argparser.add_argument('--tolerance', default=1e-3, type=float,
+                           help='The maximum absolute difference allowed between PyTorch and ONNX Runtime')
+    argparser.add_argument('-o', '--output', default=None, type=str)
+    args = argparser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    # The weights come from the checkpoints
+    if args.model == 'affordances':
+        if args.encoder_checkpoint and args.encoder_folder and args.encoder_exp:
+            encoder_params = {'encoder_checkpoint': args.encoder_checkpoint,
+                              'encoder_folder': args.encoder_folder,
+                              'encoder_exp': args.encoder_exp}
+        else:
+            encoder_params = None
+        merge_with_yaml(os.path.join('configs', args.folder, args.exp + '.yaml'), encoder_params)
+        g_conf.PRE_TRAINED = False
+        model = load_affordances_inference(args.folder, args.checkpoint, encoder_params)
+    else:
+        merge_with_yaml(os.path.join('configs', args.folder, args.exp + '.yaml'))
+        g_conf.PRE_TRAINED = False
+        if g_conf.ENCODER_MODEL_TYPE not in ['ETE']:
+            raise ValueError("The ete export needs an ETE encoder experiment")
+        encoder_model = EncoderModel(g_conf.ENCODER_MODEL_TYPE, g_conf.ENCODER_MODEL_CONFIGURATION)
+        checkpoint = torch.load(os.path.join('_logs', args.folder, g_conf.EXPERIMENT_NAME, 'checkpoints',
+                                             str(args.checkpoint) + '.pth'), map_location='cpu')
+        encoder_model.load_state_dict(checkpoint['state_dict'])
+        model = ETEInference(encoder_model).eval()
+    set_intermediate_outputs(model, [])
+
+    if args.output is None:
+        args.output = os.path.join('_logs', args.folder, g_conf.EXPERIMENT_NAME, 'checkpoints',
+                                   str(args.checkpoint) + '.onnx')
+    torch.manual_seed(0)
+    export_onnx(model, random_inputs(2), args.output, args.opset)
+    print("Saved the ONNX graph on ", args.output)
+
+    ort_model = OnnxRuntimeModel(args.output, args.threads)
+
+    # Parity, on a batch size that was not the exported one
+    inputs = random_inputs(args.batch_size)
+    with torch.no_grad():
+        torch_outputs = as_tuple(model(*inputs))
+    ort_outputs = as_tuple(ort_model(*inputs))
+    difference = max((a - b).abs().max().item() for a, b in zip(torch_outputs, ort_outputs))
+    print("Max difference between PyTorch and ONNX Runtime: %.2e" % difference)
+    if difference > args.tolerance:
+        raise RuntimeError("The ONNX graph does not match the PyTorch model")
+
+    def torch_function(*inputs):
+        with torch.no_grad():
+            return model(*inputs)
+
+    print("{:<22} {:>14} {:>14} {:>10}".format('CPU latency', 'PyTorch (ms)', 'ORT (ms)', 'speedup'))
+    for name, batch_size in [('agent step, batch 1', 1), ('batch %d' % args.batch_size, args.batch_size)]:
+        inputs = random_inputs(batch_size)
+        torch_ms = time_function(torch_function, inputs, args.iterations, args.warmup)
+        ort_ms = time_function(ort_model, inputs, args.iterations, args.warmup)
+        print("{:<22} {:>14.2f} {:>14.2f} {:>9.2f}x".format(name, torch_ms, ort_ms, torch_ms / ort_ms))
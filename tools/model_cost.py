@@ -0,0 +1,284 @@
+"""
+    The cost of the model of an experiment yaml, per module: parameters, FLOPs, activation
+    memory and forward latency, with the forward and backward latency of the whole model, at
+    the configured batch size. The models are built on CPU by default and without loading the
+    ImageNet weights.
+
+    The encoder yamls build the encoder with its training forward (the pair models compute
+    their loss). The affordances yamls build the encoder and the heads as they are deployed.
+    The FLOPs are counted on the convolutions, the linear and normalization layers and the
+    activations, the functional operations inside a forward (e.g. the STDIM logits or the
+    residual sums) are not counted.
+
+    python3 -m tools.model_cost -e configs/ENCODER/BC_im_50Hours_seed1.yaml --output cost.json
+"""
+import argparse
+import datetime
+import json
+import os
+import time
+
+import torch
+import torch.nn as nn
+
+from configs import g_conf, merge_with_yaml
+from network import CoILModel, EncoderModel
+from network.inference import AffordancesInference
+from network.models.building_blocks import GroupedFC
+
+
+PAIR_MODEL_TYPES = ['forward', 'action_prediction', 'stdim', 'ETE_inverse_model']
+
+ACTIVATIONS = (nn.ReLU, nn.LeakyReLU, nn.ELU, nn.Sigmoid, nn.Tanh, nn.Softmax, nn.MaxPool2d,
+               nn.AvgPool2d, nn.AdaptiveAvgPool2d)
+
+
+def build_model():
+    """
+        The model of the merged configuration and the way to call it.
+
+    Returns:
+        The model and its kind: 'affordances', 'single' for the one frame encoders or 'pair'
+    """
+    if g_conf.MODEL_TYPE in ['separate-affordances']:
+        encoder_model = EncoderModel(g_conf.ENCODER_MODEL_TYPE, g_conf.ENCODER_MODEL_CONFIGURATION)
+        model = CoILModel(g_conf.MODEL_TYPE, g_conf.MODEL_CONFIGURATION, g_conf.ENCODER_MODEL_CONFIGURATION)
+        return AffordancesInference.from_models(model, encoder_model), 'affordances'
+
+    if g_conf.ENCODER_MODEL_TYPE in ['one-step-affordances']:
+        model = EncoderModel(g_conf.ENCODER_MODEL_TYPE, g_conf.ENCODER_MODEL_CONFIGURATION)
+        return AffordancesInference.from_models(model), 'affordances'
+
+    if g_conf.ENCODER_MODEL_TYPE in ['ETE']:
+        return EncoderModel(g_conf.ENCODER_MODEL_TYPE, g_conf.ENCODER_MODEL_CONFIGURATION), 'single'
+
+    if g_conf.ENCODER_MODEL_TYPE in PAIR_MODEL_TYPES:
+        return EncoderModel(g_conf.ENCODER_MODEL_TYPE, g_conf.ENCODER_MODEL_CONFIGURATION), 'pair'
+
+    raise ValueError("The cost of %s models is not supported" % (g_conf.ENCODER_MODEL_TYPE or g_conf.MODEL_TYPE))
+
+
+def random_inputs(kind, batch_size, device):
+    channels, height, width = next(iter(g_conf.SENSORS.values()))
+    commands = torch.zeros(batch_size, 4)
+    commands[torch.arange(batch_size), torch.randint(0, 4, (batch_size,))] = 1.0
+
+    def frame():
+        return (torch.randn(batch_size, channels, height, width, device=device),
+                torch.rand(batch_size, 1, device=device), commands.to(device))
+
+    if kind != 'pair':
+        return frame()
+    x, m, c = zip(frame(), frame())
+    if g_conf.ENCODER_MODEL_TYPE == 'stdim':
+        return list(x), list(m), list(c)
+
+    return list(x), list(m), list(c), torch.rand(batch_size, 3, device=device)
+
+
+def tensors(output):
+    if torch.is_tensor(output):
+        return [output]
+    if isinstance(output, (list, tuple)):
+        return [t for element in output for t in tensors(element)]
+
+    return []
+
+
+def backward_target(output):
+    """ The loss of the models that return one, otherwise the sum of every output. """
+    if isinstance(output, tuple) and torch.is_tensor(output[0]) and output[0].dim() == 0:
+        return output[0]
+
+    return sum(t.float().sum() for t in tensors(output) if t.requires_grad)
+
+
+def leaf_flops(module, inputs, output):
+    """ The FLOPs of a module that has no submodules called on its forward. """
+    output_elements = sum(t.numel() for t in tensors(output))
+    if isinstance(module, nn.Conv2d):
+        kernel_height, kernel_width = module.kernel_size
+        flops = 2 * output_elements * module.in_channels // module.groups * kernel_height * kernel_width
+        return flops + (output_elements if module.bias is not None else 0)
+    if isinstance(module, nn.Linear):
+        return 2 * output_elements * module.in_features + (output_elements if module.bias is not None else 0)
+    if isinstance(module, GroupedFC):
+        batch_size = tensors(inputs)[0].size(0)
+        return sum(2 * batch_size * weight.numel() + batch_size * bias.numel()
+                   for weight, bias in zip(module.weight, module.bias))
+    if isinstance(module, (nn.modules.batchnorm._BatchNorm, nn.GroupNorm, nn.LayerNorm)):
+        return 2 * output_elements
+    if isinstance(module, ACTIVATIONS):
+        return output_elements
+
+    return 0
+
+
+def group_name(name, depth):
+    return '.'.join(name.split('.')[:depth]) if name else ''
+
+
+def is_leaf(module):
+    return isinstance(module, GroupedFC) or len(list(module.children())) == 0
+
+
+def count_costs(model, inputs, depth):
+    """
+        The parameters, FLOPs and output memory of the modules of a model, summed on the modules
+        at the given depth of the module names.
+    """
+    modules = {}
+    for name, module in model.named_modules():
+        if name.count('.') < depth:
+            modules.setdefault(group_name(name, depth), {
+                'type': type(module).__name__, 'parameters': 0, 'flops': 0, 'activation_bytes': 0})
+    for name, parameter in model.named_parameters():
+        modules[group_name(name.rsplit('.', 1)[0] if '.' in name else '', depth)]['parameters'] += \
+            parameter.numel()
+
+    def hook(name):
+        def count(module, inputs, output):
+            modules[name]['flops'] += leaf_flops(module, inputs, output)
+            modules[name]['activation_bytes'] += sum(t.numel() * t.element_size() for t in tensors(output))
+        return count
+
+    handles = [module.register_forward_hook(hook(group_name(name, depth)))
+               for name, module in model.named_modules() if is_leaf(module)]
+    try:
+        with torch.no_grad():
+            model(*inputs)
+    finally:
+        for handle in handles:
+            handle.remove()
+
+    return modules
+
+
+def synchronize(device):
+    if device.startswith('cuda'):
+        torch.cuda.synchronize()
+
+
+def time_modules(model, inputs, depth, iterations, device):
+    """ Mean forward time in milliseconds of the modules at the given depth, calls summed. """
+    times = {}
+    starts = {}
+
+    def pre_hook(name):
+        def start(module, inputs):
+            synchronize(device)
+            starts[name] = time.perf_counter()
+        return start
+
+    def hook(name):
+        def stop(module, inputs, output):
+            synchronize(device)
+            times[name] = times.get(name, 0.0) + time.perf_counter() - starts[name]
+        return stop
+
+    handles = []
+    for name, module in model.named_modules():
+        if name and name.count('.') == depth - 1:
+            handles.append(module.register_forward_pre_hook(pre_hook(name)))
+            handles.append(module.register_forward_hook(hook(name)))
+    try:
+        with torch.no_grad():
+            for _ in range(iterations):
+                model(*inputs)
+    finally:
+        for handle in handles:
+            handle.remove()
+
+    return {name: value * 1000.0 / iterations for name, value in times.items()}
+
+
+def time_model(model, inputs, iterations, warmup, device):
+    """ Mean forward and backward time in milliseconds of the whole model. """
+    forward_time, backward_time = 0.0, 0.0
+    for i in range(warmup + iterations):
+        model.zero_grad()
+        synchronize(device)
+        start = time.perf_counter()
+        output = model(*inputs)
+        synchronize(device)
+        middle = time.perf_counter()
+        backward_target(output).backward()
+        synchronize(device)
+        if i >= warmup:
+            forward_time += middle - start
+            backward_time += time.perf_counter() - middle
+
+    return forward_time * 1000.0 / iterations, backward_time * 1000.0 / iterations
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description=__doc__)
+    argparser.add_argument('-e', '--exp-config', dest='exp_config', type=str, required=True,
+                           help='The experiment yaml, an encoder or an affordances one')
+    argparser.add_argument('--batch-size', dest='batch_size', default=None, type=int,
+                           help='Defaults to the BATCH_SIZE of the configuration')
+    argparser.add_argument('--depth', default=1, type=int,
+                           help='The depth of the module names the costs are reported for')
+    argparser.add_argument('--iterations', default=10, type=int)
+    argparser.add_argument('--warmup', default=2, type=int)
+    argparser.add_argument('--device', default='cpu', type=str)
+    argparser.add_argument('--output', default=None, type=str,
+                           help='Write the report to this json file, to track it over time')
+    args = argparser.parse_args()
+
+    if args.depth < 1:
+        raise ValueError("The depth should be at least 1")
+    merge_with_yaml(args.exp_config)
+    # No need to download the ImageNet weights to measure the costs
+    g_conf.PRE_TRAINED = False
+    if args.batch_size is not None:
+        # The losses are normalized by the configured batch size
+        g_conf.BATCH_SIZE = args.batch_size
+    batch_size = g_conf.BATCH_SIZE
+
+    torch.manual_seed(0)
+    model, kind = build_model()
+    model.to(args.device).train()
+    inputs = random_inputs(kind, batch_size, args.device)
+
+    modules = count_costs(model, inputs, args.depth)
+    module_times = time_modules(model, inputs, args.depth, args.iterations, args.device)
+    forward_ms, backward_ms = time_model(model, inputs, args.iterations, args.warmup, args.device)
+
+    rows = []
+    for name, costs in sorted(modules.items()):
+        if not name:
+            continue
+        row = {'name': name}
+        row.update(costs)
+        row['forward_ms'] = module_times.get(name, 0.0)
+        rows.append(row)
+    report = {
+        'config': args.exp_config,
+        'model_type': g_conf.ENCODER_MODEL_TYPE if kind != 'affordances' else g_conf.MODEL_TYPE,
+        'date': datetime.datetime.now().isoformat(),
+        'torch_version': torch.__version__,
+        'device': args.device,
+        'batch_size': batch_size,
+        'input_shape': list(next(iter(g_conf.SENSORS.values()))),
+        'total': {'parameters': sum(p.numel() for p in model.parameters()),
+                  'flops': sum(costs['flops'] for costs in modules.values()),
+                  'activation_bytes': sum(costs['activation_bytes'] for costs in modules.values()),
+                  'forward_ms': forward_ms,
+                  'backward_ms': backward_ms},
+        'modules': rows
+    }
+
+    print("%s (%s), batch %d on %s" % (os.path.basename(args.exp_config), report['model_type'],
+                                       batch_size, args.device))
+    print("{:<40} {:>12} {:>10} {:>12} {:>12}".format('module', 'params (M)', 'GFLOPs',
+                                                      'act. (MB)', 'forward ms'))
+    for row in rows + [dict(name='total', **report['total'])]:
+        print("{:<40} {:>12.3f} {:>10.3f} {:>12.1f} {:>12.2f}".format(
+            row['name'], row['parameters'] / 1e6, row['flops'] / 1e9, row['activation_bytes'] / 2 ** 20,
+            row['forward_ms']))
+    print("Backward of the whole model: %.2f ms" % backward_ms)
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
@@ -0,0 +1,173 @@
+"""
+    Post training static int8 quantization of an affordances experiment (encoder and heads) for
+    CPU inference.
+
+    The fp32 model is traced with torch.fx, calibrated on a sample of CoILDataset frames and
+    converted to int8. Both models are then run over the validation json and the affordance
+    metrics of coil_core/validate.py are reported for both, with their difference. The int8
+    model is saved as TorchScript, with the experiment and the metrics in a metadata.json extra
+    file. Set its path as "quantized_model" on the agent json configuration to drive with it.
+
+    python3 -m tools.quantize -f EXP -e EXP_ALIAS --checkpoint 100000 --encoder-folder ENCODER \
+        --encoder-exp ENCODER_ALIAS --encoder-checkpoint 100000 -vj VALIDATION_JSON
+"""
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+import torch
+
+try:
+    from torch.ao.quantization import get_default_qconfig
+    from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+except ImportError:  # torch < 1.10
+    from torch.quantization import get_default_qconfig
+    from torch.quantization.quantize_fx import prepare_fx, convert_fx
+try:
+    from torch.ao.quantization import QConfigMapping
+except ImportError:  # torch < 1.13 takes a qconfig dict
+    QConfigMapping = None
+
+from configs import g_conf, merge_with_yaml
+from input import CoILDataset, Augmenter
+from network.inference import load_affordances_inference, set_intermediate_outputs
+from coilutils.metrics import AffordancesMetrics, CLASSIFICATION_NAMES
+
+
+def model_inputs(dataset, data):
+    return (torch.squeeze(data['rgb']), dataset.extract_inputs(data),
+            torch.squeeze(dataset.extract_commands(data)))
+
+
+def quantize(model, dataset, calibration_loader, backend):
+    """
+        Trace, calibrate and convert the model to int8.
+    """
+    torch.backends.quantized.engine = backend
+    qconfig = get_default_qconfig(backend)
+    example_inputs = model_inputs(dataset, next(iter(calibration_loader)))
+    if QConfigMapping is not None:
+        prepared = prepare_fx(model, QConfigMapping().set_global(qconfig), example_inputs)
+    else:
+        prepared = prepare_fx(model, {'': qconfig})
+
+    with torch.no_grad():
+        for count, data in enumerate(calibration_loader):
+            prepared(*model_inputs(dataset, data))
+            print("Calibration batch %d/%d" % (count + 1, len(calibration_loader)))
+
+    return convert_fx(prepared)
+
+
+def evaluate(model, dataset, data_loader, max_batches=None):
+    """
+        The affordance metrics of the validation, plus the mean time of a batch.
+    """
+    metrics = AffordancesMetrics([2] * len(CLASSIFICATION_NAMES), 1)
+    number_of_batches = 0
+    forward_time = 0.0
+    with torch.no_grad():
+        for count, data in enumerate(data_loader):
+            if max_batches is not None and count >= max_batches:
+                break
+            start = time.time()
+            c_output, r_output = model(*model_inputs(dataset, data))
+            forward_time += time.time() - start
+            number_of_batches += 1
+
+            metrics.update(c_output, r_output, dataset.extract_affordances_targets(data, 'classification'),
+                           dataset.extract_affordances_targets(data, 'regression'))
+
+    summary = metrics.summary(CLASSIFICATION_NAMES)
+    summary['ms_per_batch'] = 1000.0 * forward_time / max(number_of_batches, 1)
+
+    return summary
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description=__doc__)
+    argparser.add_argument('-f', '--folder', type=str, required=True)
+    argparser.add_argument('-e', '--exp', type=str, required=True)
+    argparser.add_argument('--checkpoint', type=int, required=True)
+    argparser.add_argument('-encoder-f', '--encoder-folder', dest='encoder_folder', default=None, type=str)
+    argparser.add_argument('-encoder-e', '--encoder-exp', dest='encoder_exp', default=None, type=str)
+    argparser.add_argument('--encoder-checkpoint', dest='encoder_checkpoint', default=None, type=int)
+    argparser.add_argument('-vj', '--val-json', dest='val_json', required=True,
+                           help='The validation json used to report the accuracy')
+    argparser.add_argument('--calibration-json', dest='calibration_json', default=None,
+                           help='The json the calibration frames are sampled from, the validation one by default')
+    argparser.add_argument('--calibration-frames', dest='calibration_frames', default=512, type=int)
+    argparser.add_argument('--batch-size', dest='batch_size', default=32, type=int)
+    argparser.add_argument('--max-batches', dest='max_batches', default=None, type=int,
+                           help='Limit the validation batches evaluated')
+    argparser.add_argument('--backend', default='fbgemm', choices=['fbgemm', 'qnnpack'],
+                           help='fbgemm for x86 hosts, qnnpack for ARM')
+    argparser.add_argument('--threads', default=None, type=int)
+    argparser.add_argument('-o', '--output', default=None, type=str)
+    args = argparser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    if args.encoder_checkpoint and args.encoder_folder and args.encoder_exp:
+        encoder_params = {'encoder_checkpoint': args.encoder_checkpoint,
+                          'encoder_folder': args.encoder_folder,
+                          'encoder_exp': args.encoder_exp}
+    else:
+        encoder_params = None
+    merge_with_yaml(os.path.join('configs', args.folder, args.exp + '.yaml'), encoder_params)
+    # The same data the validation uses, and the weights come from the checkpoints
+    g_conf.DATA_USED = 'central'
+    g_conf.PRE_TRAINED = False
+
+    fp32_model = load_affordances_inference(args.folder, args.checkpoint, encoder_params)
+    # The feature maps are not outputs of the quantized graph
+    set_intermediate_outputs(fp32_model, [])
+
+    def validation_dataset(json_file_path):
+        json_file_name = json_file_path.split('/')[-1].split('.')[-2]
+        # Shares the preload with the validation process of this json
+        return CoILDataset(transform=Augmenter(None),
+                           preload_name='validation_' + json_file_name + '_' + g_conf.DATA_USED,
+                           process_type='validation', vd_json_file_path=json_file_path)
+
+    dataset = validation_dataset(args.val_json)
+    data_loader = torch.utils.data.DataLoader(dataset, batch_size=args.batch_size, shuffle=False,
+                                              num_workers=g_conf.NUMBER_OF_LOADING_WORKERS)
+    if args.calibration_json is None or args.calibration_json == args.val_json:
+        calibration_dataset = dataset
+    else:
+        calibration_dataset = validation_dataset(args.calibration_json)
+    calibration_indices = np.random.RandomState(g_conf.MAGICAL_SEED).permutation(
+        len(calibration_dataset))[:args.calibration_frames].tolist()
+    calibration_loader = torch.utils.data.DataLoader(calibration_dataset, batch_size=args.batch_size,
+                                                     sampler=calibration_indices,
+                                                     num_workers=g_conf.NUMBER_OF_LOADING_WORKERS)
+
+    int8_model = quantize(fp32_model, calibration_dataset, calibration_loader, args.backend)
+
+    fp32_metrics = evaluate(fp32_model, dataset, data_loader, args.max_batches)
+    int8_metrics = evaluate(int8_model, dataset, data_loader, args.max_batches)
+    print("{:<28} {:>12} {:>12} {:>12}".format('Metric', 'fp32', 'int8', 'delta'))
+    for name in fp32_metrics:
+        print("{:<28} {:>12.4f} {:>12.4f} {:>12.4f}".format(name, fp32_metrics[name], int8_metrics[name],
+                                                           int8_metrics[name] - fp32_metrics[name]))
+
+    if args.output is None:
+        args.output = os.path.join('_logs', args.folder, g_conf.EXPERIMENT_NAME, 'checkpoints',
+                                   str(args.checkpoint) + '_int8.pt')
+    metadata = {'exp_batch': args.folder,
+                'exp_alias': args.exp,
+                'checkpoint': args.checkpoint,
+                'encoder_params': encoder_params,
+                'backend': args.backend,
+                'calibration_frames': len(calibration_indices),
+                'fp32_metrics': fp32_metrics,
+                'int8_metrics': int8_metrics}
+    example_inputs = model_inputs(dataset, next(iter(data_loader)))
+    with torch.no_grad():
+        scripted = torch.jit.trace(int8_model, example_inputs)
+    torch.jit.save(scripted, args.output, _extra_files={'metadata.json': json.dumps(metadata)})
+    print("Saved the int8 model on ", args.output)